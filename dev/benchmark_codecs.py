@@ -0,0 +1,82 @@
+"""Compare the codecs available for storing images in the session database.
+
+Usage: benchmark_codecs.py [image ...]
+
+For each image (or a set of synthetic A4 pages at 300 dpi if none are given)
+and codec, reports the blob size and the time taken to write the blob to and
+read it back from an SQLite database, including encoding and decoding."""
+
+from pathlib import Path
+import sqlite3
+import sys
+import time
+from PIL import Image, ImageDraw
+
+root = Path(__file__).resolve().parents[1] / "scantpaper"
+sys.path.insert(0, str(root))
+import imagecodec  # pylint: disable=wrong-import-position,import-error
+
+A4_300DPI = (2480, 3508)
+LEVELS = {"png": [1, 6], "raw": [None], "zlib": [1, 6], "zstd": [1, 3, 9]}
+
+
+def synthetic_pages():
+    "return a set of test pages, roughly like scanned text and photos"
+    text = Image.new("L", A4_300DPI, 255)
+    draw = ImageDraw.Draw(text)
+    for y in range(200, A4_300DPI[1] - 200, 50):
+        for x in range(200, A4_300DPI[0] - 200, 30):
+            if (x * 7 + y * 3) % 11:
+                draw.rectangle((x, y, x + 20, y + 30), fill=(x + y) % 64)
+    photo = Image.merge(
+        "RGB",
+        [
+            Image.effect_noise(A4_300DPI, sigma).point(lambda p: p // 2 + 64)
+            for sigma in (20, 40, 60)
+        ],
+    )
+    return {
+        "text (1-bit)": text.convert("1"),
+        "text (gray)": text,
+        "photo (RGB)": photo,
+    }
+
+
+def bench(image, codec, level):
+    "return the blob size and write and read times in seconds"
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE image (id INTEGER PRIMARY KEY, image BLOB)")
+    start = time.perf_counter()
+    blob = imagecodec.encode(image, codec, level)
+    con.execute("INSERT INTO image (id, image) VALUES (1, ?)", (blob,))
+    con.commit()
+    written = time.perf_counter()
+    (blob,) = con.execute("SELECT image FROM image WHERE id = 1").fetchone()
+    imagecodec.decode(blob).load()
+    read = time.perf_counter()
+    con.close()
+    return len(blob), written - start, read - written
+
+
+def main():
+    "main"
+    if len(sys.argv) > 1:
+        pages = {path: Image.open(path) for path in sys.argv[1:]}
+    else:
+        pages = synthetic_pages()
+    print(
+        f"{'page':<20} {'codec':<8} {'level':>5} {'MB':>8} {'write s':>8} {'read s':>8}"
+    )
+    for name, image in pages.items():
+        image.load()
+        for codec in imagecodec.available_codecs():
+            for level in LEVELS[codec]:
+                size, write, read = bench(image, codec, level)
+                print(
+                    f"{name:<20} {codec:<8} {level or '':>5} "
+                    f"{size / 1e6:>8.2f} {write:>8.3f} {read:>8.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
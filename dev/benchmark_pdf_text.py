@@ -0,0 +1,147 @@
+"""Compare adding text layers to PDFs with pdftext against the ocrmypdf
+round trip.
+
+Usage: benchmark_pdf_text.py [pages]
+
+Writes an image-only PDF of synthetic A4 pages at 300 dpi (10 by default), each
+with a text layer of 500 words, and then reports the time taken to add the text
+layers and the size of the output:
+
+- pdftext, rendering the text layers with 1 worker and with one per CPU
+- the previous path, writing the text layers as hOCR and rendering them with
+  ocrmypdf.api._hocr_to_ocr_pdf(), if ocrmypdf is installed. The hOCR stubs
+  from ocrmypdf.api._pdf_to_hocr(), which runs tesseract, are written
+  beforehand and not timed
+
+Writing the images is common to both and is not timed either"""
+
+import concurrent.futures
+import io
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+import img2pdf
+import pikepdf
+from PIL import Image, ImageDraw
+
+root = Path(__file__).resolve().parents[1] / "scantpaper"
+sys.path.insert(0, str(root))
+import pdftext  # pylint: disable=wrong-import-position,import-error
+from bboxtree import Bboxtree  # pylint: disable=wrong-import-position,import-error
+
+try:
+    import ocrmypdf
+except ImportError:
+    ocrmypdf = None
+
+A4_300DPI = (2480, 3508)
+WORD = (180, 50)  # size of each word in pixels
+
+
+def synthetic_page():
+    "return a page image and its text layer, roughly like scanned text"
+    image = Image.new("L", A4_300DPI, 255)
+    draw = ImageDraw.Draw(image)
+    words = [{"type": "page", "bbox": [0, 0, *A4_300DPI], "depth": 0}]
+    for y in range(200, A4_300DPI[1] - 200, WORD[1] + 20):
+        for x in range(200, A4_300DPI[0] - 200, WORD[0] + 20):
+            bbox = [x, y, x + WORD[0], y + WORD[1]]
+            draw.rectangle(bbox, fill=(x + y) % 64)
+            words.append({"type": "word", "bbox": bbox, "text": "word", "depth": 1})
+    return image, json.dumps(words[:501])
+
+
+def image_only_pdf(pages, tempdir):
+    "write the images of the pages, returning them as an image-only PDF"
+    filenames = []
+    for i, (image, _text) in enumerate(pages):
+        filenames.append(os.path.join(tempdir, f"{i:06}.png"))
+        image.save(filenames[-1], dpi=(300, 300))
+    layout = img2pdf.get_fixed_dpi_layout_fun((300, 300))
+    return img2pdf.convert(filenames, layout_fun=layout)
+
+
+def render_layer(image, text_layer):
+    "render the text layer of a page"
+    return pdftext.text_stream(text_layer, image.height), *image.size
+
+
+def with_pdftext(pages, path, tempdir, processes):
+    """write the image-only PDF, returning a function adding the text layers
+    with pdftext"""
+    origin = image_only_pdf(pages, tempdir)
+
+    def add_text_layers():
+        with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+            layers = list(
+                executor.map(
+                    render_layer,
+                    [image for image, _text in pages],
+                    [text for _image, text in pages],
+                )
+            )
+        with pikepdf.open(io.BytesIO(origin)) as pdf:
+            pdftext.add_text_layers(pdf, layers)
+            pdf.save(path)
+
+    return add_text_layers
+
+
+def with_ocrmypdf(pages, path, tempdir, _processes):
+    """write the image-only PDF and the hOCR stubs, returning a function adding
+    the text layers via the private ocrmypdf APIs"""
+    outdir = Path(tempdir)
+    with open(outdir / "origin_pre.pdf", "wb") as fhd:
+        fhd.write(image_only_pdf(pages, tempdir))
+    ocrmypdf.api._pdf_to_hocr(  # pylint: disable=protected-access
+        outdir / "origin_pre.pdf", outdir, language="eng", skip_text=True
+    )
+
+    def add_text_layers():
+        for i, (_image, text) in enumerate(pages):
+            with open(
+                outdir / f"{i+1:-06}_ocr_hocr.hocr", "w", encoding="utf-8"
+            ) as fhd:
+                fhd.write(Bboxtree(text).to_hocr())
+        ocrmypdf.api._hocr_to_ocr_pdf(  # pylint: disable=protected-access
+            outdir, path, optimize=0
+        )
+
+    return add_text_layers
+
+
+def main():
+    "main"
+    npages = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    pages = [synthetic_page()] * npages
+    writers = [
+        ("pdftext", with_pdftext, 1),
+        ("pdftext", with_pdftext, os.cpu_count() or 1),
+    ]
+    if ocrmypdf is None:
+        print("ocrmypdf not installed, skipping the previous path")
+    else:
+        writers.append(("ocrmypdf", with_ocrmypdf, 1))
+    print(f"{'writer':<10} {'workers':>7} {'pages':>5} {'MB':>8} {'s':>8}")
+    for name, writer, processes in writers:
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "output.pdf")
+            try:
+                add_text_layers = writer(pages, path, tempdir, processes)
+                start = time.perf_counter()
+                add_text_layers()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                print(f"{name:<10} failed: {err}")
+                continue
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(path)
+        print(
+            f"{name:<10} {processes:>7} {npages:>5} {size / 1e6:>8.2f} {elapsed:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
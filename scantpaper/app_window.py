@@ -329,6 +329,15 @@ class ApplicationWindow(
 
         # Update list in Document so that it can be used by get_resolution()
         self.slist.set_paper_sizes(self.settings["Paper"])
+        self.slist.set_processes(self.settings["processes"])
+        self.slist.set_page_cache_size(self.settings["page cache size"])
+        self.slist.set_undo_limit(
+            self.settings["undo steps"], self.settings["undo disk budget"]
+        )
+        self.slist.set_image_codec(
+            self.settings["image codec"], self.settings["image codec level"]
+        )
+        self.slist.set_keep_image_source(self.settings["keep image source"])
 
         main_vbox = self.builder.get_object("main_vbox")
         self.add(main_vbox)
@@ -1,6 +1,6 @@
 "Base document methods"
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import pathlib
 import re
 import os
@@ -12,12 +12,12 @@ import signal
 import weakref
 import gi
 from simplelist import SimpleList
-from helpers import slurp, _weak_callback
+from helpers import _weak_callback
 from i18n import _
 from docthread import DocThread
 
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, Gdk  # pylint: disable=wrong-import-position
+from gi.repository import Gtk, Gdk, GLib  # pylint: disable=wrong-import-position
 
 ID_PAGE = 1
 ID_URI = 0
@@ -32,6 +32,7 @@ class BaseDocument(SimpleList):
     jobs_completed = 0
     jobs_total = 0
     paper_sizes = {}
+    thumbnail_cache_size = 1000  # lazily loaded thumbnails to keep in memory
 
     def __init__(self, **kwargs):
         columns = {"#": "int", _("Thumbnails"): "pixbuf", "Page ID": "hint"}
@@ -47,6 +48,9 @@ class BaseDocument(SimpleList):
         self.set_reorderable(True)
         self.dir = None
         self.clipboard = None
+        self._thumb_cache = OrderedDict()
+        self._thumbs_pending = set()
+        self._thumbs_idle = None
         for key, val in kwargs.items():
             setattr(self, key, val)
         if not self.dir:
@@ -109,6 +113,9 @@ class BaseDocument(SimpleList):
         # selection changed signal is not being blocked correctly, so add an extra flag
         self._block_signals = False
 
+        # fill in missing thumbnails as the rows are shown
+        self.connect("draw", _weak_callback(self, "_on_draw"))
+
     def _on_row_changed(self, _self, _path, _iter):
         "Set-up the callback when the page number has been edited."
         # Note uuids for selected pages
@@ -132,6 +139,76 @@ class BaseDocument(SimpleList):
             selection.append(self.find_page_by_uuid(i))
         self.select(selection)
 
+    def _on_draw(self, _widget, _context):
+        # don't touch the model whilst drawing
+        if self._thumbs_idle is None:
+            self._thumbs_idle = GLib.idle_add(
+                _weak_callback(self, "_fetch_visible_thumbnails_idle")
+            )
+        return False
+
+    def _fetch_visible_thumbnails_idle(self):
+        self._thumbs_idle = None
+        self.fetch_visible_thumbnails()
+        return GLib.SOURCE_REMOVE
+
+    def fetch_visible_thumbnails(self):
+        """fill in the thumbnails of the visible rows from the cache, and
+        fetch those not cached in the background"""
+        visible = self.get_visible_range()
+        if not visible:
+            return
+        first, last = visible[0].get_indices()[0], visible[1].get_indices()[0]
+        missing, cached = [], {}
+        for i in range(first, last + 1):
+            row = self.data[i]
+            thumb, page_id = row[1], row[2]
+            if thumb is not None:
+                if page_id in self._thumb_cache:
+                    self._thumb_cache.move_to_end(page_id)
+                continue
+            if page_id in self._thumbs_pending:
+                continue
+            if page_id in self._thumb_cache:
+                cached[page_id] = self._thumb_cache[page_id]
+            else:
+                missing.append(page_id)
+        if cached:
+            self._set_thumbnails(cached)
+        if not missing:
+            return
+        self._thumbs_pending.update(missing)
+
+        def thumbnail_data_callback(response):
+            self._thumbs_pending.difference_update(response.info["thumbs"])
+            self._set_thumbnails(response.info["thumbs"])
+
+        def thumbnail_finished_callback(_response):
+            self._thumbs_pending.difference_update(missing)
+
+        self.thread.thumbnails(
+            missing,
+            data_callback=thumbnail_data_callback,
+            finished_callback=thumbnail_finished_callback,
+            error_callback=thumbnail_finished_callback,
+        )
+
+    def _set_thumbnails(self, thumbs):
+        """set the thumbnails of the given pages in a single pass over the
+        rows, dropping the least recently shown lazily loaded thumbnails if
+        the cache is full"""
+        for page_id, thumb in thumbs.items():
+            self._thumb_cache[page_id] = thumb
+            self._thumb_cache.move_to_end(page_id)
+        changes = dict(thumbs)
+        while len(self._thumb_cache) > self.thumbnail_cache_size:
+            changes[self._thumb_cache.popitem(last=False)[0]] = None
+        self.get_model().handler_block(self.row_changed_signal)
+        for row in self.data:
+            if row[2] in changes:
+                row[1] = changes[row[2]]
+        self.get_model().handler_unblock(self.row_changed_signal)
+
     def _on_selection_changed(self, _selection):
         if self._block_signals:
             return
@@ -142,16 +219,32 @@ class BaseDocument(SimpleList):
         self.paper_sizes = paper_sizes
         self.thread.send("set_paper_sizes", paper_sizes)
 
+    def set_image_codec(self, codec="png", level=None):
+        "Set the codec and compression level used to store images in the session"
+        self.thread.send("set_image_codec", codec, level)
+
+    def set_keep_image_source(self, keep=True):
+        "Set whether to keep the original compressed bitstream of imported images"
+        self.thread.send("set_keep_image_source", keep)
+
+    def set_page_cache_size(self, size):
+        "Set the memory budget in MB for caching decoded pages"
+        self.thread.send("set_page_cache_size", size)
+
+    def set_undo_limit(self, steps=None, disk_budget=None):
+        "Set the maximum number of undo steps and the session disk budget in MB"
+        self.thread.send("set_undo_limit", steps, disk_budget)
+
+    def set_processes(self, processes=None):
+        "Set the number of worker processes used for image operations and OCR"
+        self.thread.send("set_processes", processes)
+
     def cancel(self, cancel_callback, process_callback=None):
         "Kill all running processes"
         with self.thread.lock:  # FIXME: move most of this to basethread.py
             # Empty process queue first to stop any new process from starting
             logger.info("Emptying process queue")
-            try:
-                while self.thread.requests.get(False):
-                    pass
-            except queue.Empty:
-                pass
+            self.thread.drain_requests()
             try:
                 while self.thread.responses.get(False):
                     pass
@@ -166,18 +259,15 @@ class BaseDocument(SimpleList):
             self.thread.cancel = True
 
             # Kill all running processes in the thread
-            for pidfile in list(self.thread.running_pids):
-                pid = slurp(pidfile)
-                if pid != "":
-                    if pid == 1:
-                        continue
-                    if process_callback is not None:
-                        process_callback(pid)
-
-                    logger.info("Killing PID %s", pid)
+            for pid in list(self.thread.running_pids):
+                if process_callback is not None:
+                    process_callback(pid)
 
-                    os.killpg(os.getpgid(pid), signal.SIGKILL)
-                    del self.thread.running_pids[pidfile]
+                logger.info("Killing PID %s", pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass  # already finished
 
         # Add a cancel request to ensure the reply is not blocked
         logger.info("Requesting cancel")
@@ -584,7 +674,7 @@ class BaseDocument(SimpleList):
             self.get_model().handler_block(self.row_changed_signal)
 
         self.thread.open(db)
-        self.data = self.thread.page_number_table()
+        self.data = self.thread.page_number_table(thumbnails=False)
         logger.info("Opened document %s", db)
         logger.info("Found %i pages", len(self.data))
 
@@ -736,6 +826,7 @@ for method_name_ in [
     "negate",
     "unsharp",
     "crop",
+    "apply_chain",
     "tesseract",
     "user_defined",
 ]:
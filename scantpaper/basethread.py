@@ -3,6 +3,9 @@
 import threading
 import queue
 import collections
+import concurrent.futures
+import heapq
+import itertools
 from enum import Enum
 import uuid
 import logging
@@ -27,11 +30,110 @@ ResponseType = Enum("ResponseType", ResponseTypes)
 logger = logging.getLogger(__name__)
 
 CALLBACKS = ["queued", "started", "running", "data", "finished", "error"]
+RUNNING_INTERVAL = 100  # ms between running callbacks
+
+# Priority classes of requests. Interactive requests overtake everything else
+# in the queue, and are also run by bulk requests between pages. Normal
+# requests overtake bulk requests. Requests of the same class run in order,
+# and no request overtakes one queued before it that touches the same pages.
+# Quit runs after everything queued before it, and nothing queued after it
+# overtakes it.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+PRIORITY_LAST = 3
+
+
+class RequestQueue(queue.Queue):
+    "A queue of requests, ordered by their priority class and then FIFO"
+
+    def _init(self, maxsize):
+        self.queue = []
+        self._count = itertools.count()
+        self._last = 0
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        # once a request of the last class is queued, anything after it waits
+        priority = PRIORITY_LAST if self._last else item.priority
+        for queued_priority, _count, queued in self.queue:
+            if queued_priority > priority and _share_pages(item.pages, queued.pages):
+                priority = queued_priority
+        item.priority = priority
+        if priority == PRIORITY_LAST:
+            self._last += 1
+        heapq.heappush(self.queue, (priority, next(self._count), item))
+
+    def _get(self):
+        priority, _count, item = heapq.heappop(self.queue)
+        if priority == PRIORITY_LAST:
+            self._last -= 1
+        return item
+
+    def get_interactive(self, busy=frozenset()):
+        """return the next request if it is interactive and doesn't touch the
+        busy pages, otherwise None"""
+        with self.not_empty:
+            if (
+                not self.queue
+                or self.queue[0][0] != PRIORITY_INTERACTIVE
+                or _share_pages(self.queue[0][2].pages, busy)
+            ):
+                return None
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+
+def _share_pages(pages1, pages2):
+    """whether requests touching the given sets of page ids might touch the
+    same page. None stands for any page"""
+    if pages1 is None:
+        return pages2 is None or bool(pages2)
+    if pages2 is None:
+        return bool(pages1)
+    return not pages1.isdisjoint(pages2)
+
+
+class ResponseQueue(queue.Queue):
+    """A queue that calls wakeup whenever a response is put on it, so that
+    the main loop doesn't have to poll for responses"""
+
+    def __init__(self, wakeup, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wakeup = weakref.WeakMethod(wakeup)
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        wakeup = self._wakeup()
+        if wakeup is not None:
+            wakeup()
+
+
+class RequestError(RuntimeError):
+    "The exception set on the future of a request that failed"
+
+
+class RequestFuture(concurrent.futures.Future):
+    """The future of a request, resolved from the thread with the result of
+    the request, with anything passed to the data callback in data. Use
+    asyncio.wrap_future() to await it"""
+
+    def __init__(self):
+        super().__init__()
+        self.data = []
 
 
 class Request:
     "Attributes and methods around requests"
 
+    priority = PRIORITY_NORMAL
+    future = None
+    # the ids of the pages read or changed by the request, None for any page
+    pages = frozenset()
+
     def __init__(self, process_name, process_args, return_queue, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.process = process_name
@@ -40,7 +142,14 @@ class Request:
         self.return_queue = return_queue
 
     def put(self, info, rtype=ResponseType.FINISHED, status=None):
-        "put a response on the return queue"
+        "put a response on the return queue, and resolve the future, if any"
+        if self.future is not None and not self.future.done():
+            if rtype == ResponseType.DATA:
+                self.future.data.append(info)
+            elif rtype == ResponseType.FINISHED:
+                self.future.set_result(info)
+            elif rtype == ResponseType.ERROR:
+                self.future.set_exception(RequestError(status))
         if self.return_queue is not None:
             self.return_queue.put(
                 Response(
@@ -78,11 +187,19 @@ class Request:
 class BaseThread(threading.Thread):
     "A thread backed by internal queues for simple messaging"
 
+    # process -> priority class, if not PRIORITY_NORMAL
+    priorities = {"quit": PRIORITY_LAST}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.daemon = True
-        self.requests = queue.Queue()
-        self.responses = queue.Queue()
+        self.requests = RequestQueue()
+        self.responses = ResponseQueue(self._wakeup)
+        self._dispatch_lock = threading.Lock()
+        self._dispatch_pending = False
+        self._running_source = None
+        self._current = None
+        self._yielding = False
         self.callbacks = {}
         self.additional_callbacks = {}
         self.before = {}
@@ -100,6 +217,7 @@ class BaseThread(threading.Thread):
         try:
             # We don't need a response queue for finalization
             request = Request("quit", [], None)
+            request.priority = PRIORITY_LAST
             requests_queue.put(request)
         except Exception:  # pylint: disable=broad-except
             # If the interpreter is shutting down, queues might be closed/None
@@ -113,6 +231,17 @@ class BaseThread(threading.Thread):
         "dummy input handler to be overridden as required"
         return request.args
 
+    def drain_requests(self):
+        """remove all queued requests, to stop them from starting, cancelling
+        their futures, if any"""
+        while True:
+            try:
+                request = self.requests.get(False)
+            except queue.Empty:
+                return
+            if request.future is not None:
+                request.future.cancel()
+
     def do_quit(self, _request):
         "quit function does nothing"
 
@@ -134,8 +263,13 @@ class BaseThread(threading.Thread):
         *args,
         **kwargs,
     ):
-        "Puts the process and args as a `Request` on the requests queue"
+        """Puts the process and args as a `Request` on the requests queue,
+        returning its uuid, or with return_future=True, a RequestFuture"""
         request = Request(process, args, self.responses)
+        request.priority = self.priorities.get(process, PRIORITY_NORMAL)
+        request.pages = self.request_pages(process, args)
+        if kwargs.get("return_future"):
+            request.future = RequestFuture()
         callbacks = {"started": False}
         for callback in CALLBACKS:
             name = callback + "_callback"
@@ -148,22 +282,101 @@ class BaseThread(threading.Thread):
         self.requests.put(request)
         self.total_jobs += 1
         request.queued()
-        GLib.timeout_add(100, self.monitor)
+        if request.future is not None:
+            return request.future
         return request.uuid
 
+    def request_pages(self, _process, _args):  # pylint: disable=no-self-use
+        """return the ids of the pages that the process would read or change
+        with the given args, or None if it could be any page. To be overridden
+        as required"""
+        return frozenset()
+
+    def _wakeup(self):
+        """schedule the dispatch of the responses in the main loop, if it
+        isn't already scheduled. Called from any thread"""
+        with self._dispatch_lock:
+            if self._dispatch_pending:
+                return
+            self._dispatch_pending = True
+        GLib.idle_add(self._dispatch)
+
+    def _dispatch(self):
+        """trigger the callbacks for all pending responses, and whilst any
+        request is running, for the running callbacks. Once everything sent has
+        finished, the job counters start again"""
+        with self._dispatch_lock:
+            self._dispatch_pending = False
+        while not self.responses.empty():
+            self._monitor_response()
+        if not self.callbacks and self.requests.empty():
+            self.num_completed_jobs = 0
+            self.total_jobs = 0
+        if self._running_source is None and self._any_started():
+            self._running_source = GLib.timeout_add(
+                RUNNING_INTERVAL, self._tick_running
+            )
+        return GLib.SOURCE_REMOVE
+
+    def _tick_running(self):
+        "trigger the running callbacks until no request is running"
+        if self._any_started():
+            self._execute_callbacks_for_stage("running", None)
+            return GLib.SOURCE_CONTINUE
+        self._running_source = None
+        return GLib.SOURCE_REMOVE
+
+    def _any_started(self):
+        "return whether any request has started and not yet finished"
+        return any(callbacks["started"] for callbacks in self.callbacks.values())
+
     def run(self):
         "override the run() method of threading. Not called directly here"
         while True:
-            request = self.requests.get()
-            request.started()
-            request.args = self.input_handler(request)
-            handler = getattr(self, f"do_{request.process}", None)
-            if handler is None:
-                request.error(None, f"no handler for [{request.process}]")
-            else:
-                if not self.handler_wrapper(request, handler):
-                    break
-            self.requests.task_done()
+            self._current = self.next_request()
+            if not self._run_request(self._current):
+                break
+
+    def _run_request(self, request):
+        "run the request, returning False if the thread should stop"
+        request.started()
+        request.args = self.input_handler(request)
+        handler = getattr(self, f"do_{request.process}", None)
+        if handler is None:
+            request.error(None, f"no handler for [{request.process}]")
+        else:
+            if not self.handler_wrapper(request, handler):
+                return False
+        self.requests.task_done()
+        return True
+
+    def can_yield(self):
+        "whether the running request can be interrupted by interactive requests"
+        return threading.current_thread() is self
+
+    def yield_to_interactive(self):
+        """run any interactive requests waiting in the queue that don't touch
+        the pages of the running request. Called between pages by bulk
+        requests, so that interactive requests don't have to wait for the
+        whole batch"""
+        if not self.can_yield():
+            return
+        busy = frozenset() if self._current is None else self._current.pages
+        while True:
+            request = self.requests.get_interactive(busy)
+            if request is None:
+                return
+            logger.info("Running %s before continuing", request.process)
+            self._yielding = True
+            try:
+                self._run_request(request)
+            finally:
+                self._yielding = False
+
+    def next_request(self):
+        """block until the next request is available. Can be overridden by
+        subclasses with work in flight outside the requests queue"""
+        return self.requests.get()
 
     def handler_wrapper(self, request, handler):
         "separate the handler wrapper logic so that it can be overriden by subclasses"
@@ -180,16 +393,6 @@ class BaseThread(threading.Thread):
             request.error(None, str(err))
         return True
 
-    def monitor(self, block=False):
-        "monitor the thread, triggering callbacks as required"
-        if block:
-            return self._monitor_response(block)
-        # no point in returning if there are still responses
-        while not self.responses.empty():
-            return self._monitor_response(block)
-        self.total_jobs = 0
-        return GLib.SOURCE_CONTINUE
-
     def _execute_callbacks_for_stage(self, stage, result):
         """helper method to run the callbacks associated with each stage
         (started, running, finished)"""
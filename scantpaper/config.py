@@ -64,6 +64,7 @@ DEFAULTS = {
     "cancel-between-pages": False,
     "adf-defaults-scan-all-pages": True,
     "cycle sane handle": False,
+    "scan spool size": 0,  # pages scanned ahead of being imported, 0 = none
     "ignore-duplex-capabilities": False,
     "profile": {},
     "default profile": None,
@@ -91,6 +92,13 @@ DEFAULTS = {
     "current_psh": None,
     "auto-open-scan-dialog": True,
     "available-tmp-warning": 10,
+    "processes": None,  # workers for image operations and OCR, None = all cores
+    "image codec": "png",  # png, raw, zlib or zstd
+    "image codec level": None,  # compression level, None = codec default
+    "keep image source": True,  # keep imported JPEGs etc. to embed as is in PDFs
+    "page cache size": 256,  # MB of decoded pages to keep in memory
+    "undo steps": 100,  # None = unlimited
+    "undo disk budget": None,  # MB for the session including undo history
     "close_dialog_on_save": True,
     "Paper": {
         _("A3"): {
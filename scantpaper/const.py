@@ -53,4 +53,4 @@ HELP_WINDOW_DIVIDER_POS = 200
 
 THUMBNAIL = 100  # pixels
 APPLICATION_ID = 2235627884
-USER_VERSION = 1
+USER_VERSION = 4
@@ -31,6 +31,16 @@ class SaneScanDialog(Scan):
         "despite scanning from flatbed.",
     )
 
+    scan_spool_size = GObject.Property(
+        type=int,
+        minimum=0,
+        maximum=1000,
+        default=0,
+        nick="Pages to scan ahead",
+        blurb="Number of scanned pages to hold whilst they are imported. "
+        "0 waits for each page before scanning the next.",
+    )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.thread = SaneThread()
@@ -474,8 +484,17 @@ class SaneScanDialog(Scan):
             )
             self.emit("started-process", make_progress_string(i, num_pages))
 
+        scan_fraction = None
+
         def running_callback(progress):
-            self.emit("changed-progress", progress, None)
+            # only pulse if the backend doesn't report how much has been read
+            if scan_fraction is None:
+                self.emit("changed-progress", progress, None)
+
+        def progress_callback(fraction):
+            nonlocal scan_fraction
+            scan_fraction = fraction
+            self.emit("changed-progress", fraction, None)
 
         def finished_callback(_response):
             self.emit("finished-process", "scan_pages")
@@ -493,8 +512,10 @@ class SaneScanDialog(Scan):
 
         def new_page_callback(image_ob, pagenumber):
             nonlocal i
+            nonlocal scan_fraction
             nonlocal xresolution
             nonlocal yresolution
+            scan_fraction = None
             self.emit("new-scan", image_ob, pagenumber, xresolution, yresolution)
             self.emit(
                 "changed-progress",
@@ -522,9 +543,15 @@ class SaneScanDialog(Scan):
             running_callback=running_callback,
             finished_callback=finished_callback,
             new_page_callback=new_page_callback,
+            progress_callback=progress_callback,
             error_callback=error_callback,
+            spool_size=self.scan_spool_size,
         )
 
+    def release_scan(self):
+        "release the place in the scan spool held by a page that has been imported"
+        self.thread.release_frame()
+
     def cancel_scan(self, _widget):
         "cancel any running or queued scan processes"
         self.thread.cancel()
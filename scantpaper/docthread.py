@@ -1,5 +1,11 @@
 "Threading model for the Document class"
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
+import multiprocessing
 import pathlib
 import json
 import logging
@@ -13,21 +19,37 @@ import shutil
 import sqlite3
 import tempfile
 import threading
-from PIL import ImageStat, ImageEnhance, ImageOps, ImageFilter
+import time
+import queue
+from PIL import Image, UnidentifiedImageError
 from const import THUMBNAIL, APPLICATION_ID, USER_VERSION
+from basethread import PRIORITY_BULK, PRIORITY_INTERACTIVE
 from importthread import _note_callbacks
-from savethread import SaveThread
+from savethread import SaveThread, _run_user_defined
 from i18n import _
 from page import Page
 from bboxtree import Bboxtree
+import imagecodec
+from imagecache import ImageCache
+from pixbufs import bytes_to_pixbuf
+import imageops
 import tesserocr
-import gi
-
-gi.require_version("Gtk", "3.0")
-from gi.repository import GLib, GdkPixbuf  # pylint: disable=wrong-import-position
+from tesseract import EnginePool, hocr_document
 
 logger = logging.getLogger(__name__)
 
+POOL_POLL_INTERVAL = 0.1  # seconds
+GC_BATCH = 100  # rows deleted per garbage collection step
+GC_VACUUM_PAGES = 1000  # database pages returned to the filesystem per step
+BULK_COMMIT_INTERVAL = 1  # seconds between commits during a bulk import
+
+# Each page_order row is valid for the actions action_id <= a < end_action_id,
+# so that an action only writes the rows it changes. Rows that are still
+# valid have end_action_id = OPEN_ENDED, and the rows valid at a given action
+# are selected with VALID_AT, passing the action id twice.
+OPEN_ENDED = 2**62
+VALID_AT = "page_order.action_id <= ? AND page_order.end_action_id > ?"
+
 
 def _loggerise(variables):
     logger_vars = None
@@ -46,15 +68,77 @@ def _loggerise(variables):
     return logger_vars
 
 
+# unpaper options disabling all processing, to check what it supports
+UNPAPER_NO_PROCESSING = [
+    "no-deskew",
+    "no-mask-scan",
+    "no-mask-center",
+    "no-blackfilter",
+    "no-grayfilter",
+    "no-noisefilter",
+    "no-blurfilter",
+    "no-border-scan",
+    "no-border-align",
+]
+
+
 class DocThread(SaveThread):
     "subclass basethread for document"
 
+    priorities = {
+        **SaveThread.priorities,
+        "set_selection": PRIORITY_INTERACTIVE,
+        "set_saved": PRIORITY_INTERACTIVE,
+        "set_text": PRIORITY_INTERACTIVE,
+        "set_annotations": PRIORITY_INTERACTIVE,
+        "set_resolution": PRIORITY_INTERACTIVE,
+        "set_mean_std_dev": PRIORITY_INTERACTIVE,
+        **{process: PRIORITY_INTERACTIVE for process in imageops.OPERATIONS},
+        "split_page": PRIORITY_INTERACTIVE,
+        "analyse": PRIORITY_BULK,
+        "tesseract": PRIORITY_BULK,
+        "unpaper": PRIORITY_BULK,
+    }
+    # processes which don't read or change existing pages. "page" is the page
+    # number at which to add the new page, not a page id
+    pageless = {
+        "cancel",
+        "create",
+        "get_file_info",
+        "import_file",
+        "import_page",
+        "import_scan",
+        "quit",
+        "set_image_codec",
+        "set_keep_image_source",
+        "set_page_cache_size",
+        "set_paper_sizes",
+        "set_processes",
+        "set_selection",
+        "set_undo_limit",
+        "thumbnails",
+    }
     heightt = THUMBNAIL
     widtht = THUMBNAIL
     _action_id = 0
     _db = None
     _dir = None
-    # number_undo_steps = 10
+    _pool = None
+    _unpaper_pipes = None  # whether unpaper can use stdin and stdout
+    image_codec = "png"
+    image_codec_level = None
+    keep_image_source = True
+    page_cache_size = 256  # MB
+    undo_steps = None  # None = unlimited
+    undo_disk_budget = None  # MB, None = unlimited
+    _gc_pending = False
+    _indexed = False
+    _bulk_pending = None  # pages being encoded during a bulk import
+    _bulk_encoder = None
+    _bulk_rows = None  # rows to pass to the data callback after committing
+    _bulk_snapshot = False
+    _bulk_committed = 0.0
+    _deferring_commit = False
 
     def __init__(self, *args, **kwargs):
         for key in ["dir", "db"]:
@@ -81,11 +165,42 @@ class DocThread(SaveThread):
         self._con = {}
         self._cur = {}
         self._write_tid = None
+        self._pooled = collections.deque()
+        self.page_cache = ImageCache(self.page_cache_size * 1024 * 1024)
+        self._engines = EnginePool(maxidle=self.processes)
+        self._tessdata = None
         self.start()
-        mlp = GLib.MainLoop()
-        GLib.timeout_add(2000, mlp.quit)  # to prevent it hanging
-        self.send("create", self._db, finished_callback=lambda x: mlp.quit())
-        mlp.run()
+        self.send("create", self._db)
+        self.requests.join()
+
+    def request_pages(self, process, args):
+        """return the ids of the pages that the process would read or change
+        with the given args, or None if it could be any page, e.g. when they
+        are given by page number"""
+        if process in self.pageless:
+            return frozenset()
+        if not args:
+            return None
+        if not isinstance(args[0], dict):
+            if isinstance(args[0], list):
+                return frozenset(args[0])
+            return frozenset([args[0]])
+        options = args[0]
+        if "page" in options:
+            return frozenset([options["page"]])
+        for key in ("pages", "list_of_pages", "page_ids"):
+            if key in options:
+                return frozenset(options[key])
+        return None
+
+    def can_yield(self):
+        """interactive requests may take undo snapshots, so can't be run
+        whilst changes are being collected into a single undo step"""
+        return (
+            super().can_yield()
+            and not self._deferring_commit
+            and self._bulk_pending is None
+        )
 
     def _connect(self):
         tid = threading.get_native_id()
@@ -149,6 +264,7 @@ class DocThread(SaveThread):
             )
             self.open(self._db)
             return
+        self._execute("PRAGMA auto_vacuum=INCREMENTAL")
         self._execute("PRAGMA journal_mode=WAL")
         self._execute(f"PRAGMA application_id={APPLICATION_ID}")
         self._execute(f"PRAGMA user_version={USER_VERSION}")
@@ -157,8 +273,11 @@ class DocThread(SaveThread):
             """CREATE TABLE image(
                 id INTEGER PRIMARY KEY,
                 image BLOB,
-                thumb BLOB)"""
+                thumb BLOB,
+                hash BLOB,
+                source BLOB)"""
         )
+        self._execute("CREATE INDEX image_hash ON image(hash)")
         self._execute(
             """CREATE TABLE page(
                 id INTEGER PRIMARY KEY,
@@ -174,22 +293,92 @@ class DocThread(SaveThread):
         )
         self._execute(
             """CREATE TABLE page_order(
-                action_id INTEGER NOT NULL,
                 row_id INTEGER NOT NULL,
                 page_number INTEGER NOT NULL,
                 page_id INTEGER NOT NULL,
-                FOREIGN KEY (page_id) REFERENCES page(id),
-                PRIMARY KEY (action_id, row_id))"""
+                action_id INTEGER NOT NULL,
+                end_action_id INTEGER NOT NULL,
+                FOREIGN KEY (page_id) REFERENCES page(id))"""
         )
+        self._create_page_order_indexes()
         self._execute(
             """CREATE TABLE selection(
                 action_id INTEGER PRIMARY KEY,
                 row_ids TEXT NOT NULL)"""
         )
+        self._create_indexes()
+
+    def _create_indexes(self):
+        """create the indexes needed to find unreferenced rows. Sessions
+        created by older versions don't have them"""
+        self._check_write_tid()
+        self._execute(
+            "CREATE INDEX IF NOT EXISTS page_order_page_id ON page_order(page_id)"
+        )
+        self._execute("CREATE INDEX IF NOT EXISTS page_image_id ON page(image_id)")
+        self._con[threading.get_native_id()].commit()
+        self._indexed = True
+
+    def _create_page_order_indexes(self):
+        "create the indexes to select the page_order rows valid at an action"
+        self._execute("CREATE INDEX page_order_action_id ON page_order(action_id)")
+        self._execute(
+            "CREATE INDEX page_order_end_action_id ON page_order(end_action_id)"
+        )
+        self._execute("CREATE INDEX page_order_page_number ON page_order(page_number)")
+
+    def _upgrade_page_order(self):
+        """convert the page_order table of sessions created by older versions,
+        which held a copy of every row for every action, to ranges of actions"""
+        self._execute("SELECT MAX(action_id) FROM page_order")
+        max_action_id = self._fetchone()[0]
+        self._execute("ALTER TABLE page_order RENAME TO page_order_v1")
+        self._execute(
+            """CREATE TABLE page_order(
+                row_id INTEGER NOT NULL,
+                page_number INTEGER NOT NULL,
+                page_id INTEGER NOT NULL,
+                action_id INTEGER NOT NULL,
+                end_action_id INTEGER NOT NULL,
+                FOREIGN KEY (page_id) REFERENCES page(id))"""
+        )
+        # consecutive actions with identical rows have the same difference
+        # between action_id and the row number in the partition
+        self._execute(
+            """INSERT INTO page_order
+                (row_id, page_number, page_id, action_id, end_action_id)
+               SELECT row_id, page_number, page_id,
+                MIN(action_id), MAX(action_id) + 1
+               FROM (SELECT *, action_id - ROW_NUMBER() OVER (
+                    PARTITION BY row_id, page_number, page_id ORDER BY action_id
+                ) AS run FROM page_order_v1)
+               GROUP BY row_id, page_number, page_id, run"""
+        )
+        self._execute(
+            "UPDATE page_order SET end_action_id = ? WHERE end_action_id > ?",
+            (OPEN_ENDED, max_action_id),
+        )
+        self._execute("DROP TABLE page_order_v1")
+        self._create_page_order_indexes()
+
+    def _upgrade(self, user_version):
+        "upgrade a session created by an older version"
+        logger.info("Upgrading %s to user_version %s", self._db, USER_VERSION)
+        if user_version < 2:
+            self._upgrade_page_order()
+        if user_version < 3:
+            # the existing images are hashed when they are next compared
+            self._execute("ALTER TABLE image ADD COLUMN hash BLOB")
+            self._execute("CREATE INDEX image_hash ON image(hash)")
+        if user_version < 4:
+            self._execute("ALTER TABLE image ADD COLUMN source BLOB")
+        self._execute(f"PRAGMA user_version={USER_VERSION}")
+        self._con[threading.get_native_id()].commit()
 
     def open(self, db):
         "open a saved database"
         self._db = db
+        self._indexed = False
         self._connect()
         self._execute("PRAGMA application_id")
         application_id = self._fetchone()
@@ -204,38 +393,80 @@ class DocThread(SaveThread):
                 logger.warning(
                     "%s was created by a newer version of scantpaper.", self._db
                 )
-        self._execute("SELECT MAX(action_id) FROM page_order")
+            elif 0 < user_version[0] < USER_VERSION:
+                self._upgrade(user_version[0])
+        self._execute("SELECT MAX(action_id) FROM selection")
         row = self._fetchone()
-        if row:
+        if row and row[0] is not None:
             self._action_id = row[0]
 
-    def _insert_image(self, page, if_different_from=None):
-        "insert an image to the database"
+    def _insert_image(self, page, if_different_from=None, encoded=None):
+        """insert an image to the database, unless an identical image is
+        already there, returning its id and thumbnail. encoded is the result
+        of _encode_page(), if the page has already been encoded"""
         self._check_write_tid()
-        bytes_image = page.to_bytes()
-        insert = True
         if if_different_from is not None:
             self._execute(
-                "SELECT image, thumb FROM image WHERE id = ?",
+                "SELECT hash FROM image WHERE id = ?",
                 (if_different_from,),
             )
             row = self._fetchone()
             if not row:
                 raise ValueError(f"Image id {if_different_from} not found")
-            if row[0] == bytes_image:
-                insert = False
-                thumb = self._bytes_to_pixbuf(row[1])
-        if insert:
-            thumb = page.get_pixbuf_at_scale(self.heightt, self.widtht)
-            self._execute(
-                "INSERT INTO image (id, image, thumb) VALUES (NULL, ?, ?)",
-                (
-                    bytes_image,
-                    self._pixbuf_to_bytes(thumb),
-                ),
-            )
-            return self._cur[threading.get_native_id()].lastrowid, thumb
-        return if_different_from, thumb
+            if row[0] is None:  # sessions created by older versions
+                self._hash_image(if_different_from)
+
+        if encoded is None:
+            digest = imagecodec.digest(page.image_object)
+        else:
+            digest = encoded[0]
+        source = page.source if self.keep_image_source else None
+        self._execute("SELECT id, thumb FROM image WHERE hash = ?", (digest,))
+        row = self._fetchone()
+        if row:
+            if source is not None:
+                self._execute(
+                    "UPDATE image SET source = ? WHERE id = ? AND source IS NULL",
+                    (source, row[0]),
+                )
+            return row[0], self._bytes_to_pixbuf(row[1])
+
+        if encoded is None:
+            encoded = self._encode_page(page, digest)
+        _digest, blob, thumb, thumb_bytes = encoded
+        self._execute(
+            """INSERT INTO image (id, image, thumb, hash, source)
+               VALUES (NULL, ?, ?, ?, ?)""",
+            (blob, thumb_bytes, digest, source),
+        )
+        return self._cur[threading.get_native_id()].lastrowid, thumb
+
+    def _encode_page(self, page, digest=None):
+        """return the hash, blob, thumbnail and thumbnail blob of the page. Does
+        not touch the database, so can run in any thread"""
+        if digest is None:
+            digest = imagecodec.digest(page.image_object)
+        thumb = page.get_pixbuf_at_scale(self.heightt, self.widtht)
+        return (
+            digest,
+            page.to_bytes(self.image_codec, self.image_codec_level),
+            thumb,
+            self._pixbuf_to_bytes(thumb),
+        )
+
+    def _image_source(self, page):
+        "return the original compressed bitstream of the image of the page"
+        if page.image_id is None:
+            return None
+        self._execute("SELECT source FROM image WHERE id = ?", (page.image_id,))
+        row = self._fetchone()
+        return row[0] if row else None
+
+    def _hash_image(self, image_id):
+        "store the hash of an image inserted without one"
+        self._execute("SELECT image FROM image WHERE id = ?", (image_id,))
+        digest = imagecodec.digest(imagecodec.decode(self._fetchone()[0]))
+        self._execute("UPDATE image SET hash = ? WHERE id = ?", (digest, image_id))
 
     def _insert_page(self, page, image_id):
         "insert a page to the database"
@@ -258,19 +489,38 @@ class DocThread(SaveThread):
                 page.annotations,
             ),
         )
-        tid = threading.get_native_id()
-        self._con[tid].commit()
-        return self._cur[tid].lastrowid
-
-    def add_page(self, page, number=None):
-        "add a page to the database"
+        page_id = self._cur[threading.get_native_id()].lastrowid
+        self._commit()
+        return page_id
+
+    def _commit(self):
+        """commit, unless a bulk import is collecting pages to commit together
+        or the commit has been deferred"""
+        if self._bulk_pending is None and not self._deferring_commit:
+            self._con[threading.get_native_id()].commit()
+
+    @contextlib.contextmanager
+    def _deferred_commit(self):
+        "commit the changes made within the block once, at its end"
+        self._deferring_commit = True
+        try:
+            yield
+        finally:
+            self._deferring_commit = False
+            self._con[threading.get_native_id()].commit()
+
+    def add_page(self, page, number=None, encoded=None, snapshot=True):
+        """add a page to the database, by default as a new undo step. encoded
+        is the result of _encode_page(), if the page has already been encoded"""
         self._check_write_tid()
-        self._take_snapshot()
+        if snapshot and (self._bulk_pending is None or not self._bulk_snapshot):
+            self._take_snapshot()
+            self._bulk_snapshot = self._bulk_pending is not None
 
         if number is None:
             self._execute(
-                "SELECT MAX(page_number) FROM page_order WHERE action_id = ?",
-                (self._action_id,),
+                f"SELECT MAX(page_number) FROM page_order WHERE {VALID_AT}",
+                (self._action_id, self._action_id),
             )
             number = self._fetchone()[0]
             if number is None:
@@ -281,50 +531,88 @@ class DocThread(SaveThread):
         if self.find_row_id_by_page_number(number):
             raise ValueError(f"Page {number} already exists")
 
-        image_id, thumb = self._insert_image(page)
+        image_id, thumb = self._insert_image(page, encoded=encoded)
         page_id = self._insert_page(page, image_id)
         self._execute(
-            "SELECT MAX(row_id) FROM page_order WHERE action_id = ?",
-            (self._action_id,),
+            f"SELECT MAX(row_id) FROM page_order WHERE {VALID_AT}",
+            (self._action_id, self._action_id),
         )
         max_row_id = self._fetchone()[0]
         if max_row_id is None:
             max_row_id = -1
-        self._execute(
-            """INSERT INTO page_order (action_id, row_id, page_number, page_id)
-               VALUES (?, ?, ?, ?)""",
-            (
-                self._action_id,
-                max_row_id + 1,
-                number,
-                page_id,
-            ),
+        self._insert_rows([(max_row_id + 1, number, page_id)])
+        self._commit()
+        return number, thumb, page_id
+
+    @contextlib.contextmanager
+    def bulk_import(self):
+        """add the pages imported within the block as a single undo step,
+        committing at most every BULK_COMMIT_INTERVAL seconds. Each page is
+        encoded and its thumbnail made in the background whilst the next page
+        is extracted"""
+        self._check_write_tid()
+        self._bulk_pending = collections.deque()
+        self._bulk_rows = []
+        self._bulk_snapshot = False
+        self._bulk_committed = time.monotonic()
+        encoder = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._bulk_encoder = encoder
+        try:
+            yield
+            while self._bulk_pending:
+                self._write_imported_page(*self._bulk_pending.popleft())
+        finally:
+            encoder.shutdown(cancel_futures=True)
+            self._bulk_pending = None
+            self._commit_imported_pages()
+
+    def _add_imported_page(self, request, page):
+        "add an imported page, passing its row to the data callback"
+        if self._bulk_pending is None:
+            super()._add_imported_page(request, page)
+            return
+        self._bulk_pending.append(
+            (request, page, self._bulk_encoder.submit(self._encode_page, page))
         )
+        while len(self._bulk_pending) > 1:
+            self._write_imported_page(*self._bulk_pending.popleft())
+
+    def _write_imported_page(self, request, page, encoded):
+        "write an encoded page, committing if it is time to"
+        self._bulk_rows.append((request, self.add_page(page, encoded=encoded.result())))
+        if time.monotonic() - self._bulk_committed >= BULK_COMMIT_INTERVAL:
+            self._commit_imported_pages()
+
+    def _commit_imported_pages(self):
+        """commit the imported pages, and only then pass them to the data
+        callback, as the main thread reads them with its own connection"""
         self._con[threading.get_native_id()].commit()
-        return number, thumb, page_id
+        for request, row in self._bulk_rows:
+            request.data({"type": "page", "row": row})
+        self._bulk_rows = []
+        self._bulk_committed = time.monotonic()
 
-    def replace_page(self, page, number):
-        "replace a page in the database"
+    def replace_page(self, page, number, snapshot=True):
+        "replace a page in the database, by default as a new undo step"
         self._check_write_tid()
-        self._take_snapshot()
+        if snapshot:
+            self._take_snapshot()
 
         i = self.find_row_id_by_page_number(number)
         if i is None:
             raise ValueError(f"Page {number} does not exist")
 
-        image_id, thumb = self._insert_image(page, if_different_from=page.image_id)
-        page_id = self._insert_page(page, image_id)
         self._execute(
-            """UPDATE page_order SET page_number = ?, page_id = ?
-               WHERE row_id = ? AND action_id = ?""",
-            (
-                number,
-                page_id,
-                i,
-                self._action_id,
-            ),
+            f"SELECT page_id FROM page_order WHERE row_id = ? AND {VALID_AT}",
+            (i, self._action_id, self._action_id),
         )
-        self._con[threading.get_native_id()].commit()
+        old_page_id = self._fetchone()[0]
+        self.page_cache.invalidate([old_page_id])
+        image_id, thumb = self._insert_image(page, if_different_from=page.image_id)
+        page_id = self._insert_page(page, image_id)
+        self._end_rows([old_page_id])
+        self._insert_rows([(i, number, page_id)])
+        self._commit()
         return number, thumb, page_id
 
     # TODO: Commit a95296e93b392b35285d00bc633a9aa94c76995c fixed a bug
@@ -354,30 +642,26 @@ class DocThread(SaveThread):
 
         if row_ids:
             self._execute(
-                f"""DELETE FROM page_order
-                    WHERE row_id IN ({", ".join(["?"]*len(row_ids))}) AND action_id = ?""",
-                (*row_ids, self._action_id),
+                f"""SELECT page_id FROM page_order
+                    WHERE row_id IN ({", ".join(["?"]*len(row_ids))}) AND {VALID_AT}""",
+                (*row_ids, self._action_id, self._action_id),
             )
+            page_ids = [row[0] for row in self._fetchall()]
 
-        if page_ids:
-            self._execute(
-                f"""DELETE FROM page_order
-                    WHERE page_id IN ({", ".join(["?"]*len(page_ids))}) AND action_id = ?""",
-                (*page_ids, self._action_id),
-            )
+        self.page_cache.invalidate(page_ids)
+        self._end_rows(page_ids)
 
-        # renumber remaining rows
+        # renumber the remaining rows, writing only those that change
         self._execute(
-            "SELECT row_id, page_id, action_id FROM page_order WHERE action_id = ? ORDER BY row_id",
-            (self._action_id,),
-        )
-        page_order = self._fetchall()
-        for i, page in enumerate(page_order):
-            page_order[i] = [i, page[1], self._action_id]
-        self._executemany(
-            "UPDATE page_order SET row_id = ? WHERE page_id = ? AND action_id = ?",
-            page_order,
+            f"""SELECT row_id, page_number, page_id FROM page_order
+                WHERE {VALID_AT} ORDER BY row_id""",
+            (self._action_id, self._action_id),
         )
+        renumbered = [
+            (i, row[1], row[2]) for i, row in enumerate(self._fetchall()) if row[0] != i
+        ]
+        self._end_rows([row[2] for row in renumbered])
+        self._insert_rows(renumbered)
         self._con[threading.get_native_id()].commit()
 
         request.data(
@@ -390,8 +674,8 @@ class DocThread(SaveThread):
     def find_row_id_by_page_number(self, number):
         "find a row id by its page number"
         self._execute(
-            "SELECT row_id FROM page_order WHERE page_number = ? AND action_id = ?",
-            (number, self._action_id),
+            f"SELECT row_id FROM page_order WHERE page_number = ? AND {VALID_AT}",
+            (number, self._action_id, self._action_id),
         )
         row = self._fetchone()
         if row:
@@ -401,22 +685,25 @@ class DocThread(SaveThread):
     def find_page_number_by_page_id(self, page_id):
         "find a page id by its page number"
         self._execute(
-            "SELECT page_number FROM page_order WHERE page_id = ? AND action_id = ?",
-            (page_id, self._action_id),
+            f"SELECT page_number FROM page_order WHERE page_id = ? AND {VALID_AT}",
+            (page_id, self._action_id, self._action_id),
         )
         row = self._fetchone()
         if row:
             return row[0]
         return None
 
-    def page_number_table(self):
-        "get data for page number/thumb table"
+    def page_number_table(self, thumbnails=True):
+        """get data for page number/thumb table. Without thumbnails, the
+        thumbnail column is None, to be filled later with thumbnails()"""
+        if not thumbnails:
+            return self._page_numbers_and_ids()
         self._execute(
-            """SELECT page_number, thumb, page_id
+            f"""SELECT page_number, thumb, page_id
                FROM page_order, page, image
-               WHERE page_id = page.id AND image_id = image.id AND action_id = ?
+               WHERE page_id = page.id AND image_id = image.id AND {VALID_AT}
                ORDER BY page_number""",
-            (self._action_id,),
+            (self._action_id, self._action_id),
         )
         rows = []
         for row in self._fetchall():
@@ -427,24 +714,21 @@ class DocThread(SaveThread):
         "get a page from the database"
         if "number" in kwargs:
             self._execute(
-                """SELECT image, x_res, y_res, mean, std_dev, text, annotations, page.id, image.id
-                   FROM page, page_order, image
+                f"""SELECT x_res, y_res, mean, std_dev, text, annotations, page.id, image_id
+                   FROM page, page_order
                    WHERE page.id = page_id
-                    AND image_id = image.id
                     AND page_number = ?
-                    AND action_id = ?""",
-                (kwargs["number"], self._action_id),
+                    AND {VALID_AT}""",
+                (kwargs["number"], self._action_id, self._action_id),
             )
         elif "id" in kwargs:
             self._execute(
-                """SELECT
-                    image, x_res, y_res, mean, std_dev, text, annotations, page_number, image.id
-                   FROM page, page_order, image
+                f"""SELECT x_res, y_res, mean, std_dev, text, annotations, page.id, image_id
+                   FROM page, page_order
                    WHERE page.id = page_id
-                    AND image_id = image.id
                     AND page_id = ?
-                    AND action_id = ?""",
-                (kwargs["id"], self._action_id),
+                    AND {VALID_AT}""",
+                (kwargs["id"], self._action_id, self._action_id),
             )
         else:
             raise ValueError("Please specify either page number or page id")
@@ -453,15 +737,25 @@ class DocThread(SaveThread):
             if "number" in kwargs:
                 raise ValueError(f"Page number {kwargs['number']} not found")
             raise ValueError(f"Page id {kwargs['id']} not found")
-        return Page.from_bytes(
-            row[0],
-            id=row[7] if "number" in kwargs else kwargs["id"],
-            resolution=(row[1], row[2], "PixelsPerInch"),
-            mean=None if row[3] is None else json.loads(row[3], strict=False),
-            std_dev=None if row[4] is None else json.loads(row[4], strict=False),
-            text_layer=row[5],
-            annotations=row[6],
-            image_id=row[8],
+
+        # the image belonging to a page id never changes, so the cache only
+        # needs invalidating to free memory
+        page_id, image_id = row[6], row[7]
+        image = self.page_cache.get(page_id)
+        if image is None:
+            self._execute("SELECT image FROM image WHERE id = ?", (image_id,))
+            image = imagecodec.decode(self._fetchone()[0])
+            image.load()
+            self.page_cache.put(page_id, image.copy())
+        return Page.from_image(
+            image,
+            id=page_id,
+            resolution=(row[0], row[1], "PixelsPerInch"),
+            mean=None if row[2] is None else json.loads(row[2], strict=False),
+            std_dev=None if row[3] is None else json.loads(row[3], strict=False),
+            text_layer=row[4],
+            annotations=row[5],
+            image_id=image_id,
         )
 
     def do_clone_pages(self, request):
@@ -476,23 +770,9 @@ class DocThread(SaveThread):
                 WHERE id IN ({", ".join(["?"]*len(page_ids))})""",
             (*page_ids,),
         )
+        # the clones share the images of the originals
         pages = self._fetchall()
-        image_ids = [page[0] for page in pages]
-        self._execute(
-            f"SELECT image, thumb FROM image WHERE id IN ({', '.join(['?']*len(image_ids))})",
-            (*image_ids,),
-        )
-        images = self._fetchall()
-        self._executemany(
-            "INSERT INTO image (id, image, thumb) VALUES (NULL, ?, ?)",
-            images,
-        )
         tid = threading.get_native_id()
-        self._execute("SELECT last_insert_rowid()")
-        first_image_id = self._fetchone()[0] - len(pages) + 1
-        for i, page in enumerate(pages):
-            pages[i] = list(pages[i])
-            pages[i][0] = first_image_id + i  # new image id
         self._executemany(
             """INSERT INTO page (
                 id, image_id, x_res, y_res, mean, std_dev, saved, text, annotations)
@@ -501,70 +781,35 @@ class DocThread(SaveThread):
         )
         self._execute("SELECT last_insert_rowid()")
         first_page_id = self._fetchone()[0] - len(pages) + 1
+        # make room for the cloned pages by shifting the rows after dest
         self._execute(
-            "SELECT MAX(row_id) FROM page_order WHERE action_id = ?",
-            (self._action_id,),
+            f"""SELECT row_id, page_number, page_id FROM page_order
+                WHERE row_id >= ? AND {VALID_AT}""",
+            (dest, self._action_id, self._action_id),
         )
-        max_row_id = self._fetchone()[0]
-
-        # if we are not adding the cloned pages to the end, renumber the rows after dest
-        if dest <= max_row_id:
-            self._execute(
-                "SELECT row_id, page_number, page_id, action_id FROM page_order WHERE action_id = ? AND row_id >= ? ORDER BY row_id",
-                (self._action_id, dest),
-            )
-            page_order = self._fetchall()
-            for i, page in enumerate(page_order):
-                page_order[i] = (
-                    page[0] + len(pages),
-                    page[1] + len(pages),
-                    page[2],
-                    self._action_id,
-                )
-            self._execute(
-                "SELECT row_id, page_number, page_id from page_order WHERE action_id = ?",
-                (self._action_id,),
-            )
-            for page in reversed(
-                page_order
-            ):  # reverse list to prevent numbering conflicts during execution
-                self._execute(
-                    "UPDATE page_order SET row_id = ?, page_number = ? WHERE page_id = ? AND action_id = ?",
-                    page,
-                )
-            self._execute(
-                "SELECT row_id, page_number, page_id from page_order WHERE action_id = ?",
-                (self._action_id,),
-            )
-            self._con[tid].commit()
-
-        new_pages = [
-            (self._action_id, dest + i, dest + i + 1, first_page_id + i)
-            for i in range(len(pages))
+        shifted = [
+            (row[0] + len(pages), row[1] + len(pages), row[2])
+            for row in self._fetchall()
         ]
-        self._execute(
-            "SELECT row_id, page_number, page_id from page_order WHERE action_id = ?",
-            (self._action_id,),
-        )
-        self._executemany(
-            """INSERT INTO page_order (action_id, row_id, page_number, page_id)
-               VALUES (?, ?, ?, ?)""",
-            new_pages,
+        self._end_rows([row[2] for row in shifted])
+        self._insert_rows(shifted)
+        new_page_ids = [first_page_id + i for i in range(len(pages))]
+        self._insert_rows(
+            [
+                (dest + i, dest + i + 1, page_id)
+                for i, page_id in enumerate(new_page_ids)
+            ]
         )
         self._con[tid].commit()
-        self._execute(
-            "SELECT row_id, page_number, page_id from page_order WHERE action_id = ?",
-            (self._action_id,),
-        )
 
         self._execute(
             f"""SELECT page_number, thumb, page_id
                           FROM page_order, page, image
-                          WHERE action_id = ?
+                          WHERE {VALID_AT}
                            AND page_id = page.id
                            AND image_id = image.id
-                           AND page_id IN ({", ".join(["?"]*len(new_pages))})""",
-            (self._action_id, *[row[3] for row in new_pages]),
+                           AND page_id IN ({", ".join(["?"]*len(new_page_ids))})""",
+            (self._action_id, self._action_id, *new_page_ids),
         )
         rows = []
         for row in self._fetchall():
@@ -579,20 +824,17 @@ class DocThread(SaveThread):
         self._check_write_tid()
 
         # in case the user has undone one or more actions, before taking a
-        # snapshot, remove the redo steps
+        # snapshot, remove the redo steps, reopening the rows they ended
         self._execute("DELETE FROM page_order WHERE action_id > ?", (self._action_id,))
-        self._execute("DELETE FROM selection WHERE action_id > ?", (self._action_id,))
-
-        # copy page numbers and order to buffer
         self._execute(
-            """SELECT row_id, page_number, page_id
-                FROM page_order
-                WHERE action_id = ?""",
-            (self._action_id,),
+            """UPDATE page_order SET end_action_id = ?
+                WHERE end_action_id > ? AND end_action_id < ?""",
+            (OPEN_ENDED, self._action_id, OPEN_ENDED),
         )
-        snapshot = self._fetchall()
+        self._execute("DELETE FROM selection WHERE action_id > ?", (self._action_id,))
 
-        # Copy selection to buffer
+        # The page order is unchanged until the action writes the rows it
+        # changes with _end_rows() and _insert_rows(). Copy selection to buffer
         self._execute(
             "SELECT row_ids FROM selection WHERE action_id = ?",
             (self._action_id,),
@@ -601,12 +843,6 @@ class DocThread(SaveThread):
         row_ids = selection_row[0] if selection_row else "[]"
 
         self._action_id += 1
-        snapshot = [(self._action_id, *row) for row in snapshot]
-        self._executemany(
-            """INSERT INTO page_order (action_id, row_id, page_number, page_id)
-               VALUES (?, ?, ?, ?)""",
-            snapshot,
-        )
 
         # Insert selection for new action_id
         self._execute(
@@ -614,24 +850,131 @@ class DocThread(SaveThread):
             (self._action_id, row_ids),
         )
 
-        # TODO: implement set number_undo_steps depending on available disk space
-        # TODO: after deleting from selection, page_order, also delete rows in
-        # page & image that are no longer referenced.
-        # delete those outside the undo limit
-        # self._execute(
-        #     "DELETE FROM page_order WHERE action_id < ?",
-        #     (self._action_id - self.number_undo_steps,),
-        # )
+        # delete those outside the undo limit. The page and image rows that
+        # are no longer referenced are deleted by _collect_garbage() between
+        # requests.
+        if self.undo_steps is not None:
+            self._delete_actions_before(self._action_id - self.undo_steps)
         self._con[threading.get_native_id()].commit()
+        self._gc_pending = True
+
+    def _insert_rows(self, rows):
+        "insert the given (row_id, page_number, page_id) at the current action"
+        for row in rows:
+            self._execute(
+                """INSERT INTO page_order
+                    (row_id, page_number, page_id, action_id, end_action_id)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (*row, self._action_id, OPEN_ENDED),
+            )
 
-    def _get_snapshot(self):
+    def _end_rows(self, page_ids):
+        """remove the rows with the given page ids from the current action,
+        keeping them for the undo steps before it"""
+        for page_id in page_ids:
+            # rows inserted by the current action are not needed to undo it
+            self._execute(
+                """DELETE FROM page_order
+                    WHERE page_id = ? AND action_id = ? AND end_action_id = ?""",
+                (page_id, self._action_id, OPEN_ENDED),
+            )
+            self._execute(
+                """UPDATE page_order SET end_action_id = ?
+                    WHERE page_id = ? AND end_action_id = ?""",
+                (self._action_id, page_id, OPEN_ENDED),
+            )
+
+    def _delete_actions_before(self, action_id):
+        "delete the undo steps before the given action id"
+        self._execute("DELETE FROM page_order WHERE end_action_id <= ?", (action_id,))
+        self._execute("DELETE FROM selection WHERE action_id < ?", (action_id,))
+
+    def _collect_garbage(self):
+        """run one step of the garbage collection, deleting a batch of
+        unreferenced page or image rows, pruning the oldest undo step if the
+        database is over budget, or returning free space to the filesystem.
+        Returns False when there is nothing left to do.
+
+        Images shared by several pages are not reference counted. The page
+        rows of the undo history also refer to them, so a count would have to
+        follow every snapshot and pruned undo step. Instead, this sweep deletes
+        an image once no page row refers to it"""
+        self._check_write_tid()
+        if not self._indexed:
+            self._create_indexes()
+            return True
+        self._execute(
+            """SELECT id FROM page
+                WHERE id NOT IN (SELECT page_id FROM page_order) LIMIT ?""",
+            (GC_BATCH,),
+        )
+        page_ids = [row[0] for row in self._fetchall()]
+        if page_ids:
+            self._execute(
+                f"DELETE FROM page WHERE id IN ({', '.join(['?']*len(page_ids))})",
+                page_ids,
+            )
+            self._con[threading.get_native_id()].commit()
+            self.page_cache.invalidate(page_ids)
+            return True
+
+        self._execute(
+            """DELETE FROM image WHERE id IN (
+                SELECT id FROM image
+                WHERE id NOT IN (SELECT image_id FROM page) LIMIT ?)""",
+            (GC_BATCH,),
+        )
+        if self._cur[threading.get_native_id()].rowcount > 0:
+            self._con[threading.get_native_id()].commit()
+            return True
+
+        if self.undo_disk_budget is not None and self._used_bytes() > (
+            self.undo_disk_budget * 1024 * 1024
+        ):
+            self._execute("SELECT MIN(action_id) FROM selection")
+            oldest = self._fetchone()[0]
+            if oldest is not None and oldest < self._action_id:
+                logger.info("Session over disk budget, dropping undo step %s", oldest)
+                self._delete_actions_before(oldest + 1)
+                self._con[threading.get_native_id()].commit()
+                return True
+
+        self._execute("PRAGMA auto_vacuum")
+        if self._fetchone()[0] == 2:  # INCREMENTAL
+            self._execute("PRAGMA freelist_count")
+            if self._fetchone()[0] > 0:
+                self._execute(f"PRAGMA incremental_vacuum({GC_VACUUM_PAGES})")
+                self._fetchall()
+                return True
+        return False
+
+    def _used_bytes(self):
+        "return the size of the database, excluding free pages"
+        self._execute("PRAGMA page_size")
+        page_size = self._fetchone()[0]
+        self._execute("PRAGMA page_count")
+        page_count = self._fetchone()[0]
+        self._execute("PRAGMA freelist_count")
+        return (page_count - self._fetchone()[0]) * page_size
+
+    def do_set_undo_limit(self, request):
+        "set the maximum number of undo steps and the disk budget in MB"
+        self.undo_steps, self.undo_disk_budget = request.args
+        if self.undo_steps is not None:
+            self._delete_actions_before(self._action_id - self.undo_steps)
+            self._con[threading.get_native_id()].commit()
+        self._gc_pending = True
+
+    def _get_snapshot(self, thumbnails=True):
         "fetch the snapshot of the document with the given action id"
+        if not thumbnails:
+            return self._page_numbers_and_ids()
         self._execute(
-            """SELECT page_number, thumb, page_id
+            f"""SELECT page_number, thumb, page_id
                 FROM page_order, page, image
-                WHERE action_id = ? AND page_id = page.id AND image_id = image.id
+                WHERE {VALID_AT} AND page_id = page.id AND image_id = image.id
                 ORDER BY page_number""",
-            (self._action_id,),
+            (self._action_id, self._action_id),
         )
         rows = []
         for row in self._fetchall():
@@ -640,6 +983,37 @@ class DocThread(SaveThread):
             rows.append(row)
         return rows
 
+    def _page_numbers_and_ids(self):
+        "get the page numbers and ids, without the thumbnails"
+        self._execute(
+            f"""SELECT page_number, page_id
+                FROM page_order
+                WHERE {VALID_AT}
+                ORDER BY page_number""",
+            (self._action_id, self._action_id),
+        )
+        return [[row[0], None, row[1]] for row in self._fetchall()]
+
+    def thumbnails(self, page_ids, **kwargs):
+        """fetch the thumbnails of the given pages, returning them together via
+        data_callback"""
+        callbacks = _note_callbacks(kwargs)
+        return self.send("thumbnails", page_ids, **callbacks)
+
+    def do_thumbnails(self, request):
+        "fetch the thumbnails of the given pages as a dict keyed by page id"
+        thumbs = {}
+        for page_id in request.args[0]:
+            self._execute(
+                """SELECT thumb FROM page, image
+                    WHERE image_id = image.id AND page.id = ?""",
+                (page_id,),
+            )
+            row = self._fetchone()
+            if row:
+                thumbs[page_id] = self._bytes_to_pixbuf(row[0])
+        request.data({"type": "thumbnails", "thumbs": thumbs})
+
     def _pixbuf_to_bytes(self, pixbuf):
         "given a pixbuf, return the equivalent bytes, in order to store them as a blob"
         if pixbuf is None:
@@ -649,47 +1023,48 @@ class DocThread(SaveThread):
 
     def _bytes_to_pixbuf(self, blob):
         "given a stream of bytes, return the equivalent pixbuf"
-        with tempfile.NamedTemporaryFile(dir=self._dir, suffix=".png") as temp:
-            temp.write(blob)
-            temp.flush()
-            return GdkPixbuf.Pixbuf.new_from_file(temp.name)
+        return bytes_to_pixbuf(blob)
 
     def can_undo(self):
         "checks whether undo is possible"
-        self._execute("SELECT min(action_id) FROM page_order")
-        min_page = self._fetchone()[0]
+        # every action has a selection row, whereas page_order only has rows
+        # for the actions that changed it
         self._execute("SELECT min(action_id) FROM selection")
-        min_sel = self._fetchone()[0]
-        # min_action_id = min(filter(None, [min_page, min_sel])) if any([min_page, min_sel]) else None
-        # Simpler:
-        ids = [x for x in [min_page, min_sel] if x is not None]
-        min_action_id = min(ids) if ids else None
-        return min_action_id is not None and min_action_id <= self._action_id
+        min_action_id = self._fetchone()[0]
+        if min_action_id is None:
+            return False
+        # the state before the first snapshot is the empty document, which is
+        # not stored, and is only reachable if the early steps were not pruned
+        if min_action_id > 1:
+            return min_action_id < self._action_id
+        return min_action_id <= self._action_id
 
     def can_redo(self):
         "checks whether redo is possible"
-        self._execute("SELECT max(action_id) FROM page_order")
-        max_page = self._fetchone()[0]
         self._execute("SELECT max(action_id) FROM selection")
-        max_sel = self._fetchone()[0]
-        ids = [x for x in [max_page, max_sel] if x is not None]
-        max_action_id = max(ids) if ids else None
+        max_action_id = self._fetchone()[0]
         return max_action_id is not None and max_action_id > self._action_id
 
-    def undo(self):
+    def undo(self, thumbnails=True):
         "restore the state of the last snapshot"
         if not self.can_undo():
             raise StopIteration("No more undo steps possible")
 
         self._action_id -= 1
-        return self._get_snapshot()
+        return self._restore_snapshot(thumbnails)
 
-    def redo(self):
+    def redo(self, thumbnails=True):
         "restore the state of the last snapshot"
         if not self.can_redo():
             raise StopIteration("No more redo steps possible")
         self._action_id += 1
-        return self._get_snapshot()
+        return self._restore_snapshot(thumbnails)
+
+    def _restore_snapshot(self, thumbnails=True):
+        "fetch the current snapshot, dropping cached pages not in it"
+        rows = self._get_snapshot(thumbnails)
+        self.page_cache.retain([row[2] for row in rows])
+        return rows
 
     def get_selection(self):
         "get the selected row ids for the current action_id"
@@ -733,10 +1108,10 @@ class DocThread(SaveThread):
     def pages_saved(self):
         "Check that all pages have been saved"
         self._execute(
-            """SELECT COUNT(id)
+            f"""SELECT COUNT(id)
                 FROM page_order, page
-                WHERE saved = 0 and page_id = id AND action_id = ?""",
-            (self._action_id,),
+                WHERE saved = 0 and page_id = id AND {VALID_AT}""",
+            (self._action_id, self._action_id),
         )
         return self._fetchone()[0] == 0
 
@@ -838,26 +1213,8 @@ class DocThread(SaveThread):
         options = request.args[0]
         page = self.get_page(id=options["page"])
         logger.info("Rotating %s by %s degrees", page.id, options["angle"])
-        page.image_object = page.image_object.rotate(options["angle"], expand=True)
-        self.check_cancelled()
-
-        page.dirty_time = datetime.datetime.now()  # flag as dirty
-        page.saved = False
-        if options["angle"] in (-90, 90):
-            page.width, page.height = page.height, page.width
-            page.resolution = (
-                page.resolution[1],
-                page.resolution[0],
-                page.resolution[2],
-            )
-        request.data(
-            {
-                "type": "page",
-                "row": self.replace_page(
-                    page, self.find_page_number_by_page_id(page.id)
-                ),
-                "replace": page.id,
-            }
+        self._update_page(
+            request, page, imageops.rotate(page.image_object, options["angle"])
         )
 
     def analyse(self, **kwargs):
@@ -870,25 +1227,16 @@ class DocThread(SaveThread):
         options = request.args[0]
         list_of_pages = options["list_of_pages"]
 
-        i = 1
         total = len(list_of_pages)
-        for page_id in list_of_pages:
-            page = self.get_page(id=page_id)
+        for i, (page, (mean, std_dev)) in enumerate(
+            self._map_pages(list_of_pages, imageops.analyse), start=1
+        ):
             self.progress = (i - 1) / total
             self.message = _("Analysing page %i of %i") % (i, total)
-            i += 1
             self.check_cancelled()
 
-            stat = ImageStat.Stat(page.image_object)
-            # ImageStat seems to have a bug here. Working around it.
-            if stat.count == [0]:
-                page.mean = [0.0]
-                page.std_dev = [0.0]
-            else:
-                page.mean = stat.mean
-                page.std_dev = stat.stddev
+            page.mean, page.std_dev = mean, std_dev
             logger.info("std dev: %s mean: %s", page.std_dev, page.mean)
-            self.check_cancelled()
 
             # TODO add any other useful image analysis here e.g. is the page mis-oriented?
             #  detect mis-orientation possible algorithm:
@@ -918,27 +1266,8 @@ class DocThread(SaveThread):
         self.check_cancelled()
 
         logger.info("Threshold %s with %s", page.id, options["threshold"])
-
-        # To grayscale
-        page.image_object = page.image_object.convert("L")
-        # Threshold
-        page.image_object = page.image_object.point(
-            lambda p: 255 if p > options["threshold"] else 0
-        )
-        # To mono
-        page.image_object = page.image_object.convert("1")
-        self.check_cancelled()
-
-        page.dirty_time = datetime.datetime.now()  # flag as dirty
-        page.saved = False
-        request.data(
-            {
-                "type": "page",
-                "row": self.replace_page(
-                    page, self.find_page_number_by_page_id(page.id)
-                ),
-                "replace": page.id,
-            }
+        self._update_page(
+            request, page, imageops.threshold(page.image_object, options["threshold"])
         )
 
     def brightness_contrast(self, **kwargs):
@@ -958,23 +1287,10 @@ class DocThread(SaveThread):
             contrast,
         )
         self.check_cancelled()
-
-        page.image_object = ImageEnhance.Brightness(page.image_object).enhance(
-            brightness
-        )
-        page.image_object = ImageEnhance.Contrast(page.image_object).enhance(contrast)
-        self.check_cancelled()
-
-        page.dirty_time = datetime.datetime.now()  # flag as dirty
-        page.saved = False
-        request.data(
-            {
-                "type": "page",
-                "row": self.replace_page(
-                    page, self.find_page_number_by_page_id(page.id)
-                ),
-                "replace": page.id,
-            }
+        self._update_page(
+            request,
+            page,
+            imageops.brightness_contrast(page.image_object, brightness, contrast),
         )
 
     def negate(self, **kwargs):
@@ -988,22 +1304,7 @@ class DocThread(SaveThread):
         page = self.get_page(id=options["page"])
 
         logger.info("Invert %s", page.id)
-        if page.image_object.mode == "P" or page.image_object.mode == "RGBA":
-            page.image_object = page.image_object.convert("RGB")
-        page.image_object = ImageOps.invert(page.image_object)
-        self.check_cancelled()
-
-        page.dirty_time = datetime.datetime.now()  # flag as dirty
-        page.saved = False
-        request.data(
-            {
-                "type": "page",
-                "row": self.replace_page(
-                    page, self.find_page_number_by_page_id(page.id)
-                ),
-                "replace": page.id,
-            }
-        )
+        self._update_page(request, page, imageops.negate(page.image_object))
 
     def unsharp(self, **kwargs):
         "run unsharp mask"
@@ -1025,21 +1326,10 @@ class DocThread(SaveThread):
             percent,
             threshold,
         )
-        page.image_object = page.image_object.filter(
-            ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=threshold)
-        )
-        self.check_cancelled()
-
-        page.dirty_time = datetime.datetime.now()  # flag as dirty
-        page.saved = False
-        request.data(
-            {
-                "type": "page",
-                "row": self.replace_page(
-                    page, self.find_page_number_by_page_id(page.id)
-                ),
-                "replace": page.id,
-            }
+        self._update_page(
+            request,
+            page,
+            imageops.unsharp(page.image_object, radius, percent, threshold),
         )
 
     def crop(self, **kwargs):
@@ -1057,19 +1347,16 @@ class DocThread(SaveThread):
         height = options["h"]
 
         logger.info("Crop %s x %s y %s w %s h %s", page.id, left, top, width, height)
-
-        page.image_object = page.image_object.crop(
-            (left, top, left + width, top + height)
+        self._update_page(
+            request, page, imageops.crop(page.image_object, left, top, width, height)
         )
-        self.check_cancelled()
-
-        page.width = page.image_object.width
-        page.height = page.image_object.height
-
-        if page.text_layer is not None:
-            bboxtree = Bboxtree(page.text_layer)
-            page.text_layer = bboxtree.crop(left, top, width, height).json()
 
+    def _update_page(self, request, page, image):
+        """store the result of one of the image operations, replacing the
+        original page"""
+        page.image_object = image
+        self.check_cancelled()
+        _update_page_metadata(page, request.process, request.args[0])
         page.dirty_time = datetime.datetime.now()  # flag as dirty
         page.saved = False
         request.data(
@@ -1082,6 +1369,204 @@ class DocThread(SaveThread):
             }
         )
 
+    def apply_chain(self, **kwargs):
+        "apply a chain of image operations to pages"
+        callbacks = _note_callbacks(kwargs)
+        return self.send("apply_chain", kwargs, **callbacks)
+
+    def do_apply_chain(self, request):
+        """apply a chain of image operations, a list of (process, options)
+        pairs, to each page, decoding and storing it once. The pages are
+        replaced as a single undo step"""
+        options = request.args[0]
+        for process, _options in options["steps"]:
+            if process not in imageops.OPERATIONS:
+                raise ValueError(_("Unknown image operation '%s'") % process)
+        steps = imageops.chain_args(options["steps"])
+        pages = options["pages"]
+        logger.info("Applying %s to %s pages", options["steps"], len(pages))
+
+        self._take_snapshot()
+        rows = []
+        try:
+            with self._deferred_commit():
+                for i, (page, image) in enumerate(
+                    self._map_pages(pages, imageops.chain, steps), start=1
+                ):
+                    self.check_cancelled()
+                    page.image_object = image
+                    for process, step_options in options["steps"]:
+                        _update_page_metadata(page, process, step_options)
+                    page.dirty_time = datetime.datetime.now()  # flag as dirty
+                    page.saved = False
+                    number = self.find_page_number_by_page_id(page.id)
+                    self.progress = i / len(pages)
+                    self.message = _("Processing page %i of %i") % (i, len(pages))
+                    row = self.replace_page(page, number, snapshot=False)
+                    rows.append((row, page.id, self.progress, self.message))
+        finally:
+            # only pass the pages to the data callback once they are
+            # committed, as the main thread reads them with its own connection
+            for row, page_id, progress, message in rows:
+                request.data(
+                    {
+                        "type": "page",
+                        "row": row,
+                        "replace": page_id,
+                        "progress": progress,
+                        "message": message,
+                    }
+                )
+
+    def do_set_image_codec(self, request):
+        "set the codec and compression level used to store images"
+        codec, level = request.args
+        if codec not in imagecodec.available_codecs():
+            logger.warning("Image codec '%s' not available, using PNG", codec)
+            codec, level = "png", None
+        self.image_codec, self.image_codec_level = codec, level
+
+    def do_set_keep_image_source(self, request):
+        "set whether to store the original compressed bitstream of imported images"
+        self.keep_image_source = request.args[0]
+
+    def do_set_page_cache_size(self, request):
+        "set the memory budget in MB for decoded pages"
+        self.page_cache_size = request.args[0]
+        self.page_cache.resize(self.page_cache_size * 1024 * 1024)
+
+    def do_set_processes(self, request):
+        "set the number of worker processes used for image operations and OCR"
+        processes = request.args[0] or os.cpu_count() or 1
+        if processes != self.processes and self._pool is not None:
+            self._drain_pooled()
+            self._pool.shutdown()
+            self._pool = None
+        self.processes = processes
+        self._engines.maxidle = processes
+
+    def _get_pool(self):
+        "start the process pool on demand"
+        if self._pool is None:
+            logger.info("Starting pool of %s processes", self.processes)
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes,
+                # don't inherit the GTK state of this process
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def _map_pages(self, page_ids, func, *args):
+        """generator applying func to the image of each page, yielding the
+        page and result in order. Uses the process pool if there is more than
+        one page, whilst reading and writing the database only in this thread"""
+        if self.processes < 2 or len(page_ids) < 2:
+            for page_id in page_ids:
+                page = self.get_page(id=page_id)
+                yield page, func(page.image_object, *args)
+            return
+
+        pool = self._get_pool()
+        pending = collections.deque()
+        try:
+            for page_id in page_ids:
+                if len(pending) >= self.processes:
+                    page, future = pending.popleft()
+                    yield page, future.result()
+                self.check_cancelled()
+                page = self.get_page(id=page_id)
+                pending.append((page, pool.submit(func, page.image_object, *args)))
+            while pending:
+                page, future = pending.popleft()
+                yield page, future.result()
+        finally:
+            for _page, future in pending:
+                future.cancel()
+
+    def handler_wrapper(self, request, handler):
+        """hand the pixel work of image operations to the process pool if
+        there are further requests waiting, unless a bulk request is waiting
+        for them. Anything else has to wait until the pooled requests have been
+        written back"""
+        if (
+            request.process in imageops.OPERATIONS
+            and not self._yielding
+            and self.processes > 1
+            and (self._pooled or not self.requests.empty())
+        ):
+            self._submit_pooled(request)
+            return True
+        self._drain_pooled()
+        return super().handler_wrapper(request, handler)
+
+    def next_request(self):
+        """write back the pooled requests and collect garbage whilst waiting
+        for the next request"""
+        while self._pooled or self._gc_pending:
+            while self._pooled and self._pooled[0][2].done():
+                self._complete_pooled()
+            try:
+                if self._pooled:
+                    return self.requests.get(timeout=POOL_POLL_INTERVAL)
+                return self.requests.get(block=False)
+            except queue.Empty:
+                pass
+            if self._gc_pending and not self._pooled:
+                try:
+                    self._gc_pending = self._collect_garbage()
+                except (sqlite3.Error, RuntimeError) as err:
+                    logger.error("Error collecting garbage: %s", err)
+                    self._gc_pending = False
+        return super().next_request()
+
+    def _submit_pooled(self, request):
+        "read the page and submit the pixel work for the request to the pool"
+        options = request.args[0]
+        if any(options["page"] == item[0].args[0]["page"] for item in self._pooled):
+            # a second operation on the same page must see the result of the first
+            self._drain_pooled()
+        while len(self._pooled) >= self.processes:
+            self._complete_pooled()
+        page, future = None, concurrent.futures.Future()
+        try:
+            page = self.get_page(id=options["page"])
+            logger.info("Submitting %s of page %s to pool", request.process, page.id)
+            func, args = imageops.operation_args(request.process, options)
+            future = self._get_pool().submit(func, page.image_object, *args)
+        except Exception as err:  # pylint: disable=broad-except
+            future.set_exception(err)
+        self._pooled.append((request, page, future))
+
+    def _complete_pooled(self):
+        "write back the result of the oldest pooled request"
+        request, page, future = self._pooled.popleft()
+
+        def handler(request):
+            if self.cancel:
+                future.cancel()
+            self.check_cancelled()
+            try:
+                image = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                self._pool = None
+                raise
+            self._update_page(request, page, image)
+
+        super().handler_wrapper(request, handler)
+
+    def _drain_pooled(self):
+        "write back all pooled requests"
+        while self._pooled:
+            self._complete_pooled()
+
+    def do_quit(self, _request):
+        "shut down the process pool"
+        logger.info("Page cache: %s", self.page_cache.cache_info())
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        self._engines.close()
+
     def split_page(self, **kwargs):
         "split page"
         callbacks = _note_callbacks(kwargs)
@@ -1149,13 +1634,10 @@ class DocThread(SaveThread):
         callbacks = _note_callbacks(kwargs)
         return self.send("tesseract", kwargs, **callbacks)
 
-    def do_tesseract(self, request):
-        "run tesseract in thread"
-        options = request.args[0]
-        page = self.get_page(id=options["page"])
-        if options["language"] is None:
-            raise ValueError(_("No tesseract language specified"))
-        self.check_cancelled()
+    def _tessdata_path(self, request):
+        "return the tessdata directory, probing for it the first time"
+        if self._tessdata is not None:
+            return self._tessdata
 
         # path argument required for systems where tessdata non-standard or not hardcoded;
         # otherwise current directory is searched for tesseract files
@@ -1181,24 +1663,51 @@ class DocThread(SaveThread):
                 request.error(_("tessdata directory not found"))
             else:
                 path = paths[0]
-        with tesserocr.PyTessBaseAPI(lang=options["language"], path=path) as api:
-            output = "image_out"
-            api.SetVariable("tessedit_create_hocr", "T")
-            api.SetVariable("hocr_font_info", "T")
-            with tempfile.NamedTemporaryFile(dir=options["dir"], suffix=".png") as file:
-                page.image_object.save(file.name)
-                _pp = api.ProcessPages(output, file.name)
-
-            # Unnecessary filesystem write/read
-            path_hocr = pathlib.Path(output).with_suffix(".hocr")
-            hocr = path_hocr.read_text(encoding="utf-8")
-            path_hocr.unlink()
-
-            page.import_hocr(hocr)
-            page.ocr_flag = True
-            page.ocr_time = datetime.datetime.now()
+        self._tessdata = path
+        return path
+
+    def do_tesseract(self, request):
+        """run tesseract in thread. Given a list of pages, they are recognised
+        concurrently, as tesserocr releases the GIL, but read and written back
+        in order, and only from this thread"""
+        options = request.args[0]
+        pages = options["pages"] if "pages" in options else [options["page"]]
+        if options["language"] is None:
+            raise ValueError(_("No tesseract language specified"))
         self.check_cancelled()
+        path = self._tessdata_path(request)
+
+        # recognition is CPU bound, so more threads than cores would not help
+        self.progress = 0
+        self._map_in_threads(
+            (
+                (self.get_page(id=page_id), options["language"], path)
+                for page_id in pages
+            ),
+            self._recognise,
+            functools.partial(self._write_ocr_result, request, len(pages)),
+            min(self.processes, os.cpu_count() or 1),
+        )
 
+    def _recognise(self, page, language, path):
+        "return the hOCR for the page, run in a worker thread"
+        self.check_cancelled()
+        with self._engines.engine(language, path) as api:
+            if isinstance(page.resolution, tuple) and page.resolution[0]:
+                api.SetSourceResolution(round(page.resolution[0]))
+            api.SetImage(page.image_object)
+            return api.GetHOCRText(0)
+
+    def _write_ocr_result(self, request, npages, done, args, hocr):
+        "write back the hOCR of a page that has been recognised"
+        # interactive requests may have changed the page whilst it was queued
+        page = self.get_page(id=args[0].id)
+        page.import_hocr(hocr_document(hocr))
+        page.ocr_flag = True
+        page.ocr_time = datetime.datetime.now()
+        self.check_cancelled()
+        self.progress = done / npages
+        self.message = _("OCR page %i of %i") % (done, npages)
         request.data(
             {
                 "type": "page",
@@ -1206,6 +1715,8 @@ class DocThread(SaveThread):
                     page, self.find_page_number_by_page_id(page.id)
                 ),
                 "replace": page.id,
+                "progress": self.progress,
+                "message": self.message,
             }
         )
 
@@ -1214,122 +1725,112 @@ class DocThread(SaveThread):
         callbacks = _note_callbacks(kwargs)
         return self.send("unpaper", kwargs, **callbacks)
 
-    def _run_unpaper_cmd(self, request):
-        options = request.args[0]
-        out = tempfile.NamedTemporaryFile(dir=options.get("dir"), suffix=".pnm")
-        out2 = None
-        options["options"]["command"][-2] = out.name
-
-        index = options["options"]["command"].index("--output-pages")
-        if options["options"]["command"][index + 1] == "2":
-            out2 = tempfile.NamedTemporaryFile(dir=options.get("dir"), suffix=".pnm")
-            options["options"]["command"][-1] = out2.name
-        else:
-            del options["options"]["command"][-1]
-
-        spo = subprocess.run(
-            options["options"]["command"],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-        logger.info(spo.stdout)
-        if spo.stderr:
-            logger.error(spo.stderr)
-            request.data(spo.stderr)
-            if not os.path.getsize(out.name):
-                raise subprocess.CalledProcessError(
-                    spo.returncode, options["options"]["command"]
-                )
-
-        self.check_cancelled()
-        spo.stdout = re.sub(
-            r"Processing[ ]sheet.*[.]pnm\n",
-            r"",
-            spo.stdout,
-            count=1,
-            flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-        )
-        if spo.stdout:
-            logger.warning(spo.stdout)
-            request.data(spo.stdout)
-            if not os.path.getsize(out.name):
-                raise subprocess.CalledProcessError(
-                    spo.returncode, options["options"]["command"]
-                )
-
+    def _run_unpaper_cmd(self, options, image, pipes=False):
+        """run unpaper on the image, returning the output images in reading
+        order and any messages. Neither options nor the database are touched,
+        so that it can run in several threads at once"""
+        command = options["options"]["command"]
         if (
-            options["options"]["command"][index + 1] == "2"
-            and options["options"].get("direction") == "rtl"
+            "--output-pages" in command
+            and command[command.index("--output-pages") + 1] == "2"
         ):
-            out, out2 = out2, out
-        return out, out2
+            images, messages = _unpaper_via_files(command, image, 2, options.get("dir"))
+            if options["options"].get("direction") == "rtl":
+                images.reverse()
+        elif pipes:
+            images, messages = _unpaper_via_pipes(command, image)
+        else:
+            images, messages = _unpaper_via_files(command, image, 1, options.get("dir"))
+        return images, messages
+
+    def _unpaper_can_pipe(self):
+        "return whether the installed unpaper can read stdin and write stdout"
+        if self._unpaper_pipes is None:
+            command = ["unpaper", "--output-pages", "1"]
+            for option in UNPAPER_NO_PROCESSING:
+                command.append("--" + option)
+            try:
+                _unpaper_via_pipes(
+                    command + ["--overwrite", "%s", "%s", "%s"],
+                    Image.new("1", (32, 32), 1),
+                )
+                self._unpaper_pipes = True
+            except (OSError, subprocess.CalledProcessError, UnidentifiedImageError):
+                self._unpaper_pipes = False
+            logger.info("unpaper can use pipes: %s", self._unpaper_pipes)
+        return self._unpaper_pipes
 
     def do_unpaper(self, request):
-        "run unpaper in thread"
+        """run unpaper in thread. Given a list of pages, several unpaper
+        processes are run at once, but the pages are read and written back in
+        order, and only from this thread"""
         options = request.args[0]
-        page = self.get_page(id=options["page"])
+        pages = options["pages"] if "pages" in options else [options["page"]]
+        pipes = self._unpaper_can_pipe()
+        self.progress = 0
         try:
-            image = page.image_object
-            depth = page.get_depth()
-
-            suffix = ".pbm"
-            if depth > 1:
-                suffix = ".pnm"
-
-            # Temporary filename for new file
-            with tempfile.NamedTemporaryFile(
-                dir=options.get("dir"), suffix=suffix
-            ) as infile:
-                logger.debug(
-                    "Writing %s -> %s for unpaper",
-                    page.id,
-                    infile.name,
-                )
-                image.save(infile.name)
-                options["options"]["command"][-3] = infile.name
-                out, out2 = self._run_unpaper_cmd(request)
+            self._map_in_threads(
+                ((self.get_page(id=page_id),) for page_id in pages),
+                lambda page: self._run_unpaper_cmd(options, page.image_object, pipes),
+                functools.partial(self._write_unpaper_result, request, len(pages)),
+                min(self.processes, os.cpu_count() or 1),
+            )
+        except subprocess.CalledProcessError as err:
+            for message in (err.stderr, err.output):
+                if message:
+                    request.data(message)
+            raise
+        except (PermissionError, IOError) as err:
+            logger.error("Error creating file in %s: %s", options.get("dir"), err)
+            request.error(f"Error creating file in {options.get('dir')}: {err}.")
+
+    def _write_unpaper_result(self, request, npages, done, args, result):
+        "write back the results of unpaper for a page"
+        images, messages = result
+        for message in messages:
+            request.data(message)
+        self.check_cancelled()
+        self.progress = done / npages
+        self.message = _("Processing page %i of %i") % (done, npages)
 
-                # unpaper doesn't change the resolution, so we can safely copy it
-                new = Page(
-                    filename=out.name,
-                    dir=options.get("dir"),
-                    delete=True,
-                    format="Portable anymap",
-                    resolution=page.resolution,
-                    dirty_time=datetime.datetime.now(),  # flag as dirty
-                )
+        # interactive requests may have changed the page whilst it was queued
+        page = self.get_page(id=args[0].id)
 
-                # have to send the 2nd page 1st, as the page_id for the 1st will
-                # cease to exist after replacing it
-                number = self.find_page_number_by_page_id(page.id)
-                if out2:
-                    new2 = Page(
-                        filename=out2.name,
-                        dir=options.get("dir"),
-                        delete=True,
-                        format="Portable anymap",
-                        resolution=page.resolution,
-                        dirty_time=datetime.datetime.now(),  # flag as dirty
-                    )
-                    request.data(
-                        {
-                            "type": "page",
-                            "row": self.add_page(new2, number + 1),
-                            "insert-after": page.id,
-                        }
-                    )
-                request.data(
-                    {
-                        "type": "page",
-                        "row": self.replace_page(new, number),
-                        "replace": page.id,
-                    }
-                )
+        # unpaper doesn't change the resolution, so we can safely copy it
+        options = request.args[0]
+        new = [
+            Page(
+                image_object=image,
+                dir=options.get("dir"),
+                delete=True,
+                resolution=page.resolution,
+                dirty_time=datetime.datetime.now(),  # flag as dirty
+            )
+            for image in images
+        ]
 
-        except (PermissionError, IOError) as err:
-            logger.error("Error creating file in %s: %s", options["dir"], err)
-            request.error(f"Error creating file in {options['dir']}: {err}.")
+        # have to send the 2nd page 1st, as the page_id for the 1st will
+        # cease to exist after replacing it
+        number = self.find_page_number_by_page_id(page.id)
+        if len(new) > 1:
+            request.data(
+                {
+                    "type": "page",
+                    "row": self.add_page(new[1], number + 1),
+                    "insert-after": page.id,
+                    "progress": self.progress,
+                    "message": self.message,
+                }
+            )
+        request.data(
+            {
+                "type": "page",
+                "row": self.replace_page(new[0], number),
+                "replace": page.id,
+                "progress": self.progress,
+                "message": self.message,
+            }
+        )
 
     def import_page(self, **kwargs):
         "import page from file or object"
@@ -1359,6 +1860,196 @@ class DocThread(SaveThread):
             }
         )
 
+    def import_scan(self, **kwargs):
+        "import a scanned page and post-process it"
+        callbacks = _note_callbacks(kwargs)
+        return self.send("import_scan", kwargs, **callbacks)
+
+    def do_import_scan(self, request):
+        """import a scanned page and display it, then pass it through the
+        rotate, unpaper, user-defined tool and OCR steps in memory, and replace
+        it with the resulting pages. The scan and its processing are a single
+        undo step. If processing fails, the unprocessed scan is kept"""
+        options = request.args[0]
+        page = Page(**options["page_options"])
+        page.get_resolution()
+        self._take_snapshot()
+        row = self.add_page(page, options.get("page"), snapshot=False)
+        logger.info("Added page id %s at page number %s", row[2], row[0])
+        request.data({"type": "page", "row": row})
+        if not any(options.get(key) for key in ("rotate", "unpaper", "udt", "ocr")):
+            return
+
+        pages, messages = self._process_scan(request, page)
+        for message in messages:
+            request.data(message)
+        self.check_cancelled()
+
+        # add any further pages before replacing the scan, which they follow
+        responses = []
+        try:
+            with self._deferred_commit():
+                number, ref = row[0], row[2]
+                for i, new in enumerate(pages[1:], start=1):
+                    new_row = self.add_page(new, number + i, snapshot=False)
+                    responses.append(
+                        {"type": "page", "row": new_row, "insert-after": ref}
+                    )
+                    ref = new_row[2]
+                new_row = self.replace_page(pages[0], number, snapshot=False)
+                responses.append({"type": "page", "row": new_row, "replace": row[2]})
+        finally:
+            for response in responses:
+                logger.info(
+                    "Added page id %s at page number %s",
+                    response["row"][2],
+                    response["row"][0],
+                )
+                request.data(response)
+
+    def _process_scan(self, request, page):
+        """return the pages resulting from post-processing the scanned page and
+        any messages. The database is not touched"""
+        options = request.args[0]
+        pages, messages = [page], []
+        if options.get("rotate"):
+            self.check_cancelled()
+            page.image_object = imageops.rotate(page.image_object, options["rotate"])
+            _update_page_metadata(page, "rotate", {"angle": options["rotate"]})
+
+        if options.get("unpaper"):
+            self.check_cancelled()
+            images, messages = self._run_unpaper_cmd(
+                {"options": options["unpaper"], "dir": options.get("dir")},
+                page.image_object,
+                self._unpaper_can_pipe(),
+            )
+            pages = [
+                Page(
+                    image_object=image,
+                    dir=options.get("dir"),
+                    resolution=page.resolution,
+                )
+                for image in images
+            ]
+
+        if options.get("udt"):
+            for page in pages:
+                self.check_cancelled()
+                page.image_object, stderr = _run_user_defined(
+                    options["udt"],
+                    page.image_object,
+                    page.resolution,
+                    options.get("dir"),
+                )
+                if stderr != "":
+                    messages.append({"type": "message", "info": stderr})
+
+        if options.get("ocr"):
+            if options.get("language") is None:
+                raise ValueError(_("No tesseract language specified"))
+            path = self._tessdata_path(request)
+            for page in pages:
+                hocr = self._recognise(page, options["language"], path)
+                page.import_hocr(hocr_document(hocr))
+                page.ocr_flag = True
+                page.ocr_time = datetime.datetime.now()
+        return pages, messages
+
+
+def _update_page_metadata(page, process, options):
+    "update the size, resolution and text layer of the page after process"
+    if process == "rotate" and options["angle"] in (-90, 90):
+        page.width, page.height = page.height, page.width
+        page.resolution = (
+            page.resolution[1],
+            page.resolution[0],
+            page.resolution[2],
+        )
+    elif process == "crop":
+        page.width = options["w"]
+        page.height = options["h"]
+        if page.text_layer is not None:
+            bboxtree = Bboxtree(page.text_layer)
+            page.text_layer = bboxtree.crop(
+                options["x"], options["y"], options["w"], options["h"]
+            ).json()
+
+
+def _unpaper_command(command, *files):
+    """return a copy of the unpaper command line from Unpaper.get_cmdline(),
+    with its placeholders replaced by the input and output files"""
+    return command[:-3] + list(files)
+
+
+def _unpaper_via_pipes(command, image):
+    "run unpaper on the image, passing it via stdin and stdout"
+    data = io.BytesIO()
+    image.save(data, format="PPM")
+    spo = subprocess.run(
+        _unpaper_command(command, "-", "-"),
+        input=data.getvalue(),
+        check=True,
+        capture_output=True,
+    )
+    output = Image.open(io.BytesIO(spo.stdout))
+    output.load()
+    messages = []
+    stderr = spo.stderr.decode(errors="replace")
+    if stderr:
+        logger.error(stderr)
+        messages.append(stderr)
+    return [output], messages
+
+
+def _unpaper_via_files(command, image, npages, dirname):
+    "run unpaper on the image, passing it via temporary files"
+    with tempfile.TemporaryDirectory(dir=dirname) as tmpdir:
+        infile = os.path.join(tmpdir, "in.pbm" if image.mode == "1" else "in.pnm")
+        outfiles = [os.path.join(tmpdir, f"out{i}.pnm") for i in range(npages)]
+        logger.debug("Writing %s for unpaper", infile)
+        image.save(infile)
+        command = _unpaper_command(command, infile, *outfiles)
+        spo = subprocess.run(command, check=True, capture_output=True, text=True)
+        messages = []
+        logger.info(spo.stdout)
+        if spo.stderr:
+            logger.error(spo.stderr)
+            messages.append(spo.stderr)
+            if not _file_size(outfiles[0]):
+                raise subprocess.CalledProcessError(
+                    spo.returncode, command, stderr=spo.stderr
+                )
+
+        stdout = re.sub(
+            r"Processing[ ]sheet.*[.]pnm\n",
+            r"",
+            spo.stdout,
+            count=1,
+            flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
+        )
+        if stdout:
+            logger.warning(stdout)
+            messages.append(stdout)
+            if not _file_size(outfiles[0]):
+                raise subprocess.CalledProcessError(
+                    spo.returncode, command, output=stdout
+                )
+
+        images = []
+        for outfile in outfiles:
+            images.append(Image.open(outfile))
+            images[-1].load()
+    return images, messages
+
+
+def _file_size(path):
+    "return the size of the file, or 0 if it does not exist"
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
 
 def _calculate_crop_tuples(options, image):
     if options["direction"] == "v":
@@ -182,117 +182,53 @@ class Document(BaseDocument):
         kwargs["data_callback"] = _import_file_data_callback
         self.thread.import_file(**kwargs)
 
-    def _post_process_rotate(self, page_id, options):
-
-        def updated_page_callback(response):
-            info = response.info
-            if info and "type" in info and info["type"] == "page":
-                del options["rotate"]
-                self._post_process_scan(info["row"][2], options)
-
-        rotate_options = options.copy()
-        rotate_options["angle"] = options["rotate"]
-        rotate_options["page"] = page_id
-        rotate_options["updated_page_callback"] = updated_page_callback
-        del rotate_options["finished_callback"]
-        self.rotate(**rotate_options)  # pylint: disable=no-member
-
-    def _post_process_unpaper(self, page_id, options):
-
-        def updated_page_callback(response):
-            info = response.info
-            if info and "type" in info and info["type"] == "page":
-                del options["unpaper"]
-                self._post_process_scan(info["row"][2], options)
-
-        unpaper_options = options.copy()
-        unpaper_options["options"] = {
-            "command": options["unpaper"].get_cmdline(),
-            "direction": options["unpaper"].get_option("direction"),
-        }
-        unpaper_options["page"] = page_id
-        unpaper_options["updated_page_callback"] = updated_page_callback
-        del unpaper_options["finished_callback"]
-        self.unpaper(**unpaper_options)
-
-    def _post_process_udt(self, page_id, options):
-
-        def updated_page_callback(response):
-            info = response.info
-            if info and "type" in info and info["type"] == "page":
-                del options["udt"]
-                self._post_process_scan(info["row"][2], options)
-
-        udt_options = options.copy()
-        udt_options["page"] = page_id
-        udt_options["command"] = options["udt"]
-        udt_options["updated_page_callback"] = updated_page_callback
-        self.user_defined(**udt_options)
-
-    def _post_process_ocr(self, page_id, options):
-
-        def ocr_finished_callback(_response):
-            del options["ocr"]
-            self._post_process_scan(None, options)  # to fire finished_callback
-
-        self.ocr_pages(
-            pages=[page_id],
-            threshold=options.get("threshold"),
-            engine=options["engine"],
-            language=options["language"],
-            queued_callback=options.get("queued_callback"),
-            started_callback=options.get("started_callback"),
-            finished_callback=ocr_finished_callback,
-            error_callback=options.get("error_callback"),
-            display_callback=options.get("display_callback"),
-        )
-
-    def _post_process_scan(self, page_id, options):
-        options = defaultdict(None, options)
-
-        if "rotate" in options and options["rotate"]:
-            self._post_process_rotate(page_id, options)
-            return
-
-        if "unpaper" in options and options["unpaper"]:
-            self._post_process_unpaper(page_id, options)
-            return
-
-        if "udt" in options and options["udt"]:
-            self._post_process_udt(page_id, options)
-            return
-
-        if "ocr" in options and options["ocr"]:
-            self._post_process_ocr(page_id, options)
-            return
-
-        if "finished_callback" in options and options["finished_callback"]:
-            options["finished_callback"](None)
-
     def import_scan(self, **kwargs):
-        "Take new scan, display it, and set off any post-processing chains"
-
-        page_kwargs = {
+        """Take new scan and run any post-processing on it in the same job,
+        displaying the resulting pages"""
+        page_options = {
             "resolution": kwargs["resolution"],
             "format": "Portable anymap",
         }
-        for key in ["image_object", "filename", "dir"]:
+        for key in ["image_object", "filename", "dir", "delete"]:
             if key in kwargs:
-                page_kwargs[key] = kwargs[key]
+                page_options[key] = kwargs[key]
+
+        scan_kwargs = {
+            "page_options": page_options,
+            "page": kwargs.get("page"),
+            "dir": kwargs.get("dir"),
+            "rotate": kwargs.get("rotate"),
+            "udt": kwargs.get("udt"),
+        }
+        if kwargs.get("unpaper"):
+            scan_kwargs["unpaper"] = {
+                "command": kwargs["unpaper"].get_cmdline(),
+                "direction": kwargs["unpaper"].get_option("direction"),
+            }
+        if kwargs.get("ocr") and kwargs.get("engine", "tesseract") == "tesseract":
+            scan_kwargs["ocr"] = True
+            scan_kwargs["language"] = kwargs.get("language")
+        for key in [
+            "queued_callback",
+            "started_callback",
+            "running_callback",
+            "finished_callback",
+            "error_callback",
+            "display_callback",
+        ]:
+            if key in kwargs:
+                scan_kwargs[key] = kwargs[key]
 
-        # FIXME: duplicate to _import_file_data_callback(), apart from the
-        # post-processing chain
+        # FIXME: duplicate to _import_file_data_callback()
         def _import_scan_data_callback(response):
             info = response.info
             if info and "type" in info and info["type"] == "page":
                 self.add_page(*info["row"], **info)
-                self._post_process_scan(info["row"][2], kwargs)
+            elif "logger_callback" in kwargs:
+                kwargs["logger_callback"](response)
 
-        import_scan_kwargs = kwargs.copy()
-        import_scan_kwargs["data_callback"] = _import_scan_data_callback
-        if "finished_callback" in import_scan_kwargs:
-            del import_scan_kwargs["finished_callback"]
-        self.thread.import_page(**import_scan_kwargs)
+        scan_kwargs["data_callback"] = _import_scan_data_callback
+        self.thread.import_scan(**scan_kwargs)
 
     def split_page(self, **kwargs):
         """split the given page either vertically or horizontally, creating an
@@ -312,13 +248,11 @@ class Document(BaseDocument):
 
     def ocr_pages(self, **kwargs):
         "Wrapper for the various ocr engines"
-        for page in kwargs["pages"]:
-            kwargs["page"] = page
-            if kwargs["engine"] == "tesseract":
-                self.tesseract(**kwargs)  # pylint: disable=no-member
+        if kwargs["engine"] == "tesseract":
+            self.tesseract(**kwargs)  # pylint: disable=no-member
 
     def unpaper(self, **kwargs):
-        "run unpaper on the given page"
+        "run unpaper on the given page or pages"
 
         # FIXME: duplicate to _import_file_data_callback()
         def _unpaper_data_callback(response):
@@ -356,7 +290,7 @@ class Document(BaseDocument):
         # self.get_model().handler_block(self.row_deleted_signal)
         self.get_selection().handler_block(self.selection_changed_signal)
         self._block_signals = True
-        self.data = self.thread.undo()
+        self.data = self.thread.undo(thumbnails=False)
         self._block_signals = False
 
         # Unblock slist signals now finished
@@ -376,7 +310,7 @@ class Document(BaseDocument):
         # self.get_model().handler_block(self.row_deleted_signal)
         self.get_selection().handler_block(self.selection_changed_signal)
         self._block_signals = True
-        self.data = self.thread.redo()
+        self.data = self.thread.redo(thumbnails=False)
         self._block_signals = False
 
         # Unblock slist signals now finished
@@ -2,13 +2,22 @@
 
 import math
 import logging
+import threading
 from types import SimpleNamespace
+from PIL import Image
 from basethread import BaseThread
 import sane
 from frontend import enums
 
 logger = logging.getLogger(__name__)
 
+SPOOL_POLL_INTERVAL = 0.1  # seconds
+PROGRESS_STEPS = 100  # progress updates per page
+
+
+class ScanCancelledError(RuntimeError):
+    "Raised when a scan is cancelled whilst a page is being read"
+
 
 def _set_default_callbacks(kwargs):
     for callback in [
@@ -16,12 +25,20 @@ def _set_default_callbacks(kwargs):
         "running_callback",
         "error_callback",
         "new_page_callback",
+        "progress_callback",
         "finished_callback",
     ]:
         if callback not in kwargs:
             kwargs[callback] = None
 
 
+def _progress_data_callback(progress_callback):
+    "return a data callback passing the progress of a scan to progress_callback"
+    if progress_callback is None:
+        return None
+    return lambda response: progress_callback(response.info["progress"])
+
+
 class SaneThread(BaseThread):
     "subclass basethread for SANE"
 
@@ -29,6 +46,9 @@ class SaneThread(BaseThread):
     device_name = None
     num_pages_scanned = 0
     num_pages = 0
+    _spool = None  # places for scanned pages waiting to be imported
+    _cancel_scan = False
+    _reading = False  # whether a page is being read from the device
 
     def handler_wrapper(self, request, handler):
         "override the handler wrapper logic to deal with SANE_STATUS_NO_DOCS"
@@ -42,8 +62,8 @@ class SaneThread(BaseThread):
                 request.process,
                 err,
             )
-            if (
-                request.process == "scan_page"
+            if isinstance(err, ScanCancelledError) or (
+                request.process in ("scan_page", "scan_pages")
                 and str(err) == "Document feeder out of documents"
             ):
                 request.finished(None, str(err))
@@ -128,11 +148,88 @@ class SaneThread(BaseThread):
 
         return info
 
-    def do_scan_page(self, _request):
+    def do_scan_page(self, request):
         "scan page"
         if self.device_handle is None:
             raise ValueError("must open device before starting scan")
-        return self.device_handle.scan()
+        return self._snap(request)
+
+    def _snap(self, request):
+        """start the scan and read the image, passing the fraction of lines
+        read so far to the data callback as it goes. Unlike SaneDev.scan(),
+        the image wraps the buffer returned by the backend without copying it.
+        A page being read is aborted by cancel() calling sane_cancel()"""
+        last = 0
+
+        def progress(lines, total):
+            "called from C, which can't handle exceptions, so must never raise"
+            nonlocal last
+            try:
+                if total > 0 and lines * PROGRESS_STEPS // total > last:
+                    last = lines * PROGRESS_STEPS // total
+                    request.data({"progress": lines / total})
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error("Error reporting scan progress: %s", err)
+
+        self.device_handle.start()
+        self._reading = True
+        try:
+            # SaneDev.snap() has no progress callback, so, as in
+            # do_set_option(), call the device directly
+            data, width, height, samples, _sample_size = self.device_handle.dev.snap(
+                False, False, progress
+            )
+        except Exception as err:
+            if self._cancel_scan:
+                raise ScanCancelledError("Scan cancelled") from err
+            raise
+        finally:
+            self._reading = False
+
+        # the backend may return what it read before it was cancelled
+        if self._cancel_scan:
+            raise ScanCancelledError("Scan cancelled")
+        if not data:
+            raise RuntimeError("Scanner returned no data")
+        mode = "RGB" if samples == 3 else "L"
+        return Image.frombuffer(mode, (width, height), data, "raw", mode, 0, 1)
+
+    def do_scan_pages(self, request):
+        """scan pages until the feeder runs out or num_pages have been scanned,
+        starting each page as soon as the previous one has been read. Each
+        page holds a place in the spool until release_frame() is called, so
+        scanning pauses whilst the spool is full"""
+        num_pages, start, step = request.args
+        while num_pages == 0 or self.num_pages_scanned < num_pages:
+            while not self._spool.acquire(timeout=SPOOL_POLL_INTERVAL):
+                if self._cancel_scan:
+                    return None
+            if self._cancel_scan:
+                self._spool.release()
+                return None
+            try:
+                image = self.do_scan_page(request)
+            except Exception:
+                self._spool.release()
+                raise
+            self.num_pages_scanned += 1
+            request.data(
+                {
+                    "image": image,
+                    "page_number": start + step * (self.num_pages_scanned - 1),
+                }
+            )
+        return None
+
+    def release_frame(self):
+        """give back the place in the spool held by a scanned page. A page
+        from a cancelled scan may give back a place in the next spool early,
+        but never more places than the spool has"""
+        if self._spool is not None:
+            try:
+                self._spool.release()
+            except ValueError:  # from a previous spool
+                pass
 
     def do_cancel(self, _request):
         "cancel"
@@ -190,6 +287,7 @@ class SaneThread(BaseThread):
         self.scan_page(
             started_callback=kwargs["started_callback"],
             running_callback=kwargs["running_callback"],
+            data_callback=_progress_data_callback(kwargs["progress_callback"]),
             error_callback=kwargs["error_callback"],
             finished_callback=lambda response: self._scan_pages_finished_callback(
                 response,
@@ -197,6 +295,7 @@ class SaneThread(BaseThread):
                 finished_callback=kwargs["finished_callback"],
                 error_callback=kwargs["error_callback"],
                 new_page_callback=kwargs["new_page_callback"],
+                progress_callback=kwargs["progress_callback"],
             ),
         )
 
@@ -211,9 +310,13 @@ class SaneThread(BaseThread):
         if "step" in kwargs:
             self.step = kwargs["step"]
         _set_default_callbacks(kwargs)
+        self._cancel_scan = False
+        if kwargs.get("spool_size"):
+            return self._scan_pages_spooled(kwargs)
         return self.scan_page(
             started_callback=kwargs["started_callback"],
             running_callback=kwargs["running_callback"],
+            data_callback=_progress_data_callback(kwargs["progress_callback"]),
             error_callback=kwargs["error_callback"],
             finished_callback=lambda response: self._scan_pages_finished_callback(
                 response,
@@ -221,9 +324,38 @@ class SaneThread(BaseThread):
                 finished_callback=kwargs["finished_callback"],
                 error_callback=kwargs["error_callback"],
                 new_page_callback=kwargs["new_page_callback"],
+                progress_callback=kwargs["progress_callback"],
             ),
         )
 
+    def _scan_pages_spooled(self, kwargs):
+        """scan pages in a single request, with up to spool_size pages
+        scanned ahead of their being released with release_frame()"""
+        self._spool = threading.BoundedSemaphore(kwargs["spool_size"])
+
+        def data_callback(response):
+            if "progress" in response.info:
+                if kwargs["progress_callback"] is not None:
+                    kwargs["progress_callback"](response.info["progress"])
+            elif kwargs["new_page_callback"] is None:
+                self.release_frame()
+            else:
+                kwargs["new_page_callback"](
+                    response.info["image"], response.info["page_number"]
+                )
+
+        return self.send(
+            "scan_pages",
+            self.num_pages,
+            self.start,
+            self.step,
+            started_callback=kwargs["started_callback"],
+            running_callback=kwargs["running_callback"],
+            data_callback=data_callback,
+            error_callback=kwargs["error_callback"],
+            finished_callback=kwargs["finished_callback"],
+        )
+
     def close_device(self, **kwargs):
         "close device"
         return self.send("close_device", **kwargs)
@@ -233,11 +365,14 @@ class SaneThread(BaseThread):
         return self.send("quit", **kwargs)
 
     def cancel(self, **kwargs):
-        "Flag the scan routine to abort"
+        "Flag the scan routine to abort, and abort the page being read, if any"
+        self._cancel_scan = True
+        if self._reading and self.device_handle is not None:
+            # sane_cancel() may be called from another thread whilst reading
+            self.device_handle.cancel()
 
         # empty process queue first to stop any new process from starting
-        while not self.requests.empty():
-            self.requests.get()
+        self.drain_requests()
 
         # Then send the thread a cancel signal
         # _self["abort_scan"] = 1
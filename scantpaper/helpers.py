@@ -38,8 +38,9 @@ class Proc:
     stderr: str
 
 
-def exec_command(cmd, pidfile=None):
-    "wrapper for subprocess.Popen()"
+def exec_command(cmd, pidfile=None, pids=None):
+    """wrapper for subprocess.Popen(), writing the PID to pidfile, or keeping
+    it in the set pids whilst the process runs"""
 
     logger.info(" ".join(cmd))
     try:
@@ -49,7 +50,13 @@ def exec_command(cmd, pidfile=None):
             logger.info("Spawned PID %s", proc.pid)
             if pidfile is not None:
                 pidfile.write(str(proc.pid))
-            stdout_data, stderr_data = proc.communicate()
+            if pids is not None:
+                pids.add(proc.pid)
+            try:
+                stdout_data, stderr_data = proc.communicate()
+            finally:
+                if pids is not None:
+                    pids.discard(proc.pid)
             returncode = proc.returncode
     except FileNotFoundError as err:
         returncode, stdout_data, stderr_data = -1, None, str(err)
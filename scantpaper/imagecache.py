@@ -0,0 +1,97 @@
+"Byte-budgeted LRU cache of decoded page images"
+
+import collections
+import threading
+
+CacheInfo = collections.namedtuple(
+    "CacheInfo", ["hits", "misses", "maxsize", "currsize", "count"]
+)
+
+
+def image_bytes(image):
+    "estimate the memory used by the pixel data of a PIL image"
+    if image.mode in ("1", "L", "P"):
+        bytes_per_pixel = 1
+    elif image.mode.startswith("I;16"):
+        bytes_per_pixel = 2
+    else:
+        bytes_per_pixel = 4
+    return image.width * image.height * bytes_per_pixel
+
+
+class ImageCache:
+    """LRU cache of decoded images, keyed by page id, holding at most maxsize
+    bytes of pixel data. Safe to use from several threads. The cached images
+    are shared, so get() returns a copy that the caller is free to modify."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        "return a copy of the cached image for key, or None"
+        with self._lock:
+            if key not in self._images:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._images.move_to_end(key)
+            image = self._images[key]
+        return image.copy()
+
+    def put(self, key, image):
+        "cache image for key, evicting the least recently used as necessary"
+        size = image_bytes(image)
+        with self._lock:
+            self._pop(key)
+            if size > self.maxsize:
+                return
+            self._images[key] = image
+            self._size += size
+            self._evict()
+
+    def invalidate(self, keys):
+        "drop the given keys from the cache"
+        with self._lock:
+            for key in keys:
+                self._pop(key)
+
+    def retain(self, keys):
+        "drop everything except the given keys from the cache"
+        keys = set(keys)
+        with self._lock:
+            for key in [key for key in self._images if key not in keys]:
+                self._pop(key)
+
+    def clear(self):
+        "empty the cache"
+        with self._lock:
+            self._images.clear()
+            self._size = 0
+
+    def resize(self, maxsize):
+        "set the maximum size in bytes, evicting as necessary"
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def cache_info(self):
+        "return the hit and miss counters, and current and maximum size"
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.maxsize, self._size, len(self._images)
+            )
+
+    def _pop(self, key):
+        image = self._images.pop(key, None)
+        if image is not None:
+            self._size -= image_bytes(image)
+
+    def _evict(self):
+        while self._size > self.maxsize:
+            _key, image = self._images.popitem(last=False)
+            self._size -= image_bytes(image)
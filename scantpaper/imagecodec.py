@@ -0,0 +1,125 @@
+"""Lossless codecs for storing page images as blobs in the session database.
+
+Blobs written with a codec other than PNG start with a small header giving the
+codec, image mode, size and palette, followed by the (possibly compressed)
+raw pixel data. Blobs without the header are decoded as image files, so that
+sessions written with PNG blobs still open."""
+
+import hashlib
+import io
+import struct
+import zlib
+from PIL import Image
+
+try:
+    from compression import zstd  # python >= 3.14
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+MAGIC = b"SPIX"
+HEADER = struct.Struct("<4sB8sIII")  # magic, codec, mode, width, height, palette
+RAW, ZLIB, ZSTD = 1, 2, 3
+CODEC_IDS = {"raw": RAW, "zlib": ZLIB, "zstd": ZSTD}
+CODECS = ["png", *CODEC_IDS]
+DEFAULT_LEVEL = {"png": 6, "zlib": 1, "zstd": 3}
+
+
+def available_codecs():
+    "return the list of codecs that can be used with the installed modules"
+    return [codec for codec in CODECS if codec != "zstd" or zstd is not None]
+
+
+def encode(image, codec="png", level=None):
+    "return the image as bytes using the given codec and compression level"
+    if codec not in available_codecs():
+        raise ValueError(f"Unknown or unavailable image codec '{codec}'")
+    if level is None and codec in DEFAULT_LEVEL:
+        level = DEFAULT_LEVEL[codec]
+    if codec == "png":
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", compress_level=level)
+        return buffer.getvalue()
+
+    palette = b""
+    if image.mode in ("P", "PA"):
+        palette = bytes(image.getpalette())
+    data = image.tobytes()
+    if codec == "zlib":
+        data = zlib.compress(data, level)
+    elif codec == "zstd":
+        data = _zstd_compress(data, level)
+    return (
+        HEADER.pack(
+            MAGIC,
+            CODEC_IDS[codec],
+            image.mode.encode("ascii"),
+            image.width,
+            image.height,
+            len(palette),
+        )
+        + palette
+        + data
+    )
+
+
+def decode(blob):
+    "return the image encoded in blob"
+    if blob[: len(MAGIC)] != MAGIC:
+        return Image.open(io.BytesIO(blob))
+    _magic, codec, mode, width, height, npalette = HEADER.unpack_from(blob)
+    offset = HEADER.size + npalette
+    palette = blob[HEADER.size : offset]
+    data = memoryview(blob)[offset:]
+    if codec == ZLIB:
+        data = zlib.decompress(data)
+    elif codec == ZSTD:
+        if zstd is None:
+            raise ValueError("zstd support required to decode this image")
+        data = _zstd_decompress(data)
+    elif codec != RAW:
+        raise ValueError(f"Unknown image codec id {codec}")
+    image = Image.frombytes(mode.rstrip(b"\0").decode("ascii"), (width, height), data)
+    if palette:
+        image.putpalette(palette)
+    return image
+
+
+def digest(image):
+    """return a hash of the pixel data of the image, independent of the codec
+    used to store it"""
+    hasher = hashlib.blake2b(digest_size=32)
+    hasher.update(
+        HEADER.pack(MAGIC, 0, image.mode.encode("ascii"), image.width, image.height, 0)
+    )
+    if image.mode in ("P", "PA"):
+        hasher.update(bytes(image.getpalette()))
+    hasher.update(image.tobytes())
+    return hasher.digest()
+
+
+def codec_name(blob):
+    "return the name of the codec used to encode blob"
+    if blob[: len(MAGIC)] != MAGIC:
+        return "png"
+    codec = HEADER.unpack_from(blob)[1]
+    for name, codec_id in CODEC_IDS.items():
+        if codec_id == codec:
+            return name
+    return None
+
+
+def _zstd_compress(data, level):
+    if hasattr(zstd, "ZstdCompressor"):  # zstandard
+        return zstd.ZstdCompressor(level=level).compress(data)
+    return zstd.compress(data, level=level)
+
+
+def _zstd_decompress(data):
+    if hasattr(zstd, "ZstdDecompressor") and hasattr(
+        zstd.ZstdDecompressor, "decompressobj"
+    ):  # zstandard
+        return zstd.ZstdDecompressor().decompressobj().decompress(bytes(data))
+    return zstd.decompress(bytes(data))
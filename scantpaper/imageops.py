@@ -0,0 +1,87 @@
+"""Pure pixel operations on PIL images.
+
+These functions take and return plain PIL images (or simple values), and do
+not touch the database or GTK, so that they can be run in a worker process."""
+
+from PIL import ImageStat, ImageEnhance, ImageOps, ImageFilter
+
+
+def rotate(image, angle):
+    "rotate image by angle degrees"
+    return image.rotate(angle, expand=True)
+
+
+def threshold(image, level):
+    "threshold image to black and white"
+    # To grayscale
+    image = image.convert("L")
+    # Threshold
+    image = image.point(lambda p: 255 if p > level else 0)
+    # To mono
+    return image.convert("1")
+
+
+def brightness_contrast(image, brightness, contrast):
+    "adjust brightness and contrast"
+    image = ImageEnhance.Brightness(image).enhance(brightness)
+    return ImageEnhance.Contrast(image).enhance(contrast)
+
+
+def negate(image):
+    "invert image"
+    if image.mode in ("P", "RGBA"):
+        image = image.convert("RGB")
+    return ImageOps.invert(image)
+
+
+def unsharp(image, radius, percent, level):
+    "run unsharp mask"
+    return image.filter(
+        ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=level)
+    )
+
+
+def crop(image, left, top, width, height):
+    "crop image"
+    return image.crop((left, top, left + width, top + height))
+
+
+def analyse(image):
+    "return the mean and standard deviation of the image"
+    stat = ImageStat.Stat(image)
+    # ImageStat seems to have a bug here. Working around it.
+    if stat.count == [0]:
+        return [0.0], [0.0]
+    return stat.mean, stat.stddev
+
+
+# process name -> function, and the request options passed to it as arguments
+OPERATIONS = {
+    "rotate": (rotate, ("angle",)),
+    "threshold": (threshold, ("threshold",)),
+    "brightness_contrast": (brightness_contrast, ("brightness", "contrast")),
+    "negate": (negate, ()),
+    "unsharp": (unsharp, ("radius", "percent", "threshold")),
+    "crop": (crop, ("x", "y", "w", "h")),
+}
+
+
+def operation_args(process, options):
+    "return the function and picklable arguments for the given process"
+    func, keys = OPERATIONS[process]
+    return func, [options[key] for key in keys]
+
+
+def chain_args(steps):
+    """return the picklable arguments for chain() given a list of
+    (process, options) pairs"""
+    return [
+        (process, operation_args(process, options)[1]) for process, options in steps
+    ]
+
+
+def chain(image, steps):
+    "apply the steps from chain_args() to image, one after the other"
+    for process, args in steps:
+        image = OPERATIONS[process][0](image, *args)
+    return image
@@ -1,26 +1,30 @@
 "Threading model for the Document class"
 
+import contextlib
 import threading
 import pathlib
 import logging
 import re
 import os
 import subprocess
-import glob
+import shutil
 import tempfile
 from PIL import Image
-from basethread import BaseThread
+from basethread import BaseThread, PRIORITY_BULK
 from page import Page
 from i18n import _
 from helpers import exec_command
 
 logger = logging.getLogger(__name__)
 
+
 image_format = {
     "pnm": "Portable anymap",
     "ppm": "Portable pixmap format (color)",
     "pgm": "Portable graymap format (gray scale)",
     "pbm": "Portable bitmap format (black and white)",
+    "jpg": "Joint Photographic Experts Group JFIF format",
+    "jp2": "JPEG-2000 JP2 File Format Syntax",
 }
 
 
@@ -31,10 +35,12 @@ class CancelledError(RuntimeError):
 class Importhread(BaseThread):
     "subclass basethread for document"
 
+    priorities = {**BaseThread.priorities, "import_file": PRIORITY_BULK}
+
     def __init__(self):
         BaseThread.__init__(self)
         self.lock = threading.Lock()
-        self.running_pids = []
+        self.running_pids = set()
         self.message = None
         self.progress = None
         self.cancel = False
@@ -236,6 +242,19 @@ class Importhread(BaseThread):
 
     def do_import_file(self, request):
         "import file in thread"
+        with self.bulk_import():
+            self._import_file(request)
+
+    def bulk_import(self):
+        """return a context manager grouping the pages imported within it.
+        DocThread adds them as a single undo step"""
+        return contextlib.nullcontext()
+
+    def _add_imported_page(self, request, page):
+        "add an imported page, passing its row to the data callback"
+        request.data({"type": "page", "row": self.add_page(page)})
+
+    def _import_file(self, request):
         args = request.args[0]
         if args["info"]["format"] == "DJVU":
             self._do_import_djvu(request)
@@ -255,12 +274,7 @@ class Importhread(BaseThread):
                     width=args["info"]["width"][0],
                     height=args["info"]["height"][0],
                 )
-                request.data(
-                    {
-                        "type": "page",
-                        "row": self.add_page(page),
-                    }
-                )
+                self._add_imported_page(request, page)
 
             # Split the tiff into its pages and import them individually
             elif args["last"] >= args["first"] and args["first"] > 0:
@@ -286,12 +300,7 @@ class Importhread(BaseThread):
                             width=args["info"]["width"][i - 1],
                             height=args["info"]["height"][i - 1],
                         )
-                        request.data(
-                            {
-                                "type": "page",
-                                "row": self.add_page(page),
-                            }
-                        )
+                        self._add_imported_page(request, page)
 
         else:
             page = Page(
@@ -302,12 +311,7 @@ class Importhread(BaseThread):
                 height=args["info"]["height"][0],
             )
             page.get_resolution(self.paper_sizes)
-            request.data(
-                {
-                    "type": "page",
-                    "row": self.add_page(page),
-                }
-            )
+            self._add_imported_page(request, page)
 
     def get_file_info(self, path, password, **kwargs):
         "get file info"
@@ -385,85 +389,126 @@ class Importhread(BaseThread):
                         )
                         request.error("Error: parsing DjVU annotation layer")
 
-                    request.data(
-                        {
-                            "type": "page",
-                            "row": self.add_page(page),
-                        }
-                    )
+                    self._add_imported_page(request, page)
 
     def _do_import_pdf(self, request):
         args = request.args[0]
+        resolutions = self._get_pdf_resolutions(args)
+        try:
+            tmpdir = tempfile.TemporaryDirectory(dir=args["dir"] or None)
+        except (PermissionError, IOError) as err:
+            logger.error("Caught error importing PDF: %s", err)
+            request.error(_("Error importing PDF"))
+            return
 
-        # Extract images from PDF
-        warning_flag, xresolution, yresolution = False, None, None
-        for i in range(args["first"], args["last"] + 1):
-            out = subprocess.check_output(
-                _pdf_cmd_with_password(
-                    [
-                        "pdfimages",
-                        "-f",
-                        str(i),
-                        "-l",
-                        str(i),
-                        "-list",
-                        args["info"]["path"],
-                    ],
-                    args["password"],
-                ),
-                text=True,
-            )
-            for line in re.split(r"\n", out):
-                xresolution, yresolution = line[70:75], line[76:81]
-                if re.search(r"\d", xresolution, re.MULTILINE | re.DOTALL | re.VERBOSE):
-                    xresolution, yresolution = float(xresolution), float(yresolution)
-                    break
-
-            try:
-                subprocess.run(
+        # extract the images and text of the whole range with one process
+        # each, importing the pages as they become available
+        with tmpdir:
+            prefix = os.path.join(tmpdir.name, "x")
+            range_args = ["-f", str(args["first"]), "-l", str(args["last"])]
+            with subprocess.Popen(
+                _line_buffered(
                     _pdf_cmd_with_password(
                         [
                             "pdfimages",
-                            "-f",
-                            str(i),
-                            "-l",
-                            str(i),
+                            "-p",
+                            "-j",
+                            "-jp2",
+                            "-print-filenames",
+                            *range_args,
                             args["info"]["path"],
-                            "x",
+                            prefix,
                         ],
                         args["password"],
-                    ),
-                    check=True,
-                )
-            except subprocess.CalledProcessError:
+                    )
+                ),
+                stdout=subprocess.PIPE,
+                text=True,
+            ) as images, subprocess.Popen(
+                _pdf_cmd_with_password(
+                    ["pdftotext", "-bbox", *range_args, args["info"]["path"], "-"],
+                    args["password"],
+                ),
+                stdout=subprocess.PIPE,
+                text=True,
+            ) as text:
+                try:
+                    if (
+                        self._import_pdf_pages(
+                            request,
+                            resolutions,
+                            _pdfimages_by_page(
+                                images,
+                                args["first"],
+                                args["last"],
+                                self.check_cancelled,
+                            ),
+                            _pdftotext_pages(text.stdout),
+                        )
+                        and text.wait() != 0
+                    ):
+                        request.error(_("Error extracting text layer from PDF"))
+                finally:
+                    for proc in (images, text):
+                        if proc.poll() is None:
+                            proc.kill()
+
+    def _get_pdf_resolutions(self, args):
+        "return the resolution of the first image on each page in the range"
+        out = subprocess.check_output(
+            _pdf_cmd_with_password(
+                [
+                    "pdfimages",
+                    "-f",
+                    str(args["first"]),
+                    "-l",
+                    str(args["last"]),
+                    "-list",
+                    args["info"]["path"],
+                ],
+                args["password"],
+            ),
+            text=True,
+        )
+        resolutions = {}
+        for line in re.split(r"\n", out):
+            fields = line.split()
+            if not fields or not fields[0].isdigit():
+                continue
+            xresolution, yresolution = line[70:75], line[76:81]
+            if int(fields[0]) not in resolutions and re.search(r"\d", xresolution):
+                resolutions[int(fields[0])] = (float(xresolution), float(yresolution))
+        return resolutions
+
+    def _import_pdf_pages(self, request, resolutions, images, texts):
+        """import the images of each page, as yielded by _pdfimages_by_page(),
+        returning False if the images could not be extracted"""
+        args = request.args[0]
+        warning_flag = False
+        npages = args["last"] - args["first"] + 1
+        for i, fnames in images:
+            if fnames is None:
                 request.error(_("Error extracting images from PDF"))
-                return
-            self.check_cancelled()
-
-            # Import each image
-            images = glob.glob("x-??*.???")
-            if len(images) != 1:
+                return False
+            self.progress = (i - args["first"]) / npages
+            self.message = _("Importing page %i of %i") % (
+                i - args["first"] + 1,
+                npages,
+            )
+            html = next(texts, "")
+            xresolution, yresolution = resolutions.get(i, (None, None))
+            if len(fnames) != 1:
                 warning_flag = True
-            for fname in images:
-                regex = re.search(
-                    r"([^.]+)$", fname, re.MULTILINE | re.DOTALL | re.VERBOSE
-                )
-                if regex:
-                    ext = regex.group(1)
+            for fname in fnames:
                 try:
                     page = Page(
                         filename=fname,
                         dir=args["dir"],
-                        format=image_format[ext],
+                        format=image_format[fname.rsplit(".", 1)[-1]],
                         resolution=(xresolution, yresolution, "PixelsPerInch"),
                     )
-                    page.import_pdftotext(self._extract_text_from_pdf(request, i))
-                    request.data(
-                        {
-                            "type": "page",
-                            "row": self.add_page(page),
-                        }
-                    )
+                    page.import_pdftotext(html)
+                    self._add_imported_page(request, page)
                     os.remove(fname)
                 except (PermissionError, IOError) as err:
                     logger.error("Caught error importing PDF: %s", err)
@@ -480,34 +525,56 @@ class Importhread(BaseThread):
                     "PDF options in the Save dialogue."
                 ),
             )
-
-    def _extract_text_from_pdf(self, request, i):
-        args = request.args[0]
-        with tempfile.NamedTemporaryFile(
-            mode="w+t", dir=args["dir"], suffix=".html"
-        ) as html:
-            spo = subprocess.run(
-                _pdf_cmd_with_password(
-                    [
-                        "pdftotext",
-                        "-bbox",
-                        "-f",
-                        str(i),
-                        "-l",
-                        str(i),
-                        args["info"]["path"],
-                        html.name,
-                    ],
-                    args["password"],
-                ),
-                check=True,
-                capture_output=True,
-                text=True,
-            )
-            self.check_cancelled()
-            if spo.returncode != 0:
-                request.error(_("Error extracting text layer from PDF"))
-            return html.read()
+        return True
+
+
+def _pdfimages_by_page(proc, first, last, check_cancelled):
+    """for each page from first to last, yield the page number and the images
+    printed for it by pdfimages -p -print-filenames, once pdfimages has started
+    the next page or finished. The images are None if pdfimages failed"""
+    page, images = first, []
+    for line in proc.stdout:
+        check_cancelled()
+        fname = line.rstrip("\n")
+        regex = re.search(r"-(\d+)-\d+\.\w+$", fname)
+        if not regex:
+            continue
+        while page < int(regex.group(1)) and page <= last:
+            yield page, sorted(images)
+            page, images = page + 1, []
+        images.append(fname)
+    check_cancelled()
+    if proc.wait() != 0:
+        yield page, None
+        return
+    while page <= last:
+        yield page, sorted(images)
+        page, images = page + 1, []
+
+
+def _pdftotext_pages(lines):
+    """split the output of pdftotext -bbox into a document per page, each
+    wrapped in the html envelope that Bboxtree.from_pdftotext() expects"""
+    header, page, in_header = [], None, True
+    for line in lines:
+        if "<doc>" in line or "<page " in line:
+            in_header = False
+        if in_header:
+            header.append(line)
+        if "<page " in line:
+            page = []
+        if page is not None:
+            page.append(line)
+            if "</page>" in line:
+                if not any("<body>" in line for line in header):
+                    header = ["<html>\n", "<body>\n"]
+                yield (
+                    "".join(header)
+                    + "<doc>\n"
+                    + "".join(page)
+                    + "</doc>\n</body>\n</html>\n"
+                )
+                page = None
 
 
 def _add_metadata_to_info(info, string, regex):
@@ -533,6 +600,14 @@ def _pdf_cmd_with_password(cmd, password):
     return cmd
 
 
+def _line_buffered(cmd):
+    """pdfimages buffers its output to a pipe, so run it with stdbuf, where
+    available, to see each file name as soon as it is written"""
+    if shutil.which("stdbuf") is None:
+        return cmd
+    return ["stdbuf", "-oL", *cmd]
+
+
 def _note_callbacks(kwargs):
     callbacks = {}
     for callback in [
@@ -549,4 +624,6 @@ def _note_callbacks(kwargs):
         name = callback + "_callback"
         if name in kwargs:
             callbacks[name] = kwargs.pop(name)
+    if "return_future" in kwargs:
+        callbacks["return_future"] = kwargs.pop("return_future")
     return callbacks
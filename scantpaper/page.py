@@ -1,25 +1,21 @@
 "Class of data and methods for handling page objects"
 
-import io
 import json
 import locale
 import re
-import subprocess
 import tempfile
 import uuid
 import logging
 from PIL import Image, ImageFile
-import config
 from const import POINTS_PER_INCH, MM_PER_INCH, CM_PER_INCH
 from bboxtree import Bboxtree
 from helpers import exec_command
-import gi
+import imagecodec
+from pixbufs import image_to_pixbuf
+from gi.repository import GLib
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-gi.require_version("GdkPixbuf", "2.0")
-from gi.repository import GdkPixbuf, GLib  # pylint: disable=wrong-import-position
-
 
 PAGE_TOLERANCE = 0.02
 MODE2DEPTH = {
@@ -35,6 +31,15 @@ MODE2DEPTH = {
     "I": 32,
     "F": 32,
 }
+TIFF_COMPRESSION = {
+    "lzw": "tiff_lzw",
+    "zip": "tiff_adobe_deflate",
+    "jpeg": "jpeg",
+    "packbits": "packbits",
+    "g3": "group3",
+    "g4": "group4",
+    "none": "raw",
+}
 logger = logging.getLogger(__name__)
 
 
@@ -53,6 +58,7 @@ class Page:
     std_dev = None
     mean = None
     image_id = None
+    source = None  # original compressed bitstream, for passthrough on export
 
     def __init__(self, **kwargs):
         if ("image_object" not in kwargs and "filename" not in kwargs) or (
@@ -70,6 +76,9 @@ class Page:
 
         if "filename" in kwargs:
             self.image_object = Image.open(kwargs["filename"])
+            if _can_pass_through(self.image_object):
+                with open(kwargs["filename"], "rb") as fhd:
+                    self.source = fhd.read()
 
         # set this before setting attributes from kwargs in order to reuse uuid
         # if necessary. Therefore, the uuid tracks the page through import,
@@ -90,16 +99,19 @@ class Page:
             self.uuid,
         )
 
-    def to_bytes(self):
+    def to_bytes(self, codec="png", level=None):
         "return the image as bytes, e.g. suitable for storing as a blob in SQLite"
-        img_byte_arr = io.BytesIO()
-        self.image_object.save(img_byte_arr, format="PNG")
-        return img_byte_arr.getvalue()
+        return imagecodec.encode(self.image_object, codec, level)
 
     @classmethod
     def from_bytes(cls, blob, **kwargs):
         "create a page from bytes"
-        page = Page(image_object=Image.open(io.BytesIO(blob)))
+        return cls.from_image(imagecodec.decode(blob), **kwargs)
+
+    @classmethod
+    def from_image(cls, image, **kwargs):
+        "create a page from a decoded image and the metadata stored with it"
+        page = Page(image_object=image)
         page.get_size()
         for key in [
             "id",
@@ -272,30 +284,11 @@ class Page:
         if self.image_object is None:
             logger.warning("Cannot get pixbuf from None")
             return None
-        # TODO: This doesn't work, probably because I didn't test it with an RGB image,
-        # but would be a better solution
-        # width, height = self.image_object.size
-        # return GdkPixbuf.Pixbuf.new_from_bytes(
-        #     GLib.Bytes.new(self.image_object.tobytes()),
-        #     GdkPixbuf.Colorspace.RGB,
-        #     False,
-        #     8,
-        #     width,
-        #     height,
-        #     width * 3,
-        # )
-        with tempfile.NamedTemporaryFile(dir=self.dir, suffix=".png") as filename:
-            # Force PIL to load the data before the file is deleted.
-            # The upgrade to gdk-pixbuf 2.44.5+dfsg-3/4 without this threw
-            # "contains no data", caused by a race condition where PIL attempted
-            # to lazy-load data from a deleted temporary file.
-            self.image_object.load()
-            self.image_object.save(filename.name)
-            pixbuf = None
-            try:
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename.name)
-            except (GLib.Error, TypeError) as exc:
-                logger.warning("Caught error getting pixbuf: %s", exc)
+        pixbuf = None
+        try:
+            pixbuf = image_to_pixbuf(self.image_object)
+        except (GLib.Error, TypeError, ValueError) as exc:
+            logger.warning("Caught error getting pixbuf: %s", exc)
         return pixbuf
 
     def get_pixbuf_at_scale(self, max_width, max_height):
@@ -312,19 +305,10 @@ class Page:
             width, height, xresolution / yresolution, max_width, max_height
         )
         pixbuf = None
-        with tempfile.NamedTemporaryFile(dir=self.dir, suffix=".png") as filename:
-            # Force PIL to load the data before the file is deleted.
-            # The upgrade to gdk-pixbuf 2.44.5+dfsg-3/4 without this threw
-            # "contains no data", caused by a race condition where PIL attempted
-            # to lazy-load data from a deleted temporary file.
-            self.image_object.load()
-            self.image_object.save(filename.name)
-            try:
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
-                    filename.name, width, height, False
-                )
-            except (GLib.Error, TypeError) as exc:
-                logger.warning("Caught error getting pixbuf: %s", exc)
+        try:
+            pixbuf = image_to_pixbuf(self.image_object, width, height)
+        except (GLib.Error, TypeError, ValueError) as exc:
+            logger.warning("Caught error getting pixbuf: %s", exc)
         return pixbuf
 
     def get_depth(self):
@@ -347,8 +331,9 @@ class Page:
             )
         return xresolution, self.image_object
 
-    def write_image_for_pdf(self, filename, options):
-        "write the image as a PNG file"
+    def write_image_for_pdf(self, filename, options, source=None):
+        """write the image as a PNG file, or write source, the original
+        compressed bitstream of the image, if the image needs no changes"""
         image = self.image_object
         if (
             options
@@ -386,6 +371,10 @@ class Page:
             # To mono
             image = image.convert("1")
 
+        if source is not None and image is self.image_object:
+            with open(filename, "wb") as fhd:
+                fhd.write(source)
+            return
         xresolution, yresolution, _units = self.get_resolution()
         image.save(filename, dpi=(xresolution, yresolution))
 
@@ -419,96 +408,70 @@ class Page:
                     tempimage.name,
                     filename,
                 ],
-                options["pidfile"],
+                options.get("pidfile"),
+                options.get("pids"),
             )
-            self._add_txt_to_djvu(filename, options.get("dir"))
-            self._add_ann_to_djvu(filename, options.get("dir"))
 
-    def _add_txt_to_djvu(self, djvu, dirname):
-        if self.text_layer is not None:
-            try:
-                txt = self.export_djvu_txt()
-            except json.decoder.JSONDecodeError:
-                return
-            logger.debug(txt)
-
-            # Write djvusedtxtfile
-            with tempfile.NamedTemporaryFile(
-                mode="wt", dir=dirname, suffix=".txt"
-            ) as fhd:
-                fhd.write(txt)
-                fhd.flush()
-
-                # Run djvusedtxtfile
-                cmd = [
-                    "djvused",
-                    djvu,
-                    "-e",
-                    f"select 1; set-txt {fhd.name}",
-                    "-s",
-                ]
-                logger.info(cmd)
-                subprocess.run(cmd, check=True)
-
-    def _add_ann_to_djvu(self, djvu, dirname):
-        "FIXME - refactor this together with _add_txt_to_djvu"
-        if self.annotations is not None:
+    def djvused_script(self):
+        """return djvused commands setting the text and annotation layers of
+        the selected page, with the layers inline, each terminated by a line
+        containing a single period"""
+        script = ""
+        for command, export in (
+            ("set-txt", self.export_djvu_txt),
+            ("set-ant", self.export_djvu_ann),
+        ):
             try:
-                ann = self.export_djvu_ann()
+                layer = export()
             except json.decoder.JSONDecodeError:
-                return
-            logger.debug(ann)
-
-            # Write djvusedtxtfile
-            with tempfile.NamedTemporaryFile(
-                mode="w", dir=dirname, suffix=".txt"
-            ) as fhd:
-                fhd.write(ann)
-                fhd.flush()
-
-                # Run djvusedtxtfile
-                cmd = [
-                    "djvused",
-                    djvu,
-                    "-e",
-                    f"select 1; set-ant {fhd.name}",
-                    "-s",
-                ]
-                logger.info(cmd)
-                subprocess.run(cmd, check=True)
+                continue
+            if layer:
+                logger.debug(layer)
+                script += f"{command}\n{layer.rstrip()}\n.\n"
+        return script
 
     def write_image_for_tiff(self, filename, options):
-        "Save the image as a TIFF file."
-        with tempfile.NamedTemporaryFile(
-            dir=options.get("dir"), suffix=".tif"
-        ) as infile:
-            self.image_object.save(infile.name)
-            xresolution, yresolution, units = self.resolution
-
-            # Convert to tiff
-            depth = []
-            if "compression" in options["options"]:
-                if options["options"]["compression"] == "jpeg":
-                    depth = ["-depth", "8"]
-
-                elif re.search(
-                    r"g[34]",
-                    options["options"]["compression"],
-                    re.MULTILINE | re.DOTALL | re.VERBOSE,
-                ):
-                    depth = ["-threshold", "40%", "-depth", "1"]
-
-            cmd = [
-                config.CONVERT_COMMAND,
-                infile.name,
-                "-units",
-                units,
-                "-density",
-                f"{xresolution}x{yresolution}",
-                *depth,
-                filename,
-            ]
-            subprocess.run(cmd, check=True)
+        "Save the image as a TIFF file, or to a file object."
+        image = self.image_object
+        compression = options["options"].get("compression", "none")
+        kwargs = {"compression": TIFF_COMPRESSION.get(compression, "raw")}
+        if compression == "jpeg":
+            # 8 bits per sample
+            if image.mode not in ("L", "RGB"):
+                image = image.convert("L" if image.mode == "1" else "RGB")
+            if "quality" in options["options"]:
+                kwargs["quality"] = options["options"]["quality"]
+        elif compression in ("g3", "g4"):
+            # Grayscale
+            image = image.convert("L")
+            # Threshold
+            threshold = 0.4 * 255
+            image = image.point(lambda p: 255 if p > threshold else 0)
+            # To mono
+            image = image.convert("1")
+
+        xresolution, yresolution, units = self.resolution
+        image.save(
+            filename,
+            format="TIFF",
+            x_resolution=xresolution,
+            y_resolution=yresolution,
+            resolution_unit=3 if units == "PixelsPerCentimeter" else 2,
+            **kwargs,
+        )
+
+
+def _can_pass_through(image):
+    """whether the file the image was opened from can be embedded in a PDF
+    without decoding it"""
+    if image.mode not in ("1", "L", "RGB", "CMYK"):
+        return False
+    if image.format == "TIFF":
+        return (
+            image.info.get("compression") == "group4"
+            and getattr(image, "n_frames", 1) == 1
+        )
+    return image.format in ("JPEG", "JPEG2000")
 
 
 def _prepare_scale(image_width, image_height, res_ratio, max_width, max_height):
@@ -0,0 +1,126 @@
+"""Add invisible text layers to the pages of a PDF, so that it is searchable.
+
+The text is drawn in rendering mode 3 (invisible) with a glyphless Type 0 font
+whose character codes are the UTF-16 code units of the text, so that it can be
+extracted via the ToUnicode CMap without embedding a font program. The content
+streams are built in pixel coordinates, independently of the PDF, so that the
+pages can be rendered in parallel."""
+
+import pikepdf
+from bboxtree import Bboxtree
+
+GLYPH_WIDTH = 500  # thousandths of an em, the width of every glyph
+FONT = pikepdf.Name("/FGlyphLess")
+TOUNICODE = b"""/CIDInit /ProcSet findresource begin
+12 dict begin
+begincmap
+/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def
+/CMapName /Adobe-Identity-UCS def
+/CMapType 2 def
+1 begincodespacerange
+<0000> <FFFF>
+endcodespacerange
+1 beginbfrange
+<0000> <FFFF> <0000>
+endbfrange
+endcmap
+CMapName currentdict /CMap defineresource pop
+end
+end
+"""
+
+
+def text_stream(text_layer, height):
+    """return a content stream drawing the text of the bboxtree JSON
+    text_layer invisibly in pixel coordinates, on a page height pixels high,
+    or None if there is no text"""
+    if not text_layer:
+        return None
+    commands = []
+    for bbox in Bboxtree(text_layer).each_bbox():
+        if not bbox.get("text", "").strip():
+            continue
+        x_1, y_1, x_2, y_2 = bbox["bbox"]
+        lines = bbox["text"].strip().splitlines()
+        size = (y_2 - y_1) / len(lines)
+        if size <= 0 or x_2 <= x_1:
+            continue
+        for i, line in enumerate(lines):
+            line = line.strip()
+            if not line:
+                continue
+            # stretch the glyphs to fill the width of the box. The trailing
+            # space separates words when extracting the text. Each glyph is a
+            # UTF-16 code unit, so characters outside the BMP take two
+            codes = (line + " ").encode("utf-16-be")
+            scale = 100 * (x_2 - x_1) / (len(codes) / 2 * size * GLYPH_WIDTH / 1000)
+            commands.append(
+                f"{FONT} {size:.2f} Tf {scale:.2f} Tz "
+                f"1 0 0 1 {x_1} {height - y_1 - (i + 1) * size:.2f} Tm "
+                f"<{codes.hex()}> Tj"
+            )
+    if not commands:
+        return None
+    return ("BT 3 Tr\n" + "\n".join(commands) + "\nET\n").encode("ascii")
+
+
+def add_text_layers(pdf, layers):
+    """add the text layers to the pages of the pikepdf pdf. layers is a list
+    with an item for each page, either None or a tuple of the content stream
+    from text_stream() and the width and height in pixels it was drawn for"""
+    font = None
+    for page, layer in zip(pdf.pages, layers):
+        if layer is None or layer[0] is None:
+            continue
+        if font is None:
+            font = _glyphless_font(pdf)
+        stream, width, height = layer
+        _x_0, _y_0, x_1, y_1 = (float(value) for value in page.mediabox)
+        page.add_resource(font, pikepdf.Name.Font, FONT)
+        page.contents_add(
+            f"q {x_1 / width:.6f} 0 0 {y_1 / height:.6f} 0 0 cm\n".encode("ascii")
+            + stream
+            + b"Q\n"
+        )
+
+
+def _glyphless_font(pdf):
+    "return a Type 0 font with no glyphs, mapping each code to its code point"
+    descriptor = pdf.make_indirect(
+        pikepdf.Dictionary(
+            Type=pikepdf.Name.FontDescriptor,
+            FontName=pikepdf.Name.GlyphLessFont,
+            Flags=5,  # fixed pitch, symbolic
+            FontBBox=[0, 0, GLYPH_WIDTH, 1000],
+            ItalicAngle=0,
+            Ascent=1000,
+            Descent=0,
+            CapHeight=1000,
+            StemV=80,
+        )
+    )
+    descendant = pdf.make_indirect(
+        pikepdf.Dictionary(
+            Type=pikepdf.Name.Font,
+            Subtype=pikepdf.Name.CIDFontType2,
+            BaseFont=pikepdf.Name.GlyphLessFont,
+            CIDSystemInfo=pikepdf.Dictionary(
+                Registry=pikepdf.String("Adobe"),
+                Ordering=pikepdf.String("Identity"),
+                Supplement=0,
+            ),
+            FontDescriptor=descriptor,
+            DW=GLYPH_WIDTH,
+            CIDToGIDMap=pikepdf.Name.Identity,
+        )
+    )
+    return pdf.make_indirect(
+        pikepdf.Dictionary(
+            Type=pikepdf.Name.Font,
+            Subtype=pikepdf.Name.Type0,
+            BaseFont=pikepdf.Name.GlyphLessFont,
+            Encoding=pikepdf.Name("/Identity-H"),
+            DescendantFonts=[descendant],
+            ToUnicode=pdf.make_stream(TOUNICODE),
+        )
+    )
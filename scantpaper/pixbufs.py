@@ -0,0 +1,59 @@
+"In-memory conversion between PIL images and GdkPixbufs, without temporary files"
+
+import logging
+from PIL import Image
+import gi
+
+gi.require_version("GdkPixbuf", "2.0")
+from gi.repository import GdkPixbuf, GLib  # pylint: disable=wrong-import-position
+
+logger = logging.getLogger(__name__)
+
+
+def _to_pixbuf_mode(image):
+    """return the image converted to L, RGB or RGBA, i.e. something that
+    is either a pixbuf format, or can be scaled before becoming one"""
+    if image.mode in ("L", "RGB", "RGBA"):
+        return image
+    if image.mode in ("LA", "PA", "RGBa", "La") or (
+        image.mode == "P" and "transparency" in image.info
+    ):
+        return image.convert("RGBA")
+    if image.mode in ("I", "I;16", "I;16B", "I;16L", "I;16N"):
+        # scale 16-bit to 8-bit, as gdk-pixbuf does when loading 16-bit PNGs
+        return image.convert("I").point(lambda i: i * (1 / 256)).convert("L")
+    if image.mode in ("1", "F"):
+        return image.convert("L")
+    return image.convert("RGB")
+
+
+def image_to_pixbuf(image, width=None, height=None):
+    """return a pixbuf of the PIL image, optionally scaled to the given width
+    and height"""
+    image = _to_pixbuf_mode(image)
+    if width is not None and height is not None:
+        image = image.resize(
+            (max(1, round(width)), max(1, round(height))),
+            Image.Resampling.BILINEAR,
+            reducing_gap=2.0,
+        )
+    if image.mode == "L":
+        image = image.convert("RGB")
+    has_alpha = image.mode == "RGBA"
+    return GdkPixbuf.Pixbuf.new_from_bytes(
+        GLib.Bytes.new(image.tobytes()),
+        GdkPixbuf.Colorspace.RGB,
+        has_alpha,
+        8,
+        image.width,
+        image.height,
+        image.width * (4 if has_alpha else 3),
+    )
+
+
+def bytes_to_pixbuf(blob):
+    "return a pixbuf from an encoded image, e.g. a PNG thumbnail"
+    loader = GdkPixbuf.PixbufLoader()
+    loader.write(blob)
+    loader.close()
+    return loader.get_pixbuf()
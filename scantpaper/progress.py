@@ -64,7 +64,11 @@ class Progress(Gtk.Box):
 
     def update(self, response):
         "Helper function to update progress bar"
-        if response and response.total_jobs:
+        if response and isinstance(response.info, dict) and "progress" in response.info:
+            # progress through the pages of a single request
+            self.set_text(response.info["message"])
+            self.set_fraction(response.info["progress"])
+        elif response and response.total_jobs:
             if response.request.process:
                 # if  "message"  in options :
                 #     options["process"] += f" - {options['message']}"
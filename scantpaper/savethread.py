@@ -1,23 +1,27 @@
 "Threading model for the Document class"
 
-from collections import defaultdict
+from collections import defaultdict, deque
+import concurrent.futures
+import functools
 import pathlib
 import re
 import logging
 import subprocess
 import datetime
+import io
 import os
 import tempfile
 import shutil
-from PIL import Image
+from PIL import Image, TiffImagePlugin
 import img2pdf
-import ocrmypdf
+import pikepdf
 from const import VERSION, POINTS_PER_INCH, ANNOTATION_COLOR
 from importthread import Importhread, _note_callbacks
 from i18n import _
 from helpers import exec_command
 from bboxtree import Bboxtree
 from page import Page
+import pdftext
 from basethread import Request
 
 logger = logging.getLogger(__name__)
@@ -33,6 +37,41 @@ BOTTOM = 3
 class SaveThread(Importhread):
     "subclass basethread for document"
 
+    processes = os.cpu_count() or 1
+
+    def _map_in_threads(self, jobs, func, callback, workers=None):
+        """call func with each tuple of args from jobs in a pool of worker
+        threads, passing the number of jobs done, the args and the result to
+        callback in order. The jobs are taken from the iterable in this thread
+        after running any interactive requests, with at most two per worker in
+        memory"""
+        if workers is None:
+            workers = self.processes
+        jobs = iter(jobs)
+        pending = deque()
+        done = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    while len(pending) >= 2 * workers:
+                        args, future = pending.popleft()
+                        done += 1
+                        callback(done, args, future.result())
+                    self.yield_to_interactive()
+                    self.check_cancelled()
+                    args = next(jobs, None)
+                    if args is None:
+                        break
+                    pending.append((args, executor.submit(func, *args)))
+                while pending:
+                    args, future = pending.popleft()
+                    done += 1
+                    callback(done, args, future.result())
+            except BaseException:
+                for _args, future in pending:
+                    future.cancel()
+                raise
+
     def save_pdf(self, **kwargs):
         "save pdf"
         callbacks = _note_callbacks(kwargs)
@@ -57,59 +96,43 @@ class SaveThread(Importhread):
             if "metadata" in options and "ps" not in options:
                 metadata = prepare_output_metadata("PDF", options["metadata"])
 
-            list_of_pages = []
-            with open(
-                outdir / "origin_pre.pdf", "wb", buffering=0
-            ) as fhd:  # turn off buffering
-                filenames = []
-                resolutions = []
+            npages = len(options["list_of_pages"])
+            filenames, resolutions, layers = [], [], []
+
+            def read_pages():
                 for page_id in options["list_of_pages"]:
                     page = self.get_page(id=page_id)
-                    list_of_pages.append(page)
-
-                    # store the filename and not the tempfile object to avoid potentially
-                    # holding many open filehandles
-                    with tempfile.NamedTemporaryFile(
-                        dir=options.get("dir"), suffix=".png", delete=False
-                    ) as tmp:
-                        page.write_image_for_pdf(tmp.name, options)
-                        filenames.append(tmp.name)
                     xres, yres, _units = page.get_resolution(self.paper_sizes)
                     resolutions.append((xres, yres))
-                index = 0
-
-                def layout_fun(imgwidthpx, imgheightpx, _ndpi):
-                    nonlocal index
-                    xres, yres = resolutions[index]
-                    index += 1
-                    pagewidth = imgwidthpdf = img2pdf.px_to_pt(imgwidthpx, xres)
-                    pageheight = imgheightpdf = img2pdf.px_to_pt(imgheightpx, yres)
-                    return pagewidth, pageheight, imgwidthpdf, imgheightpdf
-
-                metadata["layout_fun"] = layout_fun
-                fhd.write(img2pdf.convert(filenames, **metadata))
-                for fname in filenames:
-                    os.remove(fname)
-            ocrmypdf.api._pdf_to_hocr(
-                outdir / "origin_pre.pdf",
-                outdir,
-                language="eng",
-                skip_text=True,
+                    filenames.append(str(outdir / f"{len(filenames) + 1:06}.png"))
+                    yield page, filenames[-1], options, self._image_source(page)
+
+            # the images are written and the text layers rendered in parallel
+            self._map_in_threads(
+                read_pages(),
+                self._write_page_for_pdf,
+                functools.partial(self._add_pdf_layer, layers, npages),
             )
-            for pagenr, page in enumerate(list_of_pages):
-                if page.text_layer:
-                    with open(
-                        outdir / f"{pagenr+1:-06}_ocr_hocr.hocr", "w", encoding="utf-8"
-                    ) as fhd:
-                        fhd.write(page.export_hocr())
-                self.progress = pagenr / (len(options["list_of_pages"]) + 1)
-                self.message = _("Saving page %i of %i") % (
-                    pagenr,
-                    len(list_of_pages),
-                )
-                self.check_cancelled()
-
-            ocrmypdf.api._hocr_to_ocr_pdf(outdir, filename, optimize=0)
+            self.progress = 1
+            index = 0
+
+            def layout_fun(imgwidthpx, imgheightpx, _ndpi):
+                nonlocal index
+                xres, yres = resolutions[index]
+                index += 1
+                pagewidth = imgwidthpdf = img2pdf.px_to_pt(imgwidthpx, xres)
+                pageheight = imgheightpdf = img2pdf.px_to_pt(imgheightpx, yres)
+                return pagewidth, pageheight, imgwidthpdf, imgheightpdf
+
+            metadata["layout_fun"] = layout_fun
+            # the pages are shown without their EXIF rotation
+            metadata["rotation"] = img2pdf.Rotation.none
+            with pikepdf.open(
+                io.BytesIO(img2pdf.convert(filenames, **metadata))
+            ) as pdf:
+                pdftext.add_text_layers(pdf, layers)
+                pdf.save(filename)
+            self.check_cancelled()
 
             _append_pdf(filename, options, request)
 
@@ -137,6 +160,26 @@ class SaveThread(Importhread):
                 Request("set_saved", (options["list_of_pages"], True), self.responses)
             )
 
+    def _write_page_for_pdf(self, page, filename, options, source):
+        "write the image and render the text layer of a page, in a worker thread"
+        self.check_cancelled()
+        page.write_image_for_pdf(filename, options, source)
+        return (
+            pdftext.text_stream(page.text_layer, page.height),
+            page.width,
+            page.height,
+        )
+
+    def _add_pdf_layer(self, layers, npages, done, _args, layer):
+        "collect the text layer of a written page, and report progress"
+        layers.append(layer)
+        self.progress = done / (npages + 1)
+        self.message = _("Saving page %i of %i") % (done, npages)
+
+    def _image_source(self, _page):
+        "return the original compressed bitstream of the image of the page"
+        return None
+
     def save_djvu(self, **kwargs):
         "save DjvU"
         callbacks = _note_callbacks(kwargs)
@@ -145,32 +188,33 @@ class SaveThread(Importhread):
     def do_save_djvu(self, request):
         "save DjvU in thread"
         args = request.args[0]
-        i = 0
+        npages = len(args["list_of_pages"])
         filelist = []
-        for page_id in args["list_of_pages"]:
-            page = self.get_page(id=page_id)
-            i += 1
-            self.progress = i / (len(args["list_of_pages"]) + 1)
-            self.message = _("Writing page %i of %i") % (
-                i,
-                len(args["list_of_pages"]),
+        scripts = []
+
+        def read_pages():
+            for page_id in args["list_of_pages"]:
+                page = self.get_page(id=page_id)
+                scripts.append(page.djvused_script())
+                with tempfile.NamedTemporaryFile(
+                    dir=args.get("dir"), suffix=".djvu", delete=False
+                ) as djvu:
+                    filelist.append(djvu.name)
+                yield page, djvu.name, args
+
+        # the pages are read from the database in this thread and encoded by
+        # c44/cjb2 in parallel
+        try:
+            self._map_in_threads(
+                read_pages(),
+                self._write_page_for_djvu,
+                functools.partial(self._report_djvu_page, npages),
             )
-            with tempfile.NamedTemporaryFile(
-                dir=args.get("dir"), suffix=".djvu", delete=False
-            ) as djvu:
-                # logger.error("Caught error writing DjVu: %s", err)
-                # self._thread_throw_error(
-                #     args["uuid"],
-                #     args["page"]["uuid"],
-                #     "Save file",
-                #     f"Caught error writing DjVu: {_}.",
-                # )
-                # error = True
-
-                # if error:
-                #     return
-                page.write_image_for_djvu(djvu.name, args)
-                filelist.append(djvu.name)
+        except BaseException:
+            for filename in filelist:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            raise
 
         self.progress = 1
         self.message = _("Merging DjVu")
@@ -182,63 +226,49 @@ class SaveThread(Importhread):
             logger.error("Error merging DjVu")
             request.error(_("Error merging DjVu"))
 
-        self._add_metadata_to_djvu(args)
+        self._add_layers_to_djvu(args, scripts)
         _set_timestamp(args)
         _post_save_hook(args["path"], args.get("options"))
         self.do_set_saved(
             Request("set_saved", (args["list_of_pages"], True), self.responses)
         )
 
-    def _add_metadata_to_djvu(self, options):
-        if "metadata" in options and options["metadata"] is not None:
-            metadata = prepare_output_metadata("DjVu", options["metadata"])
-
-            # Write djvusedmetafile
-            with tempfile.NamedTemporaryFile(
-                mode="wt", dir=options.get("dir"), suffix=".txt"
-            ) as fhd:
-                fhd.write("(metadata\n")
-
-                # Write the metadata
-                for key, val in metadata.items():
-                    if val is not None:
-
-                        # backslash-escape any double quotes and bashslashes
-                        val = re.sub(
-                            r"\\",
-                            r"\\\\",
-                            val,
-                            flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-                        )
-                        val = re.sub(
-                            r"\"",
-                            r"\\\"",
-                            val,
-                            flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-                        )
-                        fhd.write(f'{key} "{val}"\n')
-
-                fhd.write(")\n")
-                fhd.flush()
-
-                # Write djvusedmetafile
-                cmd = [
-                    "djvused",
-                    "-e",
-                    f'"set-meta" {fhd.name}',
-                    options["path"],
-                    "-s",
-                ]
-                subprocess.run(cmd, check=True)
-                self.check_cancelled()
-                # if status:
-                #     logger.error("Error adding metadata info to DjVu file")
-                #     self._thread_throw_error(
-                #         options["uuid"],
-                #         options["page"]["uuid"],
-                #         "Save file",
-                #         _("Error adding metadata to DjVu"),
-                #     )
+    def _write_page_for_djvu(self, page, filename, options):
+        """encode a page as DjVu, in a worker thread. The encoders run in
+        parallel, so their PIDs are kept in running_pids, not the pidfile"""
+        self.check_cancelled()
+        page.write_image_for_djvu(
+            filename, {**options, "pidfile": None, "pids": self.running_pids}
+        )
+
+    def _report_djvu_page(self, npages, done, _args, _result):
+        "report progress once a page has been encoded"
+        self.progress = done / (npages + 1)
+        self.message = _("Writing page %i of %i") % (done, npages)
+
+    def _add_layers_to_djvu(self, options, scripts):
+        """set the text and annotation layers of every page and the metadata
+        of the merged document with a single djvused script"""
+        script = ""
+        for number, page_script in enumerate(scripts, start=1):
+            if page_script:
+                script += f"select {number}\n{page_script}"
+        metadata = _djvu_metadata(options)
+        if metadata:
+            script += f"select\nset-meta\n{metadata}.\n"
+        if not script:
+            return
+        logger.debug(script)
+
+        with tempfile.NamedTemporaryFile(
+            mode="wt", dir=options.get("dir"), suffix=".txt"
+        ) as fhd:
+            fhd.write(script)
+            fhd.flush()
+            cmd = ["djvused", options["path"], "-f", fhd.name, "-s"]
+            logger.info(cmd)
+            subprocess.run(cmd, check=True)
+        self.check_cancelled()
 
     def save_tiff(self, **kwargs):
         "save TIFF"
@@ -249,56 +279,25 @@ class SaveThread(Importhread):
         "save TIFF in thread"
         options = request.args[0]
 
-        i = 0
-        filelist = []
-        for page_id in options["list_of_pages"]:
-            page = self.get_page(id=page_id)
-            self.progress = i / (len(options["list_of_pages"]) + 1)
-            i += 1
-            # self.message = _("Converting image %i of %i to TIFF") % (
-            #     page,
-            #     len(options["list_of_pages"]) - 1 + 1,
-            # )
-            with tempfile.NamedTemporaryFile(
-                dir=options.get("dir"), suffix=".tif", delete=False
-            ) as out:
-                page.write_image_for_tiff(out.name, options)
-                self.check_cancelled()
-                # if status:
-                #     logger.error("Error writing TIFF")
-                #     self._thread_throw_error(
-                #         options["uuid"],
-                #         options["page"]["uuid"],
-                #         "Save file",
-                #         _("Error writing TIFF"),
-                #     )
-                #     return
-                filelist.append(out.name)
-
-        compression = []
-        if "compression" in options["options"]:
-            compression = ["-c", options["options"]["compression"]]
-            if options["options"]["compression"] == "jpeg":
-                compression[1] += f":{options['options']['quality']}"
-                compression.append(["-r", "16"])
-
-        # Create the tiff
+        npages = len(options["list_of_pages"])
+
+        # the pages are encoded in parallel, each exactly once, and appended
+        # to the TIFF in page order
+        try:
+            with TiffImagePlugin.AppendingTiffWriter(options["path"], new=True) as tiff:
+                self._map_in_threads(
+                    (
+                        (self.get_page(id=page_id), options)
+                        for page_id in options["list_of_pages"]
+                    ),
+                    self._encode_page_for_tiff,
+                    functools.partial(self._append_page_to_tiff, tiff, npages),
+                )
+        except BaseException:
+            if os.path.exists(options["path"]):
+                os.remove(options["path"])
+            raise
         self.progress = 1
-        # self.message = _("Concatenating TIFFs")
-        cmd = ["tiffcp", *compression, *filelist, options["path"]]
-        subprocess.run(cmd, check=True)
-        for filename in filelist:
-            os.remove(filename)
-        self.check_cancelled()
-        # if status or error != EMPTY:
-        #     logger.info(error)
-        #     self._thread_throw_error(
-        #         options["uuid"],
-        #         options["page"]["uuid"],
-        #         "Save file",
-        #         _("Error compressing image: %s") % (error),
-        #     )
-        #     return
 
         if "ps" in options["options"] and options["options"]["ps"] is not None:
             # self.message = _("Converting to PS")
@@ -318,6 +317,19 @@ class SaveThread(Importhread):
             Request("set_saved", (options["list_of_pages"], True), self.responses)
         )
 
+    def _encode_page_for_tiff(self, page, options):
+        "encode a page as a single-page TIFF, in a worker thread"
+        self.check_cancelled()
+        with io.BytesIO() as fhd:
+            page.write_image_for_tiff(fhd, options)
+            return fhd.getvalue()
+
+    def _append_page_to_tiff(self, tiff, npages, done, _args, data):
+        "append a page that has been encoded to the TIFF, and report progress"
+        tiff.write(data)
+        tiff.newFrame()
+        self.progress = done / (npages + 1)
+
     def save_image(self, **kwargs):
         "save pages as image files"
         callbacks = _note_callbacks(kwargs)
@@ -415,93 +427,42 @@ class SaveThread(Importhread):
         "run user defined command on page in thread"
         options = request.args[0]
         try:
-            with tempfile.NamedTemporaryFile(
-                dir=options.get("dir"), suffix=".png"
-            ) as infile, tempfile.NamedTemporaryFile(
-                dir=options.get("dir"), suffix=".png"
-            ) as out:
-                page = self.get_page(id=options["page"])
-                page.image_object.save(infile.name)
-                command = options["command"]
-                if re.search("%o", command):
-                    command = re.sub(
-                        r"%o",
-                        out.name,
-                        command,
-                        flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-                    )
-                    command = re.sub(
-                        r"%i",
-                        infile.name,
-                        command,
-                        flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-                    )
-
-                else:
-                    if not shutil.copy2(infile.name, out.name):
-                        request.error(_("Error copying page"))
-                        return
-
-                    command = re.sub(
-                        r"%i",
-                        out.name,
-                        command,
-                        flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-                    )
-
-                command = re.sub(
-                    r"%r",
-                    rf"{page.resolution[0]}",
-                    command,
-                    flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-                )
-                # options["command"] = options["command"].split(" ")
-                sbp = subprocess.run(
-                    command,
-                    capture_output=True,
-                    check=True,
-                    text=True,
-                    shell=True,
-                )
-                self.check_cancelled()
-                logger.info("stdout: %s", sbp.stdout)
-                logger.info("stderr: %s", sbp.stderr)
-
-                # don't return in here, just in case we can ignore the error -
-                # e.g. theming errors from gimp
-                if sbp.stderr != "":
-                    request.data(
-                        {"type": "message", "info": sbp.stderr}
-                        # options["uuid"],
-                        # options["page"].uuid,
-                        # "user-defined",
-                    )
-
-                # Get file type
-                image = Image.open(out.name)
-                # Force PIL to load the data before the file is deleted.
-                # The upgrade to gdk-pixbuf 2.44.5+dfsg-3/4 without this threw
-                # "contains no data", caused by a race condition where PIL attempted
-                # to lazy-load data from a deleted temporary file.
-                image.load()
-
-                # assume the resolution hasn't changed
-                new = Page(
-                    image_object=image,
-                    dir=options.get("dir"),
-                    format=image.format,
-                    resolution=page.resolution,
-                    text_layer=page.text_layer,
-                )
-                row = self.replace_page(new, self.find_page_number_by_page_id(page.id))
+            page = self.get_page(id=options["page"])
+            image, stderr = _run_user_defined(
+                options["command"],
+                page.image_object,
+                page.resolution,
+                options.get("dir"),
+            )
+            self.check_cancelled()
+
+            # don't return in here, just in case we can ignore the error -
+            # e.g. theming errors from gimp
+            if stderr != "":
                 request.data(
-                    {
-                        "type": "page",
-                        "row": row,
-                        "replace": page.id,
-                    }
+                    {"type": "message", "info": stderr}
+                    # options["uuid"],
+                    # options["page"].uuid,
+                    # "user-defined",
                 )
 
+            # assume the resolution hasn't changed
+            new = Page(
+                image_object=image,
+                dir=options.get("dir"),
+                format=image.format,
+                resolution=page.resolution,
+                text_layer=page.text_layer,
+            )
+            row = self.replace_page(new, self.find_page_number_by_page_id(page.id))
+            request.data(
+                {
+                    "type": "page",
+                    "row": row,
+                    "replace": page.id,
+                }
+            )
+
         except (PermissionError, IOError) as err:
             logger.error("Error creating file in %s: %s", options.get("dir"), err)
             request.error(
@@ -509,6 +470,64 @@ class SaveThread(Importhread):
             )
 
 
+def _run_user_defined(command, image, resolution, dirname):
+    """run the user defined command on the image, returning the new image and
+    anything written to stderr"""
+    with tempfile.NamedTemporaryFile(
+        dir=dirname, suffix=".png"
+    ) as infile, tempfile.NamedTemporaryFile(dir=dirname, suffix=".png") as out:
+        image.save(infile.name)
+        if re.search("%o", command):
+            command = re.sub(
+                r"%o",
+                out.name,
+                command,
+                flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
+            )
+            command = re.sub(
+                r"%i",
+                infile.name,
+                command,
+                flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
+            )
+
+        else:
+            if not shutil.copy2(infile.name, out.name):
+                raise IOError(_("Error copying page"))
+            command = re.sub(
+                r"%i",
+                out.name,
+                command,
+                flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
+            )
+
+        command = re.sub(
+            r"%r",
+            rf"{resolution[0]}",
+            command,
+            flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
+        )
+        # options["command"] = options["command"].split(" ")
+        sbp = subprocess.run(
+            command,
+            capture_output=True,
+            check=True,
+            text=True,
+            shell=True,
+        )
+        logger.info("stdout: %s", sbp.stdout)
+        logger.info("stderr: %s", sbp.stderr)
+
+        # Get file type
+        image = Image.open(out.name)
+        # Force PIL to load the data before the file is deleted.
+        # The upgrade to gdk-pixbuf 2.44.5+dfsg-3/4 without this threw
+        # "contains no data", caused by a race condition where PIL attempted
+        # to lazy-load data from a deleted temporary file.
+        image.load()
+    return image, sbp.stderr
+
+
 def _need_temp_pdf(options):
     return options and (
         "prepend" in options
@@ -572,6 +591,32 @@ def _append_pdf(filename, options, request):
     return proc.returncode
 
 
+def _djvu_metadata(options):
+    "return the metadata in djvused set-meta format, or None"
+    if "metadata" not in options or options["metadata"] is None:
+        return None
+    metadata = prepare_output_metadata("DjVu", options["metadata"])
+    text = "(metadata\n"
+    for key, val in metadata.items():
+        if val is not None:
+
+            # backslash-escape any double quotes and bashslashes
+            val = re.sub(
+                r"\\",
+                r"\\\\",
+                val,
+                flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
+            )
+            val = re.sub(
+                r"\"",
+                r"\\\"",
+                val,
+                flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
+            )
+            text += f'{key} "{val}"\n'
+    return text + ")\n"
+
+
 def _set_timestamp(options):
     if (
         not options.get("options")
@@ -45,6 +45,7 @@ class ScanMenuItemMixins:
             "document": self.slist,
             "ignore_duplex_capabilities": self.settings["ignore-duplex-capabilities"],
             "cycle_sane_handle": self.settings["cycle sane handle"],
+            "scan_spool_size": self.settings["scan spool size"],
             "cancel_between_pages": (
                 self.settings["allow-batch-flatbed"]
                 and self.settings["cancel-between-pages"]
@@ -352,42 +353,61 @@ class ScanMenuItemMixins:
         self.settings["profile"][name] = profile.get()
 
     def _new_scan_callback(
-        self, _widget, image_object, page_number, xresolution, yresolution
+        self, widget, image_object, page_number, xresolution, yresolution
     ):
         "Callback function to handle a new scan."
-        if image_object is None:
-            return
-
-        rotate = (
-            self.settings["rotate facing"]
-            if page_number % 2
-            else self.settings["rotate reverse"]
-        )
-        options = {
-            "page": page_number,
-            "dir": self.session.name,
-            "rotate": rotate,
-            "ocr": self.settings["OCR on scan"],
-            "engine": self.settings["ocr engine"],
-            "language": self.settings["ocr language"],
-            "queued_callback": self.post_process_progress.queued,
-            "started_callback": self.post_process_progress.update,
-            "finished_callback": self._import_scan_finished_callback,
-            "error_callback": self._error_callback,
-            "image_object": image_object,
-            "resolution": (xresolution, yresolution, "PixelsPerInch"),
-        }
-        if self.settings["unpaper on scan"]:
-            options["unpaper"] = self._unpaper
-
-        if self.settings["threshold-before-ocr"]:
-            options["threshold"] = self.settings["threshold tool"]
-
-        if self.settings["udt_on_scan"]:
-            options["udt"] = self.settings["current_udt"]
-
-        logger.info("Importing scan with resolution=%s,%s", xresolution, yresolution)
-        self.slist.import_scan(**options)
+        queued = False
+        try:
+            if image_object is None:
+                return
+
+            def release_scan(callback, response):
+                "let the scan dialog scan another page once this one is imported"
+                if widget is not None:
+                    widget.release_scan()
+                callback(response)
+
+            rotate = (
+                self.settings["rotate facing"]
+                if page_number % 2
+                else self.settings["rotate reverse"]
+            )
+            options = {
+                "page": page_number,
+                "dir": self.session.name,
+                "rotate": rotate,
+                "ocr": self.settings["OCR on scan"],
+                "engine": self.settings["ocr engine"],
+                "language": self.settings["ocr language"],
+                "queued_callback": self.post_process_progress.queued,
+                "started_callback": self.post_process_progress.update,
+                "finished_callback": lambda response: release_scan(
+                    self._import_scan_finished_callback, response
+                ),
+                "error_callback": lambda response: release_scan(
+                    self._error_callback, response
+                ),
+                "image_object": image_object,
+                "resolution": (xresolution, yresolution, "PixelsPerInch"),
+            }
+            if self.settings["unpaper on scan"]:
+                options["unpaper"] = self._unpaper
+
+            if self.settings["threshold-before-ocr"]:
+                options["threshold"] = self.settings["threshold tool"]
+
+            if self.settings["udt_on_scan"]:
+                options["udt"] = self.settings["current_udt"]
+
+            logger.info(
+                "Importing scan with resolution=%s,%s", xresolution, yresolution
+            )
+            self.slist.import_scan(**options)
+            queued = True
+        finally:
+            if not queued and widget is not None:
+                # nothing will be imported, so free the spool slot at once
+                widget.release_scan()
 
     def _reloaded_scan_options_callback(self, widget):  # widget is windows
         "This should only be called the first time after loading the available options"
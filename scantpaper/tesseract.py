@@ -1,10 +1,28 @@
 "Some helper functions around tesseract"
 
+import contextlib
 import re
+import threading
 import iso639
+import tesserocr
 from helpers import exec_command
 from i18n import _
 
+HOCR_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title></title>
+  <meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>
+  <meta name='ocr-system' content='tesseract' />
+ </head>
+ <body>
+"""
+HOCR_FOOTER = """ </body>
+</html>
+"""
+
 # Taken from
 # https://github.com/tesseract-ocr/tesseract/blob/master/doc/tesseract.1.asc#languages
 installable_language_codes = [
@@ -250,3 +268,56 @@ def locale_installed(locale, installed_codes):
         + _("If this is in error, please contact the scantpaper developers.")
         + "\n"
     )
+
+
+class EnginePool:
+    """Pool of tesserocr engines, keyed by language and tessdata path, so that
+    the language models are loaded once rather than for every page. Each engine
+    is used by one thread at a time, and at most maxidle are kept when idle."""
+
+    def __init__(self, maxidle=4):
+        self.maxidle = maxidle
+        self._idle = []  # (key, engine), least recently used first
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def engine(self, language, path):
+        "context manager lending an engine for language from tessdata path"
+        key = (language, path)
+        api = None
+        with self._lock:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == key:
+                    api = self._idle.pop(i)[1]
+                    break
+        if api is None:
+            api = tesserocr.PyTessBaseAPI(lang=language, path=path)
+            api.SetVariable("hocr_font_info", "T")
+        try:
+            yield api
+        finally:
+            api.Clear()
+            self._release(key, api)
+
+    def _release(self, key, api):
+        with self._lock:
+            if not self._closed:
+                self._idle.append((key, api))
+                if len(self._idle) <= self.maxidle:
+                    return
+                _key, api = self._idle.pop(0)
+        api.End()
+
+    def close(self):
+        "free the idle engines, and any in use as they are returned"
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for _key, api in idle:
+            api.End()
+
+
+def hocr_document(hocr):
+    "wrap the page returned by GetHOCRText() in an hOCR document"
+    return HOCR_HEADER + hocr + HOCR_FOOTER
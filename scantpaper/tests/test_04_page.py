@@ -1,5 +1,6 @@
 "Tests for Page class"
 
+import io
 import os
 import subprocess
 import tempfile
@@ -141,14 +142,10 @@ def test_1(temp_pnm, temp_jpg):
         assert page.export_djvu_txt() is None, "export_djvu_txt() without bboxes"
         assert page.export_text() == "", "export_text() without bboxes"
         assert page.export_djvu_ann() is None, "export_djvu_ann() without bboxes"
+        assert page.djvused_script() == "", "djvused_script() without layers"
         page.text_layer = ""
-        assert (
-            page._add_txt_to_djvu("file.djvu", dirname) is None
-        ), "_add_txt_to_djvu() without bboxes"
         page.annotations = ""
-        assert (
-            page._add_ann_to_djvu("file.djvu", dirname) is None
-        ), "_add_ann_to_djvu() without bboxes"
+        assert page.djvused_script() == "", "djvused_script() without bboxes"
 
 
 def test_2(temp_pnm):
@@ -319,15 +316,14 @@ def test_2(temp_pnm):
         ), "get_pixbuf_at_scale() doesn't fall over with an error"
 
 
-@patch("page.GdkPixbuf.Pixbuf.new_from_file", side_effect=TypeError)
-@patch("page.GdkPixbuf.Pixbuf.new_from_file_at_scale", side_effect=TypeError)
-def test_get_pixbuf_error(_mock_new_from_file_at_scale, _mock_new_from_file):
+@patch("page.image_to_pixbuf", side_effect=TypeError)
+def test_get_pixbuf_error(_mock_image_to_pixbuf):
     "Test error handling in get_pixbuf()"
     page = Page(image_object=Image.new("RGB", (210, 297)))
-    assert page.get_pixbuf() is None, "TypeError from Pixbuf.new_from_file not caught"
+    assert page.get_pixbuf() is None, "TypeError from image_to_pixbuf not caught"
     assert (
         page.get_pixbuf_at_scale(1, 1) is None
-    ), "TypeError from Pixbuf.new_from_file_at_scale not caught"
+    ), "TypeError from image_to_pixbuf not caught"
 
 
 def test_write_image_for_djvu():
@@ -340,6 +336,26 @@ def test_write_image_for_djvu():
         assert os.path.isfile(filename.name), "write_image_for_djvu() creates a file"
 
 
+def test_write_image_for_pdf_source(tmp_path):
+    "Test the original JPEG is kept and written unless the image is changed"
+    Image.new("RGB", (210, 297), "red").save(tmp_path / "in.jpg")
+    page = Page(filename=tmp_path / "in.jpg", resolution=72)
+    assert page.source == (tmp_path / "in.jpg").read_bytes(), "source kept"
+    assert Page(image_object=page.image_object).source is None
+
+    page.write_image_for_pdf(tmp_path / "out", {"options": {}}, page.source)
+    assert (tmp_path / "out").read_bytes() == page.source, "passed through"
+
+    page.write_image_for_pdf(
+        tmp_path / "g4.png", {"options": {"compression": "g4"}}, page.source
+    )
+    with Image.open(tmp_path / "g4.png") as image:
+        assert image.format == "PNG", "re-encoded when changed"
+
+    Image.new("RGB", (210, 297), "red").save(tmp_path / "in.png")
+    assert Page(filename=tmp_path / "in.png").source is None, "only JPEG etc."
+
+
 def test_write_image_for_tiff():
     "Test write_image_for_djvu()"
     with tempfile.TemporaryDirectory() as dirname, tempfile.NamedTemporaryFile(
@@ -351,3 +367,15 @@ def test_write_image_for_tiff():
             filename.name, {"dir": dirname, "options": {"compression": "jpeg"}}
         )
         assert os.path.isfile(filename.name), "write_image_for_tiff() creates a file"
+
+    page = Page(image_object=Image.new("L", (210, 297), 103))
+    page.resolution = (100, 200, "PixelsPerCentimeter")
+    with io.BytesIO() as fhd:
+        page.write_image_for_tiff(fhd, {"options": {"compression": "g4"}})
+        fhd.seek(0)
+        with Image.open(fhd) as image:
+            assert image.mode == "1", "g4 thresholds to mono"
+            assert image.getpixel((0, 0)), "40% threshold"
+            assert image.info["compression"] == "group4", "g4 compression"
+            assert image.tag_v2[296] == 3, "resolution unit"
+            assert (image.tag_v2[282], image.tag_v2[283]) == (100, 200), "resolution"
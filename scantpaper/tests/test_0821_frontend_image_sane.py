@@ -1,11 +1,13 @@
 "test frontend/image_sane.py"
 
+import threading
 from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 import PIL
+import pytest
 from gi.repository import GLib
 from frontend import enums
-from frontend.image_sane import SaneThread
+from frontend.image_sane import SaneThread, ScanCancelledError
 
 
 def test_error_handling():
@@ -459,3 +461,127 @@ def test_6_mock_device():
         thread.send("quit")
         GLib.timeout_add(2000, mlp.quit)
         mlp.run()
+
+
+def test_scan_pages_spooled():
+    "test pages are scanned ahead until the spool is full"
+    thread = SaneThread()
+    thread.device_handle = MagicMock()
+    mock_snap = patch.object(
+        thread, "_snap", side_effect=["page1", "page2", "page3"]
+    ).start()
+    thread._spool = threading.BoundedSemaphore(2)
+    request = MagicMock()
+    request.args = (0, 1, 2)
+
+    # nothing releases the pages, so the spool fills after 2 pages
+    timer = threading.Timer(0.3, setattr, (thread, "_cancel_scan", True))
+    timer.start()
+    thread.do_scan_pages(request)
+    assert [call.args[0] for call in request.data.call_args_list] == [
+        {"image": "page1", "page_number": 1},
+        {"image": "page2", "page_number": 3},
+    ]
+
+    thread.release_frame()
+    thread.release_frame()
+    thread.release_frame()  # ignored, the spool is empty
+    thread._cancel_scan = False
+    mock_snap.side_effect = ValueError("Document feeder out of documents")
+    with pytest.raises(ValueError):
+        thread.do_scan_pages(request)
+    assert thread._spool.acquire(blocking=False), "place given back on error"
+    patch.stopall()
+
+
+def test_scan_pages_spooled_cancel():
+    "test a page scanned before cancelling can be released into the next spool"
+    thread = SaneThread()
+    thread.device_handle = MagicMock()
+    patch.object(thread, "_snap", side_effect=["page1", "page2"]).start()
+    thread._spool = threading.BoundedSemaphore(1)
+    request = MagicMock()
+    request.args = (0, 1, 1)
+
+    # the scan waits for page 1 to be released, and is cancelled
+    scan = threading.Thread(target=thread.do_scan_pages, args=(request,))
+    scan.start()
+    threading.Timer(0.3, thread.cancel).start()
+    scan.join(timeout=2)
+    assert not scan.is_alive()
+    assert request.data.call_count == 1
+
+    # the next scan replaces the spool before page 1 is released
+    thread.scan_pages(num_pages=1, spool_size=1)
+    thread.release_frame()
+    request.args = (1, 2, 1)
+    thread.num_pages_scanned = 0
+    thread.do_scan_pages(request)
+    assert request.data.call_args.args[0] == {"image": "page2", "page_number": 2}
+    assert not thread._spool.acquire(blocking=False), "spool still bounded"
+    thread.release_frame()
+    assert thread._spool.acquire(blocking=False)
+    patch.stopall()
+
+
+def test_snap():
+    "test the scan progress is reported and the image wraps the buffer"
+    thread = SaneThread()
+    thread.device_handle = MagicMock()
+
+    def snap(_no_cancel, _allow16, progress):
+        for line in range(1, 5):
+            progress(line, 4)
+        return bytearray(b"\x00\xff" * 4), 2, 4, 1, 1
+
+    thread.device_handle.dev.snap.side_effect = snap
+    request = MagicMock()
+    image = thread.do_scan_page(request)
+    thread.device_handle.start.assert_called_once()
+    assert image.mode == "L" and image.size == (2, 4)
+    assert image.getpixel((1, 3)) == 255
+    assert [call.args[0] for call in request.data.call_args_list] == [
+        {"progress": 0.25},
+        {"progress": 0.5},
+        {"progress": 0.75},
+        {"progress": 1},
+    ]
+
+    thread._cancel_scan = True
+    with pytest.raises(ScanCancelledError):
+        thread.do_scan_page(request)
+
+
+def test_snap_cancel():
+    "test cancelling mid-page aborts the read without raising from the callback"
+    thread = SaneThread()
+    thread.device_handle = MagicMock()
+    cancelled, halfway = threading.Event(), threading.Event()
+    thread.device_handle.cancel.side_effect = cancelled.set
+    raised = []
+
+    def snap(_no_cancel, _allow16, progress):
+        # like _sane.c, which can't handle an exception from the callback
+        for line in range(1, 101):
+            try:
+                progress(line, 100)
+            except Exception as err:  # pylint: disable=broad-except
+                raised.append(err)
+            if line == 50:
+                halfway.set()
+                assert cancelled.wait(2)
+            if cancelled.is_set():
+                raise RuntimeError("Operation was cancelled")
+        return bytearray(100), 1, 100, 1, 1
+
+    thread.device_handle.dev.snap.side_effect = snap
+    request = MagicMock()
+    timer = threading.Thread(target=lambda: halfway.wait(2) and thread.cancel())
+    timer.start()
+    with pytest.raises(ScanCancelledError):
+        thread.do_scan_page(request)
+    timer.join()
+    assert not raised, "the progress callback never raises"
+    thread.device_handle.cancel.assert_called_once()
+    assert request.data.call_args.args[0] == {"progress": 0.5}
+    assert not thread._reading
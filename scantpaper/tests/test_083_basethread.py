@@ -1,6 +1,18 @@
 "test basethread class"
 
-from basethread import BaseThread, Response, ResponseType
+from basethread import (
+    BaseThread,
+    Request,
+    RequestError,
+    RequestQueue,
+    Response,
+    ResponseType,
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_LAST,
+    PRIORITY_NORMAL,
+)
+import threading
 from gi.repository import GLib
 import pytest
 
@@ -14,6 +26,12 @@ class MyThread(BaseThread):
         request.data("arg1 / arg2")
         return arg1 / arg2
 
+    def do_wait(self, request):  # pylint: disable=no-self-use
+        "test method blocking until the event is set"
+        started, event = request.args
+        started.set()
+        event.wait(timeout=2)
+
 
 EXPECTED = [
     Response(
@@ -59,8 +77,8 @@ EXPECTED = [
         request="",
         info=None,
         status="division by zero",
-        num_completed_jobs=1,
-        total_jobs=2,
+        num_completed_jobs=0,
+        total_jobs=1,
         pending=False,
     ),
     Response(
@@ -68,8 +86,8 @@ EXPECTED = [
         request="",
         info=None,
         status="no handler for [nodiv]",
-        num_completed_jobs=2,
-        total_jobs=3,
+        num_completed_jobs=0,
+        total_jobs=1,
         pending=False,
     ),
     Response(
@@ -77,8 +95,8 @@ EXPECTED = [
         request="",
         info=0.5,
         status=None,
-        num_completed_jobs=3,
-        total_jobs=4,
+        num_completed_jobs=0,
+        total_jobs=1,
         pending=False,
     ),  # before_finished
     Response(
@@ -86,8 +104,8 @@ EXPECTED = [
         request="",
         info=0.5,
         status=None,
-        num_completed_jobs=4,
-        total_jobs=5,
+        num_completed_jobs=0,
+        total_jobs=1,
         pending=False,
     ),  # after_finished
 ]
@@ -104,6 +122,10 @@ def test_1():
         if response is None:
             assert response == EXPECTED[n_callbacks], str(n_callbacks)
         else:
+            if response.type == ResponseType.QUEUED:
+                # dispatched at once, so the worker may not have taken the
+                # request off the queue yet
+                response = response._replace(pending=False)
             assert response._replace(request="") == EXPECTED[n_callbacks], str(
                 n_callbacks
             )
@@ -161,6 +183,204 @@ def test_1():
     mlp.run()
 
 
+def test_dispatch():
+    "test all pending responses are dispatched at once"
+    thread = MyThread()
+    thread.start()
+    stages = []
+    thread.send(
+        "div",
+        1,
+        2,
+        queued_callback=lambda response: stages.append("queued"),
+        started_callback=lambda response: stages.append("started"),
+        data_callback=lambda response: stages.append("data"),
+        finished_callback=lambda response: stages.append("finished"),
+    )
+    thread.requests.join()
+    assert thread._dispatch_pending, "wakeup scheduled"
+    assert thread._dispatch() == GLib.SOURCE_REMOVE
+    assert stages == ["queued", "started", "data", "finished"]
+    assert not thread._dispatch_pending
+    assert thread._running_source is None, "nothing left running"
+    assert (thread.num_completed_jobs, thread.total_jobs) == (0, 0), "counters reset"
+    thread.send("quit")
+    thread.join()
+
+
+def test_dispatch_counts_jobs():
+    "test the job counters only cover the jobs sent since the queue drained"
+    thread = MyThread()
+    thread.start()
+    totals = []
+
+    def finished_callback(response):
+        totals.append((response.num_completed_jobs, response.total_jobs))
+
+    started, event = threading.Event(), threading.Event()
+    thread.send("wait", started, event)
+    assert started.wait(timeout=2)
+    thread.send("div", 1, 2, finished_callback=finished_callback)
+    event.set()
+    thread.requests.join()
+    thread._dispatch()
+    assert totals == [(1, 2)]
+
+    thread.send("div", 1, 2, finished_callback=finished_callback)
+    thread.requests.join()
+    thread._dispatch()
+    assert totals == [(1, 2), (0, 1)], "job 1 of 1, not 3"
+    thread.send("quit")
+    thread.join()
+
+
+def test_request_queue():
+    "test requests are ordered by priority class, then FIFO"
+    requests = RequestQueue()
+    for name, priority in [
+        ("bulk1", PRIORITY_BULK),
+        ("normal1", None),
+        ("interactive", PRIORITY_INTERACTIVE),
+        ("bulk2", PRIORITY_BULK),
+        ("normal2", None),
+        ("quit", PRIORITY_LAST),
+        ("normal3", None),
+        ("interactive2", PRIORITY_INTERACTIVE),
+    ]:
+        request = Request(name, [], None)
+        if priority is not None:
+            request.priority = priority
+        requests.put(request)
+    assert requests.get_interactive().process == "interactive"
+    assert requests.get_interactive() is None, "nothing overtakes quit"
+    assert [requests.get().process for _ in range(7)] == [
+        "normal1",
+        "normal2",
+        "bulk1",
+        "bulk2",
+        "quit",
+        "normal3",
+        "interactive2",
+    ]
+
+
+def test_yield_to_interactive(mocker):
+    "test interactive requests are run between the pages of bulk requests"
+
+    class BatchThread(MyThread):
+        "test thread class"
+
+        priorities = {**BaseThread.priorities, "note": PRIORITY_INTERACTIVE}
+
+        def do_batch(self, request):
+            "test method"
+            for page in request.args[0]:
+                self.yield_to_interactive()
+                self.log.append(page)
+
+        def do_note(self, request):
+            "test method"
+            self.log.append(request.args[0])
+
+    thread = BatchThread()
+    thread.log = []
+    mocker.patch.object(thread, "can_yield", return_value=True)
+    thread.send("note", "interactive")
+    request = Request("batch", [[1, 2]], None)
+    request.args = [[1, 2]]
+    thread.do_batch(request)
+    assert thread.log == ["interactive", 1, 2]
+    assert thread.requests.empty()
+
+
+def test_request_queue_pages():
+    "test requests don't overtake queued requests touching the same pages"
+    requests = RequestQueue()
+    for name, priority, pages in [
+        ("bulk", PRIORITY_BULK, frozenset([1, 2])),
+        ("other page", PRIORITY_INTERACTIVE, frozenset([3])),
+        ("same page", PRIORITY_INTERACTIVE, frozenset([2])),
+        ("any page", PRIORITY_NORMAL, None),
+        ("no page", PRIORITY_INTERACTIVE, frozenset()),
+    ]:
+        request = Request(name, [], None)
+        request.priority = priority
+        request.pages = pages
+        requests.put(request)
+    assert [requests.get().process for _ in range(5)] == [
+        "other page",
+        "no page",
+        "bulk",
+        "same page",
+        "any page",
+    ]
+
+
+def test_yield_to_interactive_busy_pages(mocker):
+    "test bulk requests don't yield to interactive requests on their pages"
+
+    class BatchThread(MyThread):
+        "test thread class"
+
+        priorities = {**BaseThread.priorities, "note": PRIORITY_INTERACTIVE}
+
+        def request_pages(self, _process, args):
+            return frozenset(args[0]) if isinstance(args[0], list) else frozenset()
+
+        def do_batch(self, request):
+            "test method"
+            for page in request.args[0]:
+                self.yield_to_interactive()
+                self.log.append(page)
+
+        def do_note(self, request):
+            "test method"
+            self.log.append(request.args[0])
+
+    thread = BatchThread()
+    thread.log = []
+    mocker.patch.object(thread, "can_yield", return_value=True)
+    thread._current = Request("batch", [[1, 2]], None)
+    thread._current.pages = frozenset([1, 2])
+    thread.send("note", [2])
+    thread.send("note", [3])
+    thread.do_batch(thread._current)
+    assert thread.log == [1, 2], "the note on page 2 holds up the note on page 3"
+    assert thread.requests.qsize() == 2
+
+
+def test_return_future():
+    "test requests can return futures resolved from the thread"
+    thread = MyThread()
+    thread.start()
+    future = thread.send("div", 1, 2, return_future=True)
+    assert future.result(timeout=2) == 0.5
+    assert future.data == ["arg1 / arg2"]
+
+    future = thread.send("div", 1, 0, return_future=True)
+    with pytest.raises(RequestError, match="division by zero"):
+        future.result(timeout=2)
+    thread.send("quit")
+    thread.join()
+
+
+def test_drain_requests_cancels_futures():
+    "test the futures of queued requests are cancelled when they are drained"
+    thread = MyThread()
+    thread.start()
+    started, event = threading.Event(), threading.Event()
+    running = thread.send("wait", started, event, return_future=True)
+    assert started.wait(timeout=2)
+    queued = thread.send("div", 1, 2, return_future=True)
+    thread.drain_requests()
+    assert queued.cancelled()
+
+    event.set()
+    assert running.result(timeout=2) is None
+    thread.send("quit")
+    thread.join()
+
+
 def test_empty_queue():
     "test _monitor_response with empty queue"
     thread = BaseThread()
@@ -973,7 +973,7 @@ def test_import_files_multiple_errors():
 
 
 def test_post_process_chain():
-    "test post process chain"
+    "test post process chain is sent as a single request"
     with patch("basedocument.DocThread") as mockdocthread:
         mockdocthread.return_value._dir = "/tmp"
         doc = Document()
@@ -981,90 +981,38 @@ def test_post_process_chain():
         doc.create_pidfile = MagicMock()
         doc.add_page = MagicMock()
 
-        # Methods to mock on doc to verify chain
-        doc.rotate = MagicMock()
-        doc.unpaper = MagicMock()
-        doc.user_defined = MagicMock()
-        doc.ocr_pages = MagicMock()
-
-        # 1. Rotate
-        # Setup import_scan to trigger callback
-        def import_page_side_effect(**kwargs):
-            data_callback = kwargs["data_callback"]
-            response = MagicMock()
-            response.info = {"type": "page", "row": [1, None, "uuid1"]}
-            data_callback(response)
-
-        doc.thread.import_page.side_effect = import_page_side_effect
-
-        # Setup rotate to trigger updated_page_callback
-        def rotate_side_effect(**kwargs):
-            callback = kwargs["updated_page_callback"]
-            response = MagicMock()
-            response.info = {"type": "page", "row": [1, None, "uuid1"]}
-            callback(response)
-
-        doc.rotate.side_effect = rotate_side_effect
-
-        doc.import_scan(resolution=300, rotate=90, finished_callback=MagicMock())
-
-        assert doc.rotate.called
-        assert doc.rotate.call_args[1]["angle"] == 90
-
-        # 2. Unpaper
-        doc.rotate.reset_mock()
-        # Setup unpaper mock object
-        mock_unpaper_obj = MagicMock()
-        mock_unpaper_obj.get_cmdline.return_value = "unpaper_cmd"
-        mock_unpaper_obj.get_option.return_value = "direction"
-
-        def unpaper_side_effect(**kwargs):
-            callback = kwargs["updated_page_callback"]
+        def import_scan_side_effect(**kwargs):
             response = MagicMock()
             response.info = {"type": "page", "row": [1, None, "uuid1"]}
-            callback(response)
+            kwargs["data_callback"](response)
+            kwargs["finished_callback"](None)
 
-        doc.unpaper.side_effect = unpaper_side_effect
-
-        doc.import_scan(
-            resolution=300, unpaper=mock_unpaper_obj, finished_callback=MagicMock()
-        )
-        assert doc.unpaper.called
-
-        # 3. UDT
-        doc.unpaper.reset_mock()
-
-        def udt_side_effect(**kwargs):
-            callback = kwargs["updated_page_callback"]
-            response = MagicMock()
-            response.info = {"type": "page", "row": [1, None, "uuid1"]}
-            callback(response)
-
-        doc.user_defined.side_effect = udt_side_effect
-
-        doc.import_scan(resolution=300, udt="command", finished_callback=MagicMock())
-        assert doc.user_defined.called
-
-        # 4. OCR
-        doc.user_defined.reset_mock()
-
-        def ocr_side_effect(**kwargs):
-            callback = kwargs["finished_callback"]
-            callback(None)
-
-        doc.ocr_pages.side_effect = ocr_side_effect
+        doc.thread.import_scan.side_effect = import_scan_side_effect
 
         finished_callback = MagicMock()
         doc.import_scan(
             resolution=300,
+            rotate=90,
+            udt="command",
             ocr=True,
             engine="tesseract",
             language="eng",
             finished_callback=finished_callback,
         )
-        assert doc.ocr_pages.called
+        doc.thread.import_scan.assert_called_once()
+        kwargs = doc.thread.import_scan.call_args[1]
+        assert kwargs["rotate"] == 90
+        assert kwargs["udt"] == "command"
+        assert kwargs["ocr"]
+        assert "unpaper" not in kwargs
+        assert doc.add_page.called
         assert finished_callback.called
 
+        # only tesseract can be run on scan
+        doc.thread.import_scan.reset_mock()
+        doc.import_scan(resolution=300, ocr=True, engine="other")
+        assert "ocr" not in doc.thread.import_scan.call_args[1]
+
 
 def test_split_page():
     "test split_page"
@@ -7,7 +7,13 @@ import pytest
 from gi.repository import GLib
 import config
 from document import Document
-from tesseract import languages, _iso639_1to3, locale_installed, get_tesseract_codes
+from tesseract import (
+    EnginePool,
+    languages,
+    _iso639_1to3,
+    locale_installed,
+    get_tesseract_codes,
+)
 
 
 def test_tesseract_code_conversions():
@@ -84,3 +90,27 @@ def test_tesseract_in_thread(temp_png, temp_db, import_in_mainloop, clean_up_fil
     #########################
 
     clean_up_files(slist.thread.db_files)
+
+
+def test_engine_pool(mocker):
+    "test engines are reused by language and path, and freed when closed"
+    mock_api = mocker.patch("tesserocr.PyTessBaseAPI")
+    engines = [mocker.Mock(name=str(i)) for i in range(4)]
+    mock_api.side_effect = engines
+    pool = EnginePool(maxidle=2)
+
+    with pool.engine("eng", "/a") as api:
+        assert api is engines[0]
+        with pool.engine("eng", "/a") as api2:
+            assert api2 is engines[1], "engine in use is not shared"
+    with pool.engine("eng", "/a") as api:
+        assert api is engines[0], "most recently used engine is reused"
+    with pool.engine("deu", "/a") as api:
+        assert api is engines[2]
+    engines[1].End.assert_called_once_with()
+    engines[2].Clear.assert_called_once_with()
+
+    pool.close()
+    for api in (engines[0], engines[2]):
+        api.End.assert_called_once_with()
+    assert mock_api.call_count == 3
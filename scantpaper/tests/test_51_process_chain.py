@@ -4,6 +4,7 @@ import subprocess
 import shutil
 import re
 import pytest
+from PIL import Image
 from gi.repository import GLib
 import config
 from document import Document
@@ -67,9 +68,7 @@ def test_process_chain(temp_db, temp_pnm, clean_up_files):
     GLib.timeout_add(2000, mlp.quit)  # to prevent it hanging
     mlp.run()
 
-    assert (
-        asserts == 4
-    ), "display callback called for import, rotate, unpaper, tesseract"
+    assert asserts == 2, "displayed once scanned, and again once processed"
     page = slist.thread.get_page(number=1)
     assert page.resolution[0] == 300, "Resolution of imported image"
 
@@ -158,7 +157,7 @@ def test_tesseract_in_process_chain(temp_db, rotated_qbfox_pnm, clean_up_files):
     GLib.timeout_add(5000, mlp.quit)  # to prevent it hanging
     mlp.run()
 
-    assert asserts == 3, "display callback called for import, rotate, tesseract"
+    assert asserts == 2, "displayed once scanned, and again once processed"
     page = slist.thread.get_page(number=1)
     assert page.resolution[0] == 300, "Resolution of imported image"
 
@@ -173,41 +172,38 @@ def test_tesseract_in_process_chain(temp_db, rotated_qbfox_pnm, clean_up_files):
     clean_up_files(slist.thread.db_files)
 
 
-@pytest.mark.skipif(shutil.which("tesseract") is None, reason="requires tesseract")
-def test_error_in_process_chain1(temp_db, rotated_qbfox_pnm, clean_up_files):
-    "Test error handling in process chain"
+def test_error_in_process_chain1(temp_db, clean_up_files):
+    "Test an error in the process chain is reported, keeping the unprocessed scan"
 
     slist = Document(db=temp_db.name)
 
-    asserts = 0
+    errors = []
     mlp = GLib.MainLoop()
 
-    def started_callback(_response):
-        slist.select(0)
-        slist.delete_selection()
-
-    def error_callback(_response):
-        nonlocal asserts
-        asserts += 1
+    def error_callback(response):
+        errors.append(response.status)
         mlp.quit()
 
+    # OCR without a language fails after the scan has been rotated
     slist.import_scan(
-        filename=rotated_qbfox_pnm.name,
-        page=2,
+        image_object=Image.new("L", (20, 10), 255),
+        page=1,
         rotate=-90,
         ocr=True,
         resolution=300,
-        delete=False,
         engine="tesseract",
-        language="eng",
-        started_callback=started_callback,
+        language=None,
         error_callback=error_callback,
         finished_callback=lambda response: mlp.quit(),
     )
     GLib.timeout_add(5000, mlp.quit)  # to prevent it hanging
     mlp.run()
 
-    assert asserts == 1, "Caught error trying to process deleted page"
+    assert errors == ["No tesseract language specified"]
+    assert len(slist.data) == 1, "only the scan is added"
+    page = slist.thread.get_page(id=slist.data[0][2])
+    assert page.image_object.size == (20, 10), "no partially processed page"
+    assert page.text_layer is None
 
     clean_up_files(slist.thread.db_files)
 
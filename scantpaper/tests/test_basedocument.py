@@ -15,7 +15,7 @@ from document import Document
 from basedocument import drag_data_received_callback, ID_URI, ID_PAGE
 
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, GLib  # pylint: disable=wrong-import-position
+from gi.repository import Gtk, GLib, GdkPixbuf  # pylint: disable=wrong-import-position
 
 
 @pytest.fixture(autouse=True)
@@ -30,7 +30,7 @@ def mock_thread(mocker):
     mock_inst.responses = MagicMock()
     mock_inst.responses.get.side_effect = [None, queue.Empty]
 
-    mock_inst.running_pids = {}
+    mock_inst.running_pids = set()
     mock_inst.lock = threading.Lock()
     mock_inst._dir = "/tmp"
     mock_inst._con = MagicMock()
@@ -74,14 +74,10 @@ def test_create_pidfile_error():
 
 def test_cancel(mock_thread):
     "Test cancel method"
-    mock_thread.running_pids = {"dummy.pid": "dummy.pid"}
+    mock_thread.running_pids = {12345, 12346}
     slist = Document()
 
-    # Patch slurp where it's used in basedocument
-    # slurp returns content of pidfile as string
-    with patch("basedocument.slurp", return_value="12345"), patch(
-        "os.killpg"
-    ) as mock_killpg, patch("os.getpgid", return_value=12345):
+    with patch("os.kill") as mock_kill:
 
         cancel_callback = MagicMock()
         process_callback = MagicMock()
@@ -89,9 +85,10 @@ def test_cancel(mock_thread):
         slist.cancel(cancel_callback, process_callback)
 
         assert slist.thread.cancel is True
-        process_callback.assert_called_with("12345")
-        mock_killpg.assert_called_once_with(12345, signal.SIGKILL)
-        assert "dummy.pid" not in slist.thread.running_pids
+        process_callback.assert_any_call(12345)
+        process_callback.assert_any_call(12346)
+        mock_kill.assert_any_call(12345, signal.SIGKILL)
+        mock_kill.assert_any_call(12346, signal.SIGKILL)
 
 
 def test_add_page_extra():
@@ -840,14 +837,14 @@ def test_paste_selection_after_into_or_after(mock_thread):
     assert slist.data[1][2] == 102
 
 
-def test_cancel_with_pid_1(mock_thread):
-    "Test cancel method does not kill PID 1"
-    mock_thread.running_pids = {"pid1.pid": "pid1.pid"}
+def test_cancel_finished_process(mock_thread):
+    "Test cancel method ignores processes that have already finished"
+    mock_thread.running_pids = {12345}
     slist = Document()
 
-    with patch("basedocument.slurp", return_value=1), patch("os.killpg") as mock_killpg:
+    with patch("os.kill", side_effect=ProcessLookupError) as mock_kill:
         slist.cancel(MagicMock())
-        mock_killpg.assert_not_called()
+        mock_kill.assert_called_once_with(12345, signal.SIGKILL)
 
 
 def test_valid_renumber_all_negative_step():
@@ -859,16 +856,14 @@ def test_valid_renumber_all_negative_step():
     assert not slist.valid_renumber(1, -1, "all")
 
 
-def test_cancel_with_empty_pid(mock_thread):
-    "Test cancel method with empty pid from slurp"
-    mock_thread.running_pids = {"empty.pid": "empty.pid"}
+def test_cancel_without_processes(mock_thread):
+    "Test cancel method with no processes running"
+    mock_thread.running_pids = set()
     slist = Document()
 
-    with patch("basedocument.slurp", return_value=""), patch(
-        "os.killpg"
-    ) as mock_killpg:
+    with patch("os.kill") as mock_kill:
         slist.cancel(MagicMock())
-        mock_killpg.assert_not_called()
+        mock_kill.assert_not_called()
 
 
 def test_pages_possible_complex():
@@ -999,3 +994,53 @@ def test_create_pidfile_ioerror():
     # Mock tempfile.TemporaryFile to raise IOError
     with patch("tempfile.TemporaryFile", side_effect=IOError("disk full")):
         assert slist.create_pidfile({}) is None
+
+
+def test_fetch_visible_thumbnails(mock_thread):
+    "Test missing thumbnails are fetched, cached, and the cache bounded"
+    slist = Document()
+    slist.thumbnail_cache_size = 2
+    for i in range(1, 4):
+        slist.add_page(i, None, 100 + i)
+    thumb = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 1, 1)
+
+    def mock_thumbnails(page_ids, data_callback, finished_callback, **_kwargs):
+        response = MagicMock()
+        response.info = {
+            "type": "thumbnails",
+            "thumbs": {page_id: thumb for page_id in page_ids},
+        }
+        data_callback(response)
+        finished_callback(None)
+
+    mock_thread.thumbnails.side_effect = mock_thumbnails
+    with patch.object(
+        slist,
+        "get_visible_range",
+        return_value=(Gtk.TreePath(0), Gtk.TreePath(1)),
+    ):
+        slist.fetch_visible_thumbnails()
+    mock_thread.thumbnails.assert_called_once()
+    assert mock_thread.thumbnails.call_args[0][0] == [101, 102]
+    assert [row[1] is not None for row in slist.data] == [True, True, False]
+
+    with patch.object(
+        slist,
+        "get_visible_range",
+        return_value=(Gtk.TreePath(2), Gtk.TreePath(2)),
+    ):
+        slist.fetch_visible_thumbnails()
+    assert [row[1] is not None for row in slist.data] == [False, True, True]
+    assert not slist._thumbs_pending
+
+    # restored from the cache without asking the thread
+    slist.data = [[1, None, 101], [2, None, 102], [3, None, 103]]
+    mock_thread.thumbnails.reset_mock()
+    with patch.object(
+        slist,
+        "get_visible_range",
+        return_value=(Gtk.TreePath(1), Gtk.TreePath(2)),
+    ):
+        slist.fetch_visible_thumbnails()
+    mock_thread.thumbnails.assert_not_called()
+    assert [row[1] is not None for row in slist.data] == [False, True, True]
@@ -1,11 +1,17 @@
 "Tests for DocThread"
 
+import concurrent.futures
+import io
+import sqlite3
 import threading
 import subprocess
 import pytest
+from PIL import Image
+from basethread import PRIORITY_INTERACTIVE
 from const import APPLICATION_ID, USER_VERSION
 from docthread import DocThread, _calculate_crop_tuples
 from importthread import CancelledError
+import imageops
 from page import Page
 
 
@@ -29,8 +35,7 @@ def test_do_tesseract_path_fallback(mocker):
     # Mock PyTessBaseAPI
     mock_api = mocker.patch("tesserocr.PyTessBaseAPI")
     mock_api_instance = mock_api.return_value
-    mock_api_instance.__enter__.return_value = mock_api_instance
-    mock_api_instance.ProcessPages.return_value = True
+    mock_api_instance.GetHOCRText.return_value = "hocr content"
 
     # Mock Page
     mock_page = mocker.Mock(spec=Page)
@@ -44,12 +49,6 @@ def test_do_tesseract_path_fallback(mocker):
     mocker.patch.object(thread, "replace_page")
     mocker.patch.object(thread, "find_page_number_by_page_id")
 
-    # Mock pathlib.Path
-    mock_path = mocker.patch("pathlib.Path")
-    mock_path_instance = mock_path.return_value
-    mock_path_instance.with_suffix.return_value = mock_path_instance
-    mock_path_instance.read_text.return_value = "hocr content"
-
     # Mock cancel
     thread.cancel = False
 
@@ -104,12 +103,6 @@ def test_do_tesseract_path_fallback_not_found(temp_db, clean_up_files, mocker):
     # Mock _con for commit
     thread._con[threading.get_native_id()] = mocker.Mock()
 
-    # Mock pathlib.Path
-    mock_path = mocker.patch("pathlib.Path")
-    mock_path_instance = mock_path.return_value
-    mock_path_instance.with_suffix.return_value = mock_path_instance
-    mock_path_instance.read_text.return_value = "hocr content"
-
     request = mocker.Mock()
     request.args = [{"page": 1, "language": "eng", "dir": "/tmp"}]
 
@@ -152,8 +145,7 @@ def test_do_tesseract_path_fallback_symlink(temp_db, clean_up_files, mocker):
     # Mock PyTessBaseAPI
     mock_api = mocker.patch("tesserocr.PyTessBaseAPI")
     mock_api_instance = mock_api.return_value
-    mock_api_instance.__enter__.return_value = mock_api_instance
-    mock_api_instance.ProcessPages.return_value = True
+    mock_api_instance.GetHOCRText.return_value = "hocr content"
 
     # Mock Page
     mock_page = mocker.Mock(spec=Page)
@@ -168,12 +160,6 @@ def test_do_tesseract_path_fallback_symlink(temp_db, clean_up_files, mocker):
     # Mock DB operations
     mocker.patch.object(thread, "replace_page")
 
-    # Mock pathlib.Path (the one used for reading hocr)
-    mock_pathlib_path = mocker.patch("pathlib.Path")
-    mock_pathlib_path_instance = mock_pathlib_path.return_value
-    mock_pathlib_path_instance.with_suffix.return_value = mock_pathlib_path_instance
-    mock_pathlib_path_instance.read_text.return_value = "hocr content"
-
     request = mocker.Mock()
     request.args = [{"page": 1, "language": "eng", "dir": "/tmp"}]
 
@@ -185,6 +171,168 @@ def test_do_tesseract_path_fallback_symlink(temp_db, clean_up_files, mocker):
     clean_up_files(thread.db_files)
 
 
+def test_do_tesseract_reuses_engine(mocker):
+    "test do_tesseract loads each language once and passes the image in memory"
+    thread = DocThread(db=":memory:")
+    thread._write_tid = threading.get_native_id()
+    mock_languages = mocker.patch(
+        "tesserocr.get_languages", return_value=("/tessdata/", ["eng", "deu"])
+    )
+    mock_api = mocker.patch("tesserocr.PyTessBaseAPI")
+    mock_api_instance = mock_api.return_value
+    mock_api_instance.GetHOCRText.return_value = (
+        "<div class='ocr_page' title='bbox 0 0 100 100'>"
+        "<span class='ocrx_word' title='bbox 10 10 50 20'>word</span></div>"
+    )
+    page = Page(image_object=Image.new("L", (100, 100)), resolution=300)
+    page.id = 1
+    mocker.patch.object(thread, "get_page", return_value=page)
+    mocker.patch.object(thread, "find_page_number_by_page_id", return_value=0)
+    mock_replace = mocker.patch.object(thread, "replace_page")
+    request = mocker.Mock()
+
+    for language in ["eng", "eng", "deu"]:
+        request.args = [{"page": 1, "language": language, "dir": "/tmp"}]
+        thread.do_tesseract(request)
+
+    mock_languages.assert_called_once()
+    assert mock_api.call_args_list == [
+        mocker.call(lang="eng", path="/tessdata/"),
+        mocker.call(lang="deu", path="/tessdata/"),
+    ]
+    mock_api_instance.SetImage.assert_called_with(page.image_object)
+    mock_api_instance.SetSourceResolution.assert_called_with(300)
+    assert mock_api_instance.Clear.call_count == 3
+    assert "word" in mock_replace.call_args[0][0].text_layer
+    assert page.ocr_flag
+
+    thread.do_quit(None)
+    assert mock_api_instance.End.call_count == 2
+
+
+def test_do_tesseract_pages(mocker):
+    "test do_tesseract recognises pages concurrently, writing them back in order"
+    thread = DocThread(db=":memory:")
+    thread._write_tid = threading.get_native_id()
+    thread.processes = 2
+    mocker.patch("docthread.os.cpu_count", return_value=4)
+    mocker.patch("tesserocr.get_languages", return_value=("/tessdata/", ["eng"]))
+    pages = {}
+    for i in range(1, 6):
+        pages[i] = Page(image_object=Image.new("L", (10 * i, 10)))
+        pages[i].id = i
+    mocker.patch.object(thread, "get_page", side_effect=lambda id: pages[id])
+    mocker.patch.object(thread, "find_page_number_by_page_id", side_effect=int)
+    mocker.patch.object(
+        thread, "replace_page", side_effect=lambda page, number: (number, None, 10)
+    )
+
+    # the first page is the slowest, so the others finish before it
+    first = threading.Event()
+    running = set()
+
+    def recognise(**_kwargs):
+        running.add(threading.get_native_id())
+        api = mocker.Mock()
+        width = {}
+
+        def set_image(image):
+            width["x"] = image.width
+
+        api.SetImage.side_effect = set_image
+
+        def hocr(_page):
+            if width["x"] == 10:
+                assert first.wait(5)
+            else:
+                first.set()
+            return (
+                f"<div class='ocr_page' title='bbox 0 0 {width['x']} 10'>"
+                f"<span class='ocrx_word' title='bbox 0 0 {width['x']} 10'>x</span>"
+                "</div>"
+            )
+
+        api.GetHOCRText.side_effect = hocr
+        return api
+
+    mocker.patch("tesserocr.PyTessBaseAPI", side_effect=recognise)
+    request = mocker.Mock()
+    request.args = [{"pages": [1, 2, 3, 4, 5], "language": "eng"}]
+
+    thread.do_tesseract(request)
+
+    assert len(running) == 2, "pages recognised in two threads"
+    infos = [call.args[0] for call in request.data.call_args_list]
+    assert [info["replace"] for info in infos] == [1, 2, 3, 4, 5]
+    assert [info["progress"] for info in infos] == [0.2, 0.4, 0.6, 0.8, 1]
+    assert infos[-1]["message"] == "OCR page 5 of 5"
+    assert all(page.ocr_flag for page in pages.values())
+    assert '"bbox": [0, 0, 30, 10], "type": "word", "text": "x"' in pages[3].text_layer
+
+
+def test_do_tesseract_pages_cancel(mocker):
+    "test cancelling do_tesseract stops the rest of the pages"
+    thread = DocThread(db=":memory:")
+    thread._write_tid = threading.get_native_id()
+    thread.processes = 1
+    mocker.patch("tesserocr.get_languages", return_value=("/tessdata/", ["eng"]))
+    page = Page(image_object=Image.new("L", (10, 10)))
+    page.id = 1
+    mocker.patch.object(thread, "get_page", return_value=page)
+    mocker.patch.object(thread, "find_page_number_by_page_id", return_value=0)
+    mocker.patch.object(thread, "replace_page", return_value=(0, None, 2))
+    mock_api = mocker.patch("tesserocr.PyTessBaseAPI")
+    mock_api.return_value.GetHOCRText.return_value = ""
+    request = mocker.Mock()
+    request.args = [{"pages": [1, 2, 3, 4, 5], "language": "eng"}]
+
+    def cancel(_info):
+        thread.cancel = True
+
+    request.data.side_effect = cancel
+    with pytest.raises(CancelledError):
+        thread.do_tesseract(request)
+    assert request.data.call_count == 1
+    assert mock_api.return_value.GetHOCRText.call_count < 5
+
+
+def test_do_tesseract_rereads_page(mocker):
+    "test interactive changes made whilst a page is queued are not overwritten"
+    thread = DocThread(db=":memory:")
+    thread._write_tid = threading.get_native_id()
+    thread.processes = 2
+    mocker.patch("docthread.os.cpu_count", return_value=4)
+    mocker.patch("tesserocr.get_languages", return_value=("/tessdata/", ["eng"]))
+    resolution = {1: 300, 2: 300}
+
+    def get_page(id):  # pylint: disable=redefined-builtin
+        page = Page(image_object=Image.new("L", (10, 10)), resolution=resolution[id])
+        page.id = id
+        return page
+
+    def set_resolution():
+        "change the first page once it has been read"
+        if thread.get_page.call_count:
+            resolution[1] = 600
+
+    mocker.patch.object(thread, "get_page", side_effect=get_page)
+    mocker.patch.object(thread, "yield_to_interactive", side_effect=set_resolution)
+    mocker.patch.object(thread, "find_page_number_by_page_id", side_effect=int)
+    mock_replace = mocker.patch.object(
+        thread, "replace_page", side_effect=lambda page, number: (number, None, 10)
+    )
+    mock_api = mocker.patch("tesserocr.PyTessBaseAPI")
+    mock_api.return_value.GetHOCRText.return_value = ""
+    request = mocker.Mock()
+    request.args = [{"pages": [1, 2], "language": "eng"}]
+
+    thread.do_tesseract(request)
+
+    page = mock_replace.call_args_list[0].args[0]
+    assert page.resolution == (600, 600, "PixelsPerInch")
+    assert page.ocr_flag
+
+
 def test_calculate_crop_tuples(mocker):
     "test _calculate_crop_tuples"
 
@@ -252,7 +400,7 @@ def test_open_session_file(mocker):
     assert mock_execute.call_count == 3
     mock_execute.assert_any_call("PRAGMA application_id")
     mock_execute.assert_any_call("PRAGMA user_version")
-    mock_execute.assert_any_call("SELECT MAX(action_id) FROM page_order")
+    mock_execute.assert_any_call("SELECT MAX(action_id) FROM selection")
 
 
 def test_open_session_file_invalid_app_id(mocker):
@@ -304,79 +452,141 @@ def test_do_set_saved(mocker):
     )
 
 
+def _unpaper_options(pages, direction="ltr"):
+    "return the options for unpaper with the given number of output pages"
+    command = ["unpaper", "--output-pages", str(pages), "--overwrite"]
+    return {
+        "dir": "/tmp",
+        "options": {"command": command + ["%s"] * 3, "direction": direction},
+    }
+
+
 def test_run_unpaper_cmd_rtl(mocker):
     "test _run_unpaper_cmd with rtl direction"
     thread = DocThread(db=":memory:")
     thread._write_tid = threading.get_native_id()
 
-    mock_run = mocker.patch("subprocess.run")
-    mock_run.return_value.stdout = "Processing sheet 1.pnm\n"
-    mock_run.return_value.stderr = ""
+    def unpaper(command, **_kwargs):
+        for i, path in enumerate(command[-2:]):
+            Image.new("L", (10 + i, 10)).save(path, format="PPM")
+        return mocker.Mock(stdout="Processing sheet 1.pnm\n", stderr="")
 
-    mocker.patch("os.path.getsize", return_value=100)
-    mock_temp = mocker.patch("tempfile.NamedTemporaryFile")
-    mock_temp.return_value.name = "temp_file"
-
-    request = mocker.Mock()
-    request.args = [
-        {
-            "dir": "/tmp",
-            "options": {
-                "command": ["unpaper", "--output-pages", "2", "out"],
-                "direction": "rtl",
-            },
-        }
-    ]
+    mock_run = mocker.patch("subprocess.run", side_effect=unpaper)
+    options = _unpaper_options(2, "rtl")
+    command = options["options"]["command"].copy()
 
-    out, out2 = thread._run_unpaper_cmd(request)
+    images, messages = thread._run_unpaper_cmd(options, Image.new("1", (20, 10)))
 
-    # With RTL, out and out2 should be swapped
-    # Normally out is the first temp file created (output-pages arg -2)
-    # out2 is the second temp file created (output-pages arg -1)
-    # The method swaps them if direction is rtl
-    assert out != out2
+    # With RTL, the right half of the sheet is the first page
+    assert [image.width for image in images] == [11, 10]
+    assert messages == []
+    args = mock_run.call_args[0][0]
+    assert args[:4] == command[:4]
+    assert args[4].endswith("in.pbm") and args[5].endswith("out0.pnm")
+    assert options["options"]["command"] == command, "command not modified"
 
 
 def test_run_unpaper_cmd_rtl_error(mocker):
     "test _run_unpaper_cmd error handling"
     thread = DocThread(db=":memory:")
     thread._write_tid = threading.get_native_id()
+    options = _unpaper_options(2, "rtl")
 
-    # Mock os.path.getsize to return 0 (empty file), triggering the error check
-    mocker.patch("os.path.getsize", return_value=0)
-    mock_temp = mocker.patch("tempfile.NamedTemporaryFile")
-    mock_temp.return_value.name = "temp_file"
-
-    request = mocker.Mock()
-    request.args = [
-        {
-            "dir": "/tmp",
-            "options": {
-                "command": ["unpaper", "--output-pages", "2", "out"],
-                "direction": "rtl",
-            },
-        }
-    ]
-
-    # Test stderr error
+    # Test stderr error, with no output written
     mock_run = mocker.patch("subprocess.run")
     mock_run.return_value.stdout = ""
     mock_run.return_value.stderr = "some error"
 
-    with pytest.raises(subprocess.CalledProcessError):
-        thread._run_unpaper_cmd(request)
-    request.data.assert_called_with("some error")
-
-    # Reset command for the second call
-    request.args[0]["options"]["command"] = ["unpaper", "--output-pages", "2", "out"]
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        thread._run_unpaper_cmd(options, Image.new("1", (20, 10)))
+    assert excinfo.value.stderr == "some error"
 
     # Test stdout error (after processing replacement)
     mock_run.return_value.stdout = "Processing sheet 1.pnm\nError processing"
     mock_run.return_value.stderr = ""
 
-    with pytest.raises(subprocess.CalledProcessError):
-        thread._run_unpaper_cmd(request)
-    request.data.assert_called_with("Error processing")
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        thread._run_unpaper_cmd(options, Image.new("1", (20, 10)))
+    assert excinfo.value.output == "Error processing"
+
+
+def test_run_unpaper_cmd_pipes(mocker):
+    "test _run_unpaper_cmd passing a single page via stdin and stdout"
+    thread = DocThread(db=":memory:")
+
+    def unpaper(command, **kwargs):
+        assert command[-2:] == ["-", "-"]
+        image = Image.open(io.BytesIO(kwargs["input"]))
+        output = io.BytesIO()
+        image.rotate(90, expand=True).save(output, format="PPM")
+        return mocker.Mock(stdout=output.getvalue(), stderr=b"")
+
+    mocker.patch("subprocess.run", side_effect=unpaper)
+    images, messages = thread._run_unpaper_cmd(
+        _unpaper_options(1), Image.new("L", (20, 10)), True
+    )
+    assert [image.size for image in images] == [(10, 20)]
+    assert messages == []
+
+    # the probe succeeds with an unpaper that supports pipes
+    assert thread._unpaper_can_pipe()
+
+
+def test_unpaper_can_pipe_not_supported(mocker):
+    "test unpaper falls back to files if it cannot use stdin and stdout"
+    thread = DocThread(db=":memory:")
+    mock_run = mocker.patch(
+        "subprocess.run", return_value=mocker.Mock(stdout=b"", stderr=b"")
+    )
+    assert not thread._unpaper_can_pipe()
+    assert not thread._unpaper_can_pipe()
+    mock_run.assert_called_once()
+
+
+def test_do_unpaper_pages(mocker):
+    "test do_unpaper runs pages concurrently, inserting the results in order"
+    thread = DocThread(db=":memory:")
+    thread._write_tid = threading.get_native_id()
+    thread.processes = 2
+    mocker.patch("docthread.os.cpu_count", return_value=4)
+    thread._unpaper_pipes = False
+    pages = {}
+    for i in range(1, 4):
+        pages[i] = Page(image_object=Image.new("L", (20 * i, 10)), resolution=300)
+        pages[i].id = i
+    mocker.patch.object(thread, "get_page", side_effect=lambda id: pages[id])
+    mocker.patch.object(thread, "find_page_number_by_page_id", side_effect=int)
+    mock_add = mocker.patch.object(
+        thread, "add_page", side_effect=lambda page, number: (number, None, 0)
+    )
+    mock_replace = mocker.patch.object(
+        thread, "replace_page", side_effect=lambda page, number: (number, None, 0)
+    )
+
+    def unpaper(command, **_kwargs):
+        # split the sheet in half
+        with Image.open(command[-3]) as image:
+            width = image.width // 2
+            for i, path in enumerate(command[-2:]):
+                image.crop((i * width, 0, (i + 1) * width, 10)).save(path, "PPM")
+        return mocker.Mock(stdout="", stderr="")
+
+    mocker.patch("subprocess.run", side_effect=unpaper)
+    request = mocker.Mock()
+    options = _unpaper_options(2)
+    options["pages"] = [1, 2, 3]
+    request.args = [options]
+
+    thread.do_unpaper(request)
+
+    infos = [call.args[0] for call in request.data.call_args_list]
+    refs = [info.get("insert-after", info.get("replace")) for info in infos]
+    assert refs == [1, 1, 2, 2, 3, 3], "second page inserted before replacing"
+    assert [call.args[1] for call in mock_add.call_args_list] == [2, 3, 4]
+    widths = [call.args[0].image_object.width for call in mock_replace.call_args_list]
+    assert widths == [10, 20, 30]
+    assert mock_replace.call_args[0][0].resolution == (300, 300, "PixelsPerInch")
+    assert infos[-1]["progress"] == 1
 
 
 def test_set_text_calls_send(mocker):
@@ -653,3 +863,542 @@ def test_do_unpaper_ioerror(mocker):
 
     request.error.assert_called()
     assert "Error creating file in /tmp: Mocked IOError" in str(request.error.call_args)
+
+
+def test_request_pages():
+    "test the pages touched by requests are found from their args"
+    thread = DocThread(db=":memory:")
+    assert thread.request_pages("set_text", (1, "text")) == {1}
+    assert thread.request_pages("set_saved", ([1, 2], True)) == {1, 2}
+    assert thread.request_pages("rotate", ({"page": 3, "angle": 90},)) == {3}
+    assert thread.request_pages("tesseract", ({"pages": [1, 2]},)) == {1, 2}
+    assert thread.request_pages("save_pdf", ({"list_of_pages": [4]},)) == {4}
+    assert thread.request_pages("import_scan", ({"page": 5},)) == set()
+    assert thread.request_pages("delete_pages", ({"numbers": [1]},)) is None
+    assert thread.priorities["rotate"] == PRIORITY_INTERACTIVE
+
+
+def test_handler_wrapper_pools_image_operations(mocker):
+    "test image operations are only submitted to the pool if more are waiting"
+    thread = DocThread(db=":memory:")
+    thread._write_tid = threading.get_native_id()
+    thread.processes = 2
+    mock_submit = mocker.patch.object(thread, "_submit_pooled")
+    mock_handler = mocker.Mock()
+    request = mocker.Mock()
+    request.process = "rotate"
+
+    mocker.patch.object(thread.requests, "empty", return_value=True)
+    thread.handler_wrapper(request, mock_handler)
+    mock_submit.assert_not_called()
+    mock_handler.assert_called_once_with(request)
+
+    mocker.patch.object(thread.requests, "empty", return_value=False)
+    assert thread.handler_wrapper(request, mock_handler)
+    mock_submit.assert_called_once_with(request)
+
+    thread._yielding = True
+    thread.handler_wrapper(request, mock_handler)
+    mock_submit.assert_called_once_with(request)
+    assert mock_handler.call_count == 2, "not pooled whilst a batch waits"
+
+
+def test_map_pages(mocker):
+    "test _map_pages returns the results in order, with and without the pool"
+    thread = DocThread(db=":memory:")
+    for processes in (1, 2):
+        thread.processes = processes
+        pages = [
+            mocker.Mock(image_object=Image.new("RGB", (10 * i, 10)))
+            for i in range(1, 4)
+        ]
+        mocker.patch.object(thread, "get_page", side_effect=pages)
+        results = list(thread._map_pages([1, 2, 3], imageops.rotate, 90))
+        assert [page for page, _image in results] == pages
+        assert [image.size for _page, image in results] == [
+            (10, 10),
+            (10, 20),
+            (10, 30),
+        ]
+    thread.do_quit(None)
+
+
+def test_do_set_image_codec(mocker):
+    "test do_set_image_codec falls back to PNG for unavailable codecs"
+    thread = DocThread(db=":memory:")
+    thread.do_set_image_codec(mocker.Mock(args=("raw", None)))
+    assert thread.image_codec == "raw"
+    mocker.patch("imagecodec.zstd", None)
+    thread.do_set_image_codec(mocker.Mock(args=("zstd", 3)))
+    assert (thread.image_codec, thread.image_codec_level) == ("png", None)
+
+
+def test_page_cache(temp_db, clean_up_files, mocker):
+    "test get_page uses the cache, and that it is invalidated"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    for i in range(1, 3):
+        thread.add_page(Page(image_object=Image.new("L", (10, 10))), number=i)
+    page_id = thread.page_number_table()[0][2]
+
+    page = thread.get_page(id=page_id)
+    assert thread.page_cache.cache_info()[:2] == (0, 1)
+    assert thread.get_page(number=1).image_object.tobytes() == (
+        page.image_object.tobytes()
+    )
+    assert thread.page_cache.cache_info()[:2] == (1, 1)
+
+    thread.replace_page(Page(image_object=Image.new("L", (5, 5)), id=page_id), 1)
+    assert thread.page_cache.cache_info().count == 0
+    assert thread.get_page(number=1).image_object.size == (5, 5)
+    assert thread.page_cache.cache_info().count == 1
+
+    thread.undo()
+    assert thread.page_cache.cache_info().count == 0
+    assert thread.get_page(number=1).image_object.size == (10, 10)
+
+    thread.do_delete_pages(mocker.Mock(args=[{"numbers": [1]}]))
+    assert thread.page_cache.cache_info().count == 0
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_lazy_thumbnails(temp_db, clean_up_files, mocker):
+    "test the page number table without thumbnails, and fetching them later"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    for i in range(1, 3):
+        thread.add_page(Page(image_object=Image.new("L", (10, 10))), number=i)
+    table = thread.page_number_table(thumbnails=False)
+    assert [row[:2] for row in table] == [[1, None], [2, None]]
+    assert [row[2] for row in table] == [row[2] for row in thread.page_number_table()]
+
+    request = mocker.Mock(args=[[table[1][2]]])
+    thread.do_thumbnails(request)
+    request.data.assert_called_once()
+    thumbs = request.data.call_args[0][0]["thumbs"]
+    assert list(thumbs) == [table[1][2]]
+    assert thumbs[table[1][2]].get_width() == thread.widtht
+
+    thread.do_delete_pages(mocker.Mock(args=[{"numbers": [1]}]))
+    assert thread.undo(thumbnails=False)[0][1] is None
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_undo_journal(temp_db, clean_up_files, mocker):
+    "test actions only write the page_order rows they change"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+
+    def state():
+        return [
+            (number, thread.find_row_id_by_page_number(number), page_id)
+            for number, _thumb, page_id in thread.page_number_table(thumbnails=False)
+        ]
+
+    def written():
+        thread._execute(
+            "SELECT COUNT(*) FROM page_order WHERE action_id = ? OR end_action_id = ?",
+            (thread._action_id, thread._action_id),
+        )
+        return thread._fetchone()[0]
+
+    for i in range(5):
+        thread.add_page(Page(image_object=Image.new("L", (10, 10), i)), number=i + 1)
+    states = [state()]
+    assert written() == 1
+
+    thread.replace_page(
+        Page(image_object=Image.new("L", (10, 10), 255), id=states[0][2][2]), 3
+    )
+    states.append(state())
+    assert written() == 2, "only the replaced row is ended and inserted"
+    assert states[1][2][2] != states[0][2][2]
+
+    thread.do_delete_pages(mocker.Mock(args=[{"numbers": [4]}]))
+    states.append(state())
+    assert written() == 3, "page 4 deleted and page 5 renumbered"
+    assert [row[1] for row in states[2]] == [0, 1, 2, 3]
+
+    thread.do_clone_pages(
+        mocker.Mock(args=[{"page_ids": [states[2][0][2]], "dest": 1}])
+    )
+    states.append(state())
+    assert [row[0] for row in states[3]] == [1, 2, 3, 4, 6]
+    assert [row[1] for row in states[3]] == [0, 1, 2, 3, 4]
+
+    for expected in reversed(states[:-1]):
+        thread.undo()
+        assert state() == expected
+    for expected in states[1:]:
+        thread.redo()
+        assert state() == expected
+
+    # a new action after undoing discards the redo steps
+    thread.undo()
+    thread.undo()
+    thread.do_delete_pages(mocker.Mock(args=[{"numbers": [1]}]))
+    assert not thread.can_redo()
+    assert [row[2] for row in state()] == [row[2] for row in states[1][1:]]
+    thread.undo()
+    assert state() == states[1]
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_apply_chain(temp_db, clean_up_files, mocker):
+    "test a chain of operations replaces the pages as a single undo step"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    thread.processes = 1
+    for i in range(3):
+        page = Page(
+            image_object=Image.new("L", (20, 10), 100 + i),
+            resolution=(300, 150, "PixelsPerInch"),
+        )
+        page.text_layer = (
+            '[{"type": "page", "bbox": [0, 0, 20, 10], "depth": 0},'
+            '{"type": "word", "bbox": [1, 1, 4, 4], "text": "a", "depth": 1}]'
+        )
+        thread.add_page(page, number=i + 1)
+    page_ids = [row[2] for row in thread.page_number_table(thumbnails=False)]
+    action_id = thread._action_id
+    mock_replace = mocker.spy(thread, "replace_page")
+    request = mocker.Mock()
+    request.args = [
+        {
+            "pages": page_ids[:2],
+            "steps": [
+                ("rotate", {"angle": 90}),
+                ("crop", {"x": 0, "y": 0, "w": 5, "h": 8}),
+                ("threshold", {"threshold": 60}),
+            ],
+        }
+    ]
+
+    thread.do_apply_chain(request)
+
+    assert thread._action_id == action_id + 1, "one undo step"
+    assert mock_replace.call_count == 2
+    infos = [call.args[0] for call in request.data.call_args_list]
+    assert [info["replace"] for info in infos] == page_ids[:2]
+    assert [info["progress"] for info in infos] == [0.5, 1]
+    page = thread.get_page(id=infos[0]["row"][2])
+    assert page.image_object.size == (5, 8)
+    assert page.image_object.mode == "1"
+    assert page.resolution[:2] == (150, 300)
+    assert '"bbox": [1, 1, 4, 4]' in page.text_layer
+
+    thread.undo()
+    assert [row[2] for row in thread.page_number_table(thumbnails=False)] == page_ids
+
+    request.args[0]["steps"] = [("explode", {})]
+    with pytest.raises(ValueError):
+        thread.do_apply_chain(request)
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_do_import_scan(temp_db, clean_up_files, mocker):
+    "test a scan is post-processed in memory and added as a single undo step"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    action_id = thread._action_id
+    mocker.patch.object(thread, "_unpaper_can_pipe", return_value=True)
+    mock_unpaper = mocker.patch.object(
+        thread,
+        "_run_unpaper_cmd",
+        side_effect=lambda _options, image, _pipes: (
+            [image.crop((0, 0, 10, 20)), image.crop((10, 0, 20, 20))],
+            [],
+        ),
+    )
+    mocker.patch(
+        "docthread._run_user_defined",
+        side_effect=lambda _command, image, _resolution, _dir: (image, "warning"),
+    )
+    mocker.patch.object(thread, "_tessdata_path", return_value="/tessdata")
+    mock_recognise = mocker.patch.object(
+        thread,
+        "_recognise",
+        return_value='<div class="ocr_page" title="bbox 0 0 10 20">'
+        '<span class="ocrx_word" title="bbox 1 1 5 5">a</span></div>',
+    )
+    mock_snapshot = mocker.spy(thread, "_take_snapshot")
+    request = mocker.Mock()
+    request.args = [
+        {
+            "page_options": {
+                "image_object": Image.new("L", (20, 10), 255),
+                "resolution": (300, 150, "PixelsPerInch"),
+            },
+            "page": 1,
+            "rotate": 90,
+            "unpaper": {"command": ["unpaper"], "direction": "ltr"},
+            "udt": "cmd %i",
+            "ocr": True,
+            "language": "eng",
+        }
+    ]
+
+    thread.do_import_scan(request)
+
+    assert mock_unpaper.call_args.args[1].size == (10, 20), "rotated first"
+    assert mock_recognise.call_count == 2
+    assert mock_snapshot.call_count == 1
+    assert thread._action_id == action_id + 1, "one undo step"
+    infos = [call.args[0] for call in request.data.call_args_list]
+    assert infos[0]["row"][0] == 1, "scan displayed before it is processed"
+    assert infos[1] == {"type": "message", "info": "warning"}
+    assert infos[3]["insert-after"] == infos[0]["row"][2]
+    assert infos[4]["replace"] == infos[0]["row"][2]
+    assert [info["row"][0] for info in infos[3:]] == [2, 1]
+    page = thread.get_page(id=infos[4]["row"][2])
+    assert page.resolution[:2] == (150, 300)
+    assert '"text": "a"' in page.text_layer
+    assert [row[0] for row in thread.page_number_table()] == [1, 2]
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_do_import_scan_error(temp_db, clean_up_files, mocker):
+    "test a scan that fails to be processed is kept unprocessed"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    action_id = thread._action_id
+    request = mocker.Mock()
+    request.args = [
+        {
+            "page_options": {
+                "image_object": Image.new("L", (20, 10), 255),
+                "resolution": (300, 300, "PixelsPerInch"),
+            },
+            "page": 1,
+            "rotate": 90,
+            "ocr": True,
+            "language": None,
+        }
+    ]
+
+    with pytest.raises(ValueError, match="No tesseract language specified"):
+        thread.do_import_scan(request)
+
+    request.data.assert_called_once()
+    row = request.data.call_args.args[0]["row"]
+    assert [row[2] for row in thread.page_number_table()] == [row[2]]
+    assert thread.get_page(id=row[2]).image_object.size == (20, 10), "not rotated"
+    assert thread._action_id == action_id + 1, "one undo step"
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_return_future(temp_db, clean_up_files):
+    "test operations on several pages can be composed with futures"
+    thread = DocThread(db=temp_db.name)
+    thread.processes = 1
+    for i in range(2):
+        thread.send(
+            "import_page",
+            {"image_object": Image.new("L", (20, 10)), "page": i + 1},
+        )
+    thread.requests.join()
+    page_ids = [row[2] for row in thread.page_number_table(thumbnails=False)]
+    futures = [
+        thread.rotate(page=page_id, angle=90, return_future=True)
+        for page_id in page_ids
+    ]
+    concurrent.futures.wait(futures, timeout=10)
+    for future, page_id in zip(futures, page_ids):
+        assert future.exception() is None
+        assert future.data[0]["replace"] == page_id
+        page = thread.get_page(id=future.data[0]["row"][2])
+        assert page.image_object.size == (10, 20)
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_upgrade_page_order(temp_db, clean_up_files):
+    "test sessions with a copy of page_order for every action are upgraded"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    thread.add_page(Page(image_object=Image.new("L", (10, 10))), number=1)
+    thread.add_page(Page(image_object=Image.new("L", (10, 10))), number=2)
+    page_ids = [row[2] for row in thread.page_number_table(thumbnails=False)]
+
+    # rewrite page_order as written by older versions: actions 1 to 4 with
+    # page 2 deleted by action 3 and restored by action 4
+    thread._execute("DROP TABLE page_order")
+    thread._execute(
+        """CREATE TABLE page_order(
+            action_id INTEGER NOT NULL,
+            row_id INTEGER NOT NULL,
+            page_number INTEGER NOT NULL,
+            page_id INTEGER NOT NULL,
+            PRIMARY KEY (action_id, row_id))"""
+    )
+    rows = [(1, 0, 1, page_ids[0])]
+    for action_id in (2, 3, 4):
+        rows.append((action_id, 0, 1, page_ids[0]))
+        if action_id != 3:
+            rows.append((action_id, 1, 2, page_ids[1]))
+    thread._executemany("INSERT INTO page_order VALUES (?, ?, ?, ?)", rows)
+    thread._executemany(
+        "INSERT INTO selection (action_id, row_ids) VALUES (?, '[]')",
+        [(3,), (4,)],
+    )
+    thread._execute("DROP INDEX image_hash")
+    thread._execute("ALTER TABLE image DROP COLUMN hash")
+    thread._execute("ALTER TABLE image DROP COLUMN source")
+    thread._execute("PRAGMA user_version = 1")
+    thread._con[threading.get_native_id()].commit()
+
+    thread.open(temp_db.name)
+    assert thread._action_id == 4
+    thread._execute("SELECT COUNT(*) FROM page_order")
+    assert thread._fetchone()[0] == 3
+    expected = {4: page_ids, 3: page_ids[:1], 2: page_ids}
+    for action_id, ids in expected.items():
+        thread._action_id = action_id
+        assert [row[2] for row in thread.page_number_table(thumbnails=False)] == ids
+    thread._execute("PRAGMA user_version")
+    assert thread._fetchone()[0] == USER_VERSION
+
+    # the images without a hash are hashed when compared
+    page = thread.get_page(id=page_ids[0])
+    assert thread._insert_image(page, if_different_from=page.image_id)[0] == (
+        page.image_id
+    )
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_image_source(temp_db, clean_up_files, tmp_path):
+    "test the original bitstream is kept only for the unchanged image"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    Image.new("RGB", (20, 10), "red").save(tmp_path / "in.jpg")
+
+    thread.add_page(Page(filename=tmp_path / "in.jpg"), number=1)
+    page = thread.get_page(number=1)
+    assert page.source is None, "not loaded with the page"
+    assert thread._image_source(page) == (tmp_path / "in.jpg").read_bytes()
+
+    page.image_object = page.image_object.rotate(90, expand=True)
+    thread.replace_page(page, 1)
+    assert thread._image_source(thread.get_page(number=1)) is None
+
+    thread.keep_image_source = False
+    Image.new("RGB", (20, 10), "blue").save(tmp_path / "in.jpg")
+    thread.add_page(Page(filename=tmp_path / "in.jpg"), number=2)
+    page = thread.get_page(number=2)
+    assert thread._image_source(page) is None, "disabled"
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_image_deduplication(temp_db, clean_up_files, mocker):
+    "test identical images share a row"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+
+    def count_images():
+        thread._execute("SELECT COUNT(*) FROM image")
+        return thread._fetchone()[0]
+
+    thread.add_page(Page(image_object=Image.new("RGB", (10, 10), "white")), number=1)
+    thread.add_page(Page(image_object=Image.new("RGB", (10, 10), "white")), number=2)
+    assert count_images() == 1
+    thread.add_page(Page(image_object=Image.new("L", (10, 10), 255)), number=3)
+    assert count_images() == 2, "same pixels, but a different mode"
+
+    page = thread.get_page(number=3)
+    thread.replace_page(page, 3)
+    assert thread.get_page(number=3).image_id == page.image_id, "no-op edit"
+
+    page_ids = [row[2] for row in thread.page_number_table(thumbnails=False)]
+    thread.do_clone_pages(mocker.Mock(args=[{"page_ids": page_ids, "dest": 3}]))
+    assert len(thread.page_number_table(thumbnails=False)) == 6
+    assert count_images() == 2
+    assert thread.get_page(number=6).image_object.mode == "L"
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_bulk_import(temp_db, clean_up_files, mocker):
+    "test pages imported in bulk are a single undo step, reported once committed"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    thread.add_page(Page(image_object=Image.new("L", (10, 10), 0)), number=1)
+    action_id = thread._action_id
+
+    def check_committed(response):
+        con = sqlite3.connect(temp_db.name)
+        page_id = response["row"][2]
+        assert con.execute("SELECT id FROM page WHERE id = ?", (page_id,)).fetchone()
+        con.close()
+
+    request = mocker.Mock()
+    request.data.side_effect = check_committed
+    with thread.bulk_import():
+        for i in range(1, 4):
+            thread._add_imported_page(
+                request, Page(image_object=Image.new("L", (10, 10), i))
+            )
+    assert [call.args[0]["row"][0] for call in request.data.call_args_list] == [
+        2,
+        3,
+        4,
+    ]
+    assert thread._action_id == action_id + 1
+    assert len(thread.page_number_table(thumbnails=False)) == 4
+    thread.undo()
+    assert len(thread.page_number_table(thumbnails=False)) == 1
+
+    # without the bulk import, each page is a separate step
+    thread.redo()
+    thread._add_imported_page(request, Page(image_object=Image.new("L", (10, 10))))
+    assert thread._action_id == action_id + 2
+    thread.quit()
+    clean_up_files(thread.db_files)
+
+
+def test_undo_limit_and_garbage_collection(temp_db, clean_up_files, mocker):
+    "test old undo steps are pruned, and unreferenced rows deleted"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    thread.do_set_undo_limit(mocker.Mock(args=(2, None)))
+    thread.add_page(Page(image_object=Image.new("L", (10, 10))), number=1)
+    for i in range(4):
+        page_id = thread.page_number_table(thumbnails=False)[0][2]
+        thread.replace_page(
+            Page(image_object=Image.new("L", (10, 10), i + 1), id=page_id), 1
+        )
+    thread._execute("SELECT MIN(action_id), MAX(action_id) FROM page_order")
+    assert thread._fetchone() == (thread._action_id - 2, thread._action_id)
+    assert thread._gc_pending
+
+    while thread._collect_garbage():
+        pass
+    for table in ["page", "image"]:
+        thread._execute(f"SELECT COUNT(*) FROM {table}")
+        assert thread._fetchone()[0] == 3, f"only the retained {table}s are kept"
+
+    thread.undo()
+    thread.undo()
+    with pytest.raises(StopIteration):
+        thread.undo()
+
+    thread.redo()
+    thread.redo()
+
+    # over budget, so drop all but the current step
+    thread.do_set_undo_limit(mocker.Mock(args=(None, 0)))
+    while thread._collect_garbage():
+        pass
+    assert not thread.can_undo()
+    thread._execute("SELECT COUNT(*) FROM image")
+    assert thread._fetchone()[0] == 1
+    assert thread.get_page(number=1).image_object.getpixel((0, 0)) == 4
+    thread.quit()
+    clean_up_files(thread.db_files)
@@ -103,76 +103,36 @@ def test_get_file_info_finished_callback2_no_pagerange():
     )
 
 
-def test_post_process_rotate():
-    "test _post_process_rotate"
-    doc = create_doc()
-    doc.rotate = unittest.mock.Mock()
-    options = {"rotate": 90, "finished_callback": unittest.mock.Mock()}
-    doc._post_process_rotate("uuid", options)
-    doc.rotate.assert_called()
-
-    updated_page_callback = doc.rotate.call_args[1]["updated_page_callback"]
-    with unittest.mock.patch.object(doc, "_post_process_scan") as mock_pps:
-        updated_page_callback(MockResponse({"type": "page", "row": [0, 0, "new_uuid"]}))
-        mock_pps.assert_called_with("new_uuid", options)
-
-
-def test_post_process_unpaper():
-    "test _post_process_unpaper"
+def test_import_scan():
+    "test import_scan compiles the post-processing into a single request"
     doc = create_doc()
-    doc.unpaper = unittest.mock.Mock()
+    doc.thread.import_scan = unittest.mock.Mock()
+    doc.add_page = unittest.mock.Mock()
     unpaper_obj = unittest.mock.Mock()
-    options = {"unpaper": unpaper_obj, "finished_callback": unittest.mock.Mock()}
-    doc._post_process_unpaper("uuid", options)
-    doc.unpaper.assert_called()
-
-    updated_page_callback = doc.unpaper.call_args[1]["updated_page_callback"]
-    with unittest.mock.patch.object(doc, "_post_process_scan") as mock_pps:
-        updated_page_callback(MockResponse({"type": "page", "row": [0, 0, "new_uuid"]}))
-        mock_pps.assert_called()
-
-
-def test_post_process_udt():
-    "test _post_process_udt"
-    doc = create_doc()
-    doc.user_defined = unittest.mock.Mock()
-    options = {"udt": "cmd", "finished_callback": unittest.mock.Mock()}
-    doc._post_process_udt("uuid", options)
-    doc.user_defined.assert_called()
-
-    updated_page_callback = doc.user_defined.call_args[1]["updated_page_callback"]
-    with unittest.mock.patch.object(doc, "_post_process_scan") as mock_pps:
-        updated_page_callback(MockResponse({"type": "page", "row": [0, 0, "new_uuid"]}))
-        mock_pps.assert_called()
-
-
-def test_post_process_ocr():
-    "test _post_process_ocr"
-    doc = create_doc()
-    doc.ocr_pages = unittest.mock.Mock()
-    options = {
-        "ocr": True,
-        "engine": "t",
-        "language": "l",
-        "finished_callback": unittest.mock.Mock(),
+    unpaper_obj.get_cmdline.return_value = ["unpaper"]
+    unpaper_obj.get_option.return_value = "ltr"
+    doc.import_scan(
+        resolution=300,
+        page=1,
+        rotate=90,
+        unpaper=unpaper_obj,
+        udt="cmd",
+        ocr=True,
+        engine="tesseract",
+        language="eng",
+    )
+    kwargs = doc.thread.import_scan.call_args[1]
+    assert kwargs["page_options"] == {
+        "resolution": 300,
+        "format": "Portable anymap",
     }
-    doc._post_process_ocr("uuid", options)
-    doc.ocr_pages.assert_called()
+    assert kwargs["rotate"] == 90
+    assert kwargs["unpaper"] == {"command": ["unpaper"], "direction": "ltr"}
+    assert kwargs["udt"] == "cmd"
+    assert kwargs["ocr"] and kwargs["language"] == "eng"
 
-    ocr_finished_callback = doc.ocr_pages.call_args[1]["finished_callback"]
-    with unittest.mock.patch.object(doc, "_post_process_scan") as mock_pps:
-        ocr_finished_callback(None)
-        mock_pps.assert_called_with(None, options)
-
-
-def test_import_scan():
-    "test import_scan"
-    doc = create_doc()
-    doc.import_scan(resolution=300, rotate=None)
-    data_callback = doc.thread.import_page.call_args[1]["data_callback"]
-    with unittest.mock.patch.object(doc, "_post_process_scan") as mock_pps:
-        data_callback(MockResponse({"type": "page", "row": [0, 0, "uuid"]}))
-        mock_pps.assert_called()
+    kwargs["data_callback"](MockResponse({"type": "page", "row": [1, 0, "uuid"]}))
+    doc.add_page.assert_called_once()
 
 
 def test_split_page():
@@ -56,6 +56,25 @@ def test_exec_command_success(mocker):
     pidfile.write.assert_called_with("1234")
 
 
+def test_exec_command_pids(mocker):
+    "Test exec_command keeps the PID in the set whilst the process runs"
+    mock_popen = mocker.patch("subprocess.Popen")
+    proc = mock_popen.return_value.__enter__.return_value
+    proc.pid = 1234
+    pids = set()
+
+    def communicate():
+        assert pids == {1234}
+        return ("stdout", "stderr")
+
+    proc.communicate.side_effect = communicate
+    proc.returncode = 0
+
+    exec_command(["ls"], pids=pids)
+    proc.communicate.assert_called_once()
+    assert not pids
+
+
 def test_exec_command_filenotfound(mocker):
     "Test exec_command file not found"
     mocker.patch("subprocess.Popen", side_effect=FileNotFoundError("not found"))
@@ -0,0 +1,52 @@
+"Tests for the decoded page cache"
+
+from PIL import Image
+from imagecache import ImageCache, image_bytes
+
+
+def test_image_bytes():
+    "test image_bytes"
+    assert image_bytes(Image.new("1", (10, 10))) == 100
+    assert image_bytes(Image.new("L", (10, 10))) == 100
+    assert image_bytes(Image.new("I;16", (10, 10))) == 200
+    assert image_bytes(Image.new("RGB", (10, 10))) == 400
+
+
+def test_lru():
+    "test hits, misses and eviction of the least recently used"
+    cache = ImageCache(250)
+    assert cache.get(1) is None
+    for key in (1, 2):
+        cache.put(key, Image.new("L", (10, 10), key))
+    assert cache.get(1).getpixel((0, 0)) == 1
+    cache.put(3, Image.new("L", (10, 10)))
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    assert cache.cache_info() == (2, 2, 250, 200, 2)
+
+    cache.put(4, Image.new("L", (100, 100)))
+    assert cache.cache_info().count == 2, "images larger than the cache are ignored"
+    cache.resize(100)
+    assert cache.cache_info().currsize == 100
+
+
+def test_get_returns_copy():
+    "test that modifying the returned image does not change the cache"
+    cache = ImageCache(1000)
+    cache.put(1, Image.new("L", (10, 10)))
+    cache.get(1).putpixel((0, 0), 255)
+    assert cache.get(1).getpixel((0, 0)) == 0
+
+
+def test_invalidate():
+    "test invalidate, retain and clear"
+    cache = ImageCache(1000)
+    for key in range(4):
+        cache.put(key, Image.new("L", (10, 10)))
+    cache.invalidate([0, 5])
+    assert cache.get(0) is None
+    cache.retain([1, 2])
+    assert cache.get(3) is None
+    assert cache.cache_info().currsize == 200
+    cache.clear()
+    assert cache.cache_info().count == 0
@@ -0,0 +1,60 @@
+"Tests for the image blob codecs"
+
+import io
+import pytest
+from PIL import Image
+import imagecodec
+
+
+@pytest.mark.parametrize("codec", imagecodec.available_codecs())
+@pytest.mark.parametrize("mode", ["1", "L", "P", "RGB", "RGBA", "CMYK"])
+def test_round_trip(codec, mode):
+    "test that images survive encoding and decoding unchanged"
+    if codec == "png" and mode == "CMYK":
+        pytest.skip("PNG does not support CMYK")
+    image = Image.linear_gradient("L").resize((33, 17)).convert(mode)
+    blob = imagecodec.encode(image, codec)
+    assert imagecodec.codec_name(blob) == codec
+    decoded = imagecodec.decode(blob)
+    assert decoded.mode == image.mode
+    assert decoded.size == image.size
+    assert decoded.tobytes() == image.tobytes()
+    if mode == "P":
+        assert decoded.getpalette() == image.getpalette()
+
+
+def test_legacy_png():
+    "test that blobs written by PIL without a header still decode"
+    image = Image.new("RGB", (5, 3), (1, 2, 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    blob = buffer.getvalue()
+    assert imagecodec.codec_name(blob) == "png"
+    assert imagecodec.decode(blob).tobytes() == image.tobytes()
+
+
+def test_errors(mocker):
+    "test unknown and unavailable codecs"
+    image = Image.new("L", (2, 2))
+    with pytest.raises(ValueError):
+        imagecodec.encode(image, "jpeg")
+    blob = imagecodec.encode(image, "raw")
+    mocker.patch("imagecodec.zstd", None)
+    assert "zstd" not in imagecodec.available_codecs()
+    with pytest.raises(ValueError):
+        imagecodec.encode(image, "zstd")
+    with pytest.raises(ValueError):
+        imagecodec.decode(blob[:4] + bytes([imagecodec.ZSTD]) + blob[5:])
+
+
+def test_digest():
+    "test the digest depends on the pixels, not the codec"
+    image = Image.new("RGB", (10, 10), "white")
+    digest = imagecodec.digest(image)
+    for codec in imagecodec.available_codecs():
+        decoded = imagecodec.decode(imagecodec.encode(image, codec))
+        assert imagecodec.digest(decoded) == digest
+    assert imagecodec.digest(image.convert("L")) != digest
+    assert imagecodec.digest(image.resize((20, 5))) != digest
+    image.putpixel((5, 5), (0, 0, 0))
+    assert imagecodec.digest(image) != digest
@@ -0,0 +1,81 @@
+"Tests for the pure pixel operations"
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from PIL import Image
+import imageops
+
+
+def test_rotate():
+    "test rotate"
+    image = Image.new("RGB", (20, 10))
+    assert imageops.rotate(image, 90).size == (10, 20)
+    assert imageops.rotate(image, 180).size == (20, 10)
+
+
+def test_threshold():
+    "test threshold"
+    image = Image.new("L", (2, 1))
+    image.putpixel((0, 0), 100)
+    image.putpixel((1, 0), 200)
+    image = imageops.threshold(image, 150)
+    assert image.mode == "1"
+    assert image.getpixel((0, 0)) == 0
+    assert image.getpixel((1, 0)) == 255
+
+
+def test_negate():
+    "test negate"
+    image = imageops.negate(Image.new("RGBA", (1, 1), (255, 255, 255, 255)))
+    assert image.mode == "RGB"
+    assert image.getpixel((0, 0)) == (0, 0, 0)
+
+
+def test_crop():
+    "test crop"
+    image = imageops.crop(Image.new("RGB", (20, 10)), 2, 3, 5, 4)
+    assert image.size == (5, 4)
+
+
+def test_analyse():
+    "test analyse"
+    mean, std_dev = imageops.analyse(Image.new("L", (10, 10), 255))
+    assert mean == [255.0]
+    assert std_dev == [0.0]
+
+
+def test_operation_args():
+    "test operation_args"
+    func, args = imageops.operation_args(
+        "crop", {"page": 1, "x": 1, "y": 2, "w": 3, "h": 4, "dir": "/tmp"}
+    )
+    assert func == imageops.crop
+    assert args == [1, 2, 3, 4]
+    func, args = imageops.operation_args("negate", {"page": 1})
+    assert func == imageops.negate
+    assert args == []
+
+
+def test_chain():
+    "test a chain of operations is applied in order"
+    steps = imageops.chain_args(
+        [
+            ("rotate", {"angle": 90}),
+            ("crop", {"x": 0, "y": 0, "w": 10, "h": 5}),
+            ("threshold", {"threshold": 60}),
+        ]
+    )
+    assert steps == [("rotate", [90]), ("crop", [0, 0, 10, 5]), ("threshold", [60])]
+    image = imageops.chain(Image.new("L", (20, 10), 100), steps)
+    assert image.size == (10, 5)
+    assert image.mode == "1"
+
+
+def test_process_pool():
+    "test that the operations can be run in a worker process"
+    image = Image.new("RGB", (20, 10), (255, 0, 0))
+    with ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        futures = [pool.submit(imageops.rotate, image, angle) for angle in (90, 180)]
+        assert [future.result().size for future in futures] == [(10, 20), (20, 10)]
@@ -4,7 +4,8 @@ import subprocess
 import unittest.mock
 from types import SimpleNamespace
 import pytest
-from importthread import Importhread
+from PIL import Image
+from importthread import Importhread, _pdfimages_by_page, _pdftotext_pages
 from helpers import Proc
 
 
@@ -154,96 +155,175 @@ def test_get_pdf_info_error(mock_run):
     mock_request.error.assert_called_once_with("Permission denied")
 
 
-@unittest.mock.patch("subprocess.run")
-@unittest.mock.patch("subprocess.check_output")
-def test_get_pdf_images_error(mock_co, mock_run):
-    "Test that request.error is thrown when pdfimages returns error"
-    mock_co.return_value = """page   num  type   width height color comp bpc  enc interp  object ID x-ppi y-ppi size ratio
+PDFIMAGES_LIST = """page   num  type   width height color comp bpc  enc interp  object ID x-ppi y-ppi size ratio
 --------------------------------------------------------------------------------------------
    1     0 image     157   196  gray    1   1  ccitt  no   [inline]      72    72    0B 0.0%
 """
-    mock_run.side_effect = subprocess.CalledProcessError(
-        returncode=1,
-        cmd=["pdfimages", "-f"],
-        output="",
-        stderr="Permission denied",
-    )
-    thread = Importhread()
-    mock_request = unittest.mock.Mock()
-    mock_request.args = (
+
+
+def _pdf_request():
+    request = unittest.mock.Mock()
+    request.args = (
         {
             "first": 1,
             "last": 1,
             "dir": "/tmp",
             "password": "",
             "info": {
-                "path": "/to/file.djvu",
+                "path": "/to/file.pdf",
             },
         },
         None,
     )
+    return request
+
+
+def _mock_poppler(mocker, returncode=0, text_returncode=0, images=()):
+    """mock pdfimages -list, and the pdfimages process printing the given
+    images, and the pdftotext process, which is returned"""
+    mocker.patch("subprocess.check_output", return_value=PDFIMAGES_LIST)
+    procs = []
+    for code, stdout in (
+        (returncode, [f"{fname}\n" for fname in images]),
+        (text_returncode, []),
+    ):
+        proc = mocker.MagicMock()
+        proc.__enter__.return_value.poll.return_value = code
+        proc.__enter__.return_value.wait.return_value = code
+        proc.__enter__.return_value.stdout = iter(stdout)
+        procs.append(proc)
+    mocker.patch("subprocess.Popen", side_effect=procs)
+    return procs[1].__enter__.return_value
+
+
+def test_get_pdf_images_error(mocker):
+    "Test that request.error is thrown when pdfimages returns error"
+    _mock_poppler(mocker, returncode=1)
+    thread = Importhread()
+    mock_request = _pdf_request()
     thread._do_import_pdf(mock_request)
     mock_request.error.assert_called_once_with("Error extracting images from PDF")
 
 
-@unittest.mock.patch("subprocess.run")
-@unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
-@unittest.mock.patch("importthread.Page")
-def test_import_pdf_image_error(mock_page, mock_glob, mock_co, _mock_run):
+def test_import_pdf_image_error(mocker):
     "Test that request.error is thrown when importing individual images fails"
-    mock_co.return_value = """page   num  type   width height color comp bpc  enc interp  object ID x-ppi y-ppi size ratio
---------------------------------------------------------------------------------------------
-   1     0 image     157   196  gray    1   1  ccitt  no   [inline]      72    72    0B 0.0%
-"""
-
     # Simulate the presence of image files
-    mock_glob.return_value = ["x-01.pnm"]
+    _mock_poppler(mocker, images=["/tmp/x/x-001-000.pnm"])
 
     # Simulate an error during Page initialization
-    mock_page.side_effect = PermissionError("Error importing PDF")
+    mocker.patch("importthread.Page", side_effect=PermissionError("Error"))
 
     thread = Importhread()
-    mock_request = unittest.mock.Mock()
-    mock_request.args = (
-        {
-            "first": 1,
-            "last": 1,
-            "dir": "/tmp",
-            "password": "",
-            "info": {
-                "path": "/to/file.pdf",
-            },
-        },
-        None,
-    )
-
-    # Call the method
+    mock_request = _pdf_request()
     thread._do_import_pdf(mock_request)
-
-    # Assert that the error was logged and the request.error was called
     mock_request.error.assert_called_once_with("Error importing PDF")
 
 
-@unittest.mock.patch("subprocess.run")
-def test_extract_text_from_pdf_error(mock_run):
+def test_import_pdf_text_error(mocker):
     "Test that request.error is thrown when pdftotext fails"
-    # Simulate a subprocess error when running pdftotext
-    mock_run.return_value = unittest.mock.Mock(returncode=1)
+    _mock_poppler(mocker, text_returncode=1, images=["/tmp/x/x-001-000.pnm"])
+    mock_page = mocker.patch("importthread.Page")
+    mocker.patch("os.remove")
 
     thread = Importhread()
-    mock_request = unittest.mock.Mock()
-    mock_request.args = (
-        {
-            "info": {
-                "path": "/to/file.pdf",
-            },
-            "dir": "/tmp",
-            "password": "",
-        },
-        None,
+    thread.add_page = unittest.mock.Mock()
+    mock_request = _pdf_request()
+    thread._do_import_pdf(mock_request)
+    assert mock_page.call_args.kwargs["resolution"] == (72, 72, "PixelsPerInch")
+    mock_request.error.assert_called_once_with("Error extracting text layer from PDF")
+
+
+def test_pdfimages_by_page(mocker):
+    "Test that pages are yielded as soon as pdfimages starts the next page"
+    printed = []
+
+    def stdout():
+        for fname in ["x-001-000.ppm", "x-002-000.ppm", "x-002-001.ppm"]:
+            printed.append(fname)
+            yield f"/tmp/{fname}\n"
+
+    proc = mocker.Mock()
+    proc.stdout = stdout()
+    proc.wait.return_value = 0
+    pages = _pdfimages_by_page(proc, 1, 3, lambda: None)
+
+    assert next(pages) == (1, ["/tmp/x-001-000.ppm"])
+    assert len(printed) == 2, "page 1 is yielded before pdfimages finishes"
+    proc.wait.assert_not_called()
+
+    # page 3 has no images
+    assert next(pages) == (2, ["/tmp/x-002-000.ppm", "/tmp/x-002-001.ppm"])
+    assert list(pages) == [(3, [])]
+
+
+def test_pdfimages_by_page_error(mocker):
+    "Test that the images of the page are None if pdfimages fails"
+    proc = mocker.Mock()
+    proc.stdout = iter(["/tmp/x-001-000.ppm\n"])
+    proc.wait.return_value = 1
+    assert list(_pdfimages_by_page(proc, 1, 2, lambda: None)) == [(1, None)]
+
+
+def test_pdftotext_pages():
+    "Test that the output of pdftotext -bbox is split by page"
+    html = """<html>
+<body>
+<doc>
+  <page width="10" height="20">
+    <word xMin="1" yMin="2" xMax="3" yMax="4">one</word>
+  </page>
+  <page width="10" height="20">
+  </page>
+</doc>
+</body>
+</html>
+"""
+    pages = list(_pdftotext_pages(html.splitlines(keepends=True)))
+    assert len(pages) == 2
+    assert ">one</word>" in pages[0]
+    assert (
+        pages[1]
+        == """<html>
+<body>
+<doc>
+  <page width="10" height="20">
+  </page>
+</doc>
+</body>
+</html>
+"""
     )
 
-    # Call the method and check for the error
-    thread._extract_text_from_pdf(mock_request, 1)
-    mock_request.error.assert_called_once_with("Error extracting text layer from PDF")
+
+def test_import_pdf_text_layer(tmp_path, mocker):
+    "Test that the text layer of an imported PDF is attached to its page"
+    image = tmp_path / "x-001-000.pnm"
+    Image.new("RGB", (72, 72), "white").save(image)
+    proc = _mock_poppler(mocker, images=[str(image)])
+    proc.stdout = iter(
+        """<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<title></title>
+</head>
+<body>
+<doc>
+  <page width="72.000000" height="72.000000">
+    <word xMin="1.000000" yMin="2.000000" xMax="30.000000" yMax="12.000000">one</word>
+  </page>
+</doc>
+</body>
+</html>
+""".splitlines(
+            keepends=True
+        )
+    )
+    mocker.patch("os.remove")
+
+    thread = Importhread()
+    thread._add_imported_page = unittest.mock.Mock()
+    mock_request = _pdf_request()
+    thread._do_import_pdf(mock_request)
+    mock_request.error.assert_not_called()
+    page = thread._add_imported_page.call_args.args[1]
+    assert page.text_layer is not None
+    assert '"text": "one"' in page.text_layer
@@ -0,0 +1,55 @@
+"Tests for pdftext.py"
+
+import io
+import json
+import img2pdf
+import pikepdf
+from PIL import Image
+from pdftext import text_stream, add_text_layers
+
+
+def test_text_stream():
+    "test the text is drawn invisibly, stretched to fill each box"
+    assert text_stream(None, 100) is None
+    layer = [{"type": "page", "bbox": [0, 0, 200, 100], "depth": 0}]
+    assert text_stream(json.dumps(layer), 100) is None, "no text"
+
+    layer.append({"type": "word", "bbox": [10, 20, 110, 40], "text": "€ab", "depth": 1})
+    stream = text_stream(json.dumps(layer), 100)
+    assert stream == (
+        b"BT 3 Tr\n/FGlyphLess 20.00 Tf 250.00 Tz 1 0 0 1 10 60.00 Tm "
+        b"<20ac006100620020> Tj\nET\n"
+    )
+
+    # characters outside the BMP are drawn as surrogate pairs
+    layer[1]["text"] = "\U0001f600\U00020000"
+    stream = text_stream(json.dumps(layer), 100)
+    assert b"20.00 Tf 200.00 Tz" in stream
+    assert b"<d83dde00d840dc000020> Tj" in stream
+
+    stream = text_stream(
+        json.dumps([{"type": "page", "bbox": [0, 0, 200, 100], "text": "a\nb"}]), 100
+    )
+    assert b"1 0 0 1 0 50.00 Tm <00610020>" in stream, "first line in top half"
+    assert b"1 0 0 1 0 0.00 Tm <00620020>" in stream, "second line in bottom half"
+
+
+def test_add_text_layers():
+    "test the text layers are scaled to the pages and share one font"
+    image = io.BytesIO()
+    Image.new("L", (200, 100)).save(image, format="PNG")
+    layout = img2pdf.get_fixed_dpi_layout_fun((100, 100))
+    data = img2pdf.convert([image.getvalue()] * 3, layout_fun=layout)
+    layer = json.dumps([{"type": "word", "bbox": [0, 0, 200, 100], "text": "a"}])
+    stream = text_stream(layer, 100)
+
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        add_text_layers(pdf, [(stream, 200, 100), None, (stream, 200, 100)])
+        pages = pdf.pages
+        assert "/Font" not in pages[1].Resources
+        font = pages[0].Resources.Font.FGlyphLess
+        assert font.objgen == pages[2].Resources.Font.FGlyphLess.objgen
+        assert font.Subtype == "/Type0"
+        assert b"<0000> <FFFF> <0000>" in font.ToUnicode.read_bytes()
+        content = pages[0].obj.Contents.as_list()[-1].read_bytes()
+        assert content == b"q 0.720000 0 0 0.720000 0 0 cm\n" + stream + b"Q\n"
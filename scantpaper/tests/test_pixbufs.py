@@ -0,0 +1,49 @@
+"Tests for the PIL <-> GdkPixbuf conversions"
+
+import io
+import pytest
+from PIL import Image
+from pixbufs import image_to_pixbuf, bytes_to_pixbuf
+
+
+@pytest.mark.parametrize(
+    "mode,alpha",
+    [
+        ("1", False),
+        ("L", False),
+        ("P", False),
+        ("RGB", False),
+        ("RGBA", True),
+        ("LA", True),
+        ("CMYK", False),
+    ],
+)
+def test_image_to_pixbuf(mode, alpha):
+    "test all the common modes give a pixbuf of the correct size"
+    image = Image.new("RGB", (7, 5), (255, 255, 255)).convert(mode)
+    pixbuf = image_to_pixbuf(image)
+    assert (pixbuf.get_width(), pixbuf.get_height()) == (7, 5)
+    assert pixbuf.get_has_alpha() == alpha
+    assert pixbuf.get_pixels()[:3] == b"\xff\xff\xff"
+
+
+def test_image_to_pixbuf_16bit():
+    "test that 16-bit images are scaled, rather than clipped, to 8-bit"
+    pixbuf = image_to_pixbuf(Image.new("I;16", (1, 1), 32768))
+    assert not pixbuf.get_has_alpha()
+    assert pixbuf.get_pixels()[:3] == b"\x80\x80\x80"
+
+
+def test_image_to_pixbuf_at_scale():
+    "test scaling"
+    pixbuf = image_to_pixbuf(Image.new("1", (100, 50)), 10.4, 5)
+    assert (pixbuf.get_width(), pixbuf.get_height()) == (10, 5)
+
+
+def test_bytes_to_pixbuf():
+    "test decoding a PNG"
+    buffer = io.BytesIO()
+    Image.new("RGB", (3, 2), (255, 0, 0)).save(buffer, format="PNG")
+    pixbuf = bytes_to_pixbuf(buffer.getvalue())
+    assert (pixbuf.get_width(), pixbuf.get_height()) == (3, 2)
+    assert pixbuf.get_pixels()[:3] == b"\xff\x00\x00"
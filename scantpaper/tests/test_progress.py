@@ -99,6 +99,12 @@ def test_progress_update():
     # "Process 3 of 10"
     assert "Process" in pbar.get_text()
 
+    # Test update with progress through the pages of the request
+    response.info = {"type": "page", "progress": 0.25, "message": "OCR page 1 of 4"}
+    progress.update(response)
+    assert pbar.get_text() == "OCR page 1 of 4"
+    assert abs(pbar.get_fraction() - 0.25) < 0.001
+
 
 def test_progress_finish():
     "Test finish method"
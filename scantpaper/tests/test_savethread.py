@@ -1,8 +1,14 @@
 "Tests for savethread.py"
 
 import datetime
+from functools import partial
+import threading
+import time
 from unittest.mock import MagicMock, patch, mock_open
 import pytest
+from PIL import Image
+import img2pdf
+import pikepdf
 from savethread import (
     SaveThread,
     prepare_output_metadata,
@@ -13,6 +19,8 @@ from savethread import (
     _add_annotations_to_pdf,
 )
 from basethread import Request
+from bboxtree import Bboxtree
+from importthread import CancelledError
 from page import Page
 
 
@@ -83,6 +91,27 @@ def mock_page_instance():
 # pylint: disable=redefined-outer-name
 
 
+def test_map_in_threads(mock_thread_instance):
+    "test jobs are read lazily, at most two per worker ahead, with results in order"
+    thread = mock_thread_instance
+    read, results = [], []
+
+    def jobs():
+        for i in range(5):
+            read.append(i)
+            yield (i,)
+
+    def callback(done, args, result):
+        assert len(read) - done < 2 * 2, "at most two jobs per worker in memory"
+        results.append((done, args, result))
+
+    # the first job is the slowest, so the others finish before it
+    thread._map_in_threads(
+        jobs(), lambda i: time.sleep(0.1 if i == 0 else 0) or i * i, callback, 2
+    )
+    assert results == [(i + 1, (i,), i * i) for i in range(5)]
+
+
 def test_save_pdf(mock_thread_instance, mock_page_instance):
     "Test save_pdf method"
     mock_thread_instance.mock_pages[1] = mock_page_instance
@@ -101,10 +130,8 @@ def test_save_pdf(mock_thread_instance, mock_page_instance):
     ), patch("savethread.open", mock_open()), patch(
         "savethread.img2pdf.convert", return_value=b"pdf_data"
     ) as mock_img2pdf, patch(
-        "savethread.ocrmypdf.api._pdf_to_hocr"
-    ) as mock_pdf_to_hocr, patch(
-        "savethread.ocrmypdf.api._hocr_to_ocr_pdf"
-    ) as mock_hocr_to_ocr_pdf, patch(
+        "savethread.pikepdf.open"
+    ) as mock_pikepdf_open, patch(
         "savethread.os.remove"
     ), patch(
         "savethread._set_timestamp"
@@ -120,48 +147,51 @@ def test_save_pdf(mock_thread_instance, mock_page_instance):
         mock_thread_instance.do_save_pdf(request)
 
         assert mock_img2pdf.called
-        assert mock_pdf_to_hocr.called
-        assert mock_hocr_to_ocr_pdf.called
-        assert mock_page_instance.write_image_for_pdf.called
+        mock_pikepdf_open.return_value.__enter__.return_value.save.assert_called_once()
+        mock_page_instance.write_image_for_pdf.assert_called_once()
+        assert mock_page_instance.write_image_for_pdf.call_args[0][2] is None
+        assert mock_img2pdf.call_args[1]["rotation"] == img2pdf.Rotation.none
         assert mock_post_save_hook.called
 
 
-def test_save_pdf_with_hocr(mock_thread_instance, mock_page_instance):
-    "Test save_pdf method with HOCR"
-    mock_page_instance.text_layer = "some text layer data"
-    mock_thread_instance.mock_pages[1] = mock_page_instance
-
+def test_save_pdf_with_text_layer(mock_thread_instance, tmp_path):
+    "Test save_pdf method adds the text layers of the pages"
+    mock_thread_instance.processes = 2
+    for i in range(1, 4):
+        page = Page(image_object=Image.new("RGB", (300, 150), "white"))
+        page.get_size()
+        page.resolution = (150, 150, "PixelsPerInch")
+        if i != 2:
+            tree = Bboxtree()
+            tree.from_text(f"page {i}", 300, 150)
+            page.text_layer = tree.json()
+        mock_thread_instance.mock_pages[i] = page
     options = {
-        "dir": "/tmp",
-        "path": "/tmp/output.pdf",
-        "list_of_pages": [1],
+        "dir": tmp_path,
+        "path": str(tmp_path / "output.pdf"),
+        "list_of_pages": [1, 2, 3],
         "metadata": {"datetime": datetime.datetime.now()},
         "options": {},
     }
     request = Request("save_pdf", (options,), mock_thread_instance.responses)
 
-    with patch("savethread.tempfile.TemporaryDirectory"), patch(
-        "savethread.tempfile.NamedTemporaryFile"
-    ), patch("savethread.open", mock_open()), patch(
-        "savethread.img2pdf.convert", return_value=b"pdf_data"
-    ), patch(
-        "savethread.ocrmypdf.api._pdf_to_hocr"
-    ), patch(
-        "savethread.ocrmypdf.api._hocr_to_ocr_pdf"
-    ), patch(
-        "savethread.os.remove"
-    ), patch(
-        "savethread._set_timestamp"
-    ), patch(
-        "savethread._post_save_hook"
-    ), patch(
-        "savethread.pathlib.Path"
-    ):
-
+    with patch("savethread._post_save_hook"):
         mock_thread_instance.do_save_pdf(request)
 
-        # Verify HOCR was exported/written
-        assert mock_page_instance.export_hocr.called
+    with pikepdf.open(options["path"]) as pdf:
+        assert len(pdf.pages) == 3
+        assert [float(value) for value in pdf.pages[0].mediabox] == [0, 0, 144, 72]
+        for i, page in enumerate(pdf.pages):
+            fonts = page.Resources.get("/Font", {})
+            if i == 1:
+                assert "/FGlyphLess" not in fonts, "page without text"
+                continue
+            assert "/FGlyphLess" in fonts
+            content = b"".join(
+                stream.read_bytes() for stream in page.obj.Contents.as_list()
+            )
+            assert f"page {i + 1} ".encode("utf-16-be").hex().encode() in content
+    assert mock_thread_instance.progress == 1
 
 
 def test_save_djvu(mock_thread_instance, mock_page_instance):
@@ -193,6 +223,9 @@ def test_save_djvu(mock_thread_instance, mock_page_instance):
         mock_thread_instance.do_save_djvu(request)
 
         assert mock_page_instance.write_image_for_djvu.called
+        page_options = mock_page_instance.write_image_for_djvu.call_args[0][1]
+        assert page_options["pids"] is mock_thread_instance.running_pids
+        assert page_options["pidfile"] is None, "encoders don't share the pidfile"
         # Check djvm call
         args, _ = mock_exec.call_args
         assert args[0][0] == "djvm"
@@ -236,50 +269,219 @@ def test_save_djvu_failure(mock_thread_instance, mock_page_instance):
         assert args[0].type.name == "ERROR"
 
 
-def test_save_tiff(mock_thread_instance, mock_page_instance):
-    "Test save_tiff method"
-    mock_thread_instance.mock_pages[1] = mock_page_instance
+def test_save_djvu_layers(mock_thread_instance):
+    "Test the layers of all pages and the metadata are set by one djvused call"
+    for i, script in (
+        (1, "set-txt\n(page 0 0 1 1)\n.\n"),
+        (2, ""),
+        (3, "set-ant\n.\n"),
+    ):
+        page = MagicMock(spec=Page)
+        page.djvused_script.return_value = script
+        mock_thread_instance.mock_pages[i] = page
     options = {
         "dir": "/tmp",
-        "path": "/tmp/output.tif",
-        "list_of_pages": [1],
-        "options": {"compression": "jpeg", "quality": 75},
+        "path": "/tmp/output.djvu",
+        "list_of_pages": [1, 2, 3],
+        "metadata": {"datetime": datetime.datetime.now(), "title": "a title"},
+        "options": {},
         "pidfile": "pidfile",
     }
-    request = Request("save_tiff", (options,), mock_thread_instance.responses)
+    request = Request("save_djvu", (options,), mock_thread_instance.responses)
 
     with patch("savethread.tempfile.NamedTemporaryFile") as mock_temp, patch(
+        "savethread.exec_command"
+    ) as mock_exec, patch("savethread.os.remove"), patch(
+        "savethread._set_timestamp"
+    ), patch(
+        "savethread._post_save_hook"
+    ), patch(
         "savethread.subprocess.run"
-    ) as mock_run, patch("savethread.os.remove"), patch("savethread._post_save_hook"):
+    ) as mock_run:
+        fhd = mock_temp.return_value.__enter__.return_value
+        fhd.name = "/tmp/script.txt"
+        mock_exec.return_value.returncode = 0
+        mock_thread_instance.do_save_djvu(request)
 
-        mock_temp.return_value.__enter__.return_value.name = "/tmp/temp.tif"
+    assert mock_run.call_count == 1
+    assert mock_run.call_args[0][0] == [
+        "djvused",
+        "/tmp/output.djvu",
+        "-f",
+        "/tmp/script.txt",
+        "-s",
+    ]
+    fhd.write.assert_called_once()
+    script = fhd.write.call_args[0][0]
+    assert script.startswith(
+        "select 1\nset-txt\n(page 0 0 1 1)\n.\n"
+        "select 3\nset-ant\n.\n"
+        "select\nset-meta\n(metadata\n"
+    )
+    assert 'title "a title"\n' in script
+    assert script.endswith(")\n.\n")
+
+
+def _djvu_pages(thread, npages, write):
+    "add mock pages to thread, returning the names of their temporary files"
+    names = []
+    for i in range(1, npages + 1):
+        page = MagicMock(spec=Page)
+        page.write_image_for_djvu.side_effect = partial(write, i)
+        page.djvused_script.return_value = ""
+        thread.mock_pages[i] = page
+        temp = MagicMock()
+        temp.__enter__.return_value.name = f"/tmp/page{i}.djvu"
+        names.append(temp)
+    return names
+
+
+def test_save_djvu_parallel(mock_thread_instance):
+    "Test pages are encoded concurrently, and merged in page order"
+    mock_thread_instance.processes = 3
+    lock = threading.Lock()
+    active = []
+    concurrency = []
+
+    def write(i, _filename, _options):
+        with lock:
+            active.append(i)
+            concurrency.append(len(active))
+        time.sleep(0.01 * (7 - i))  # the first pages finish last
+        with lock:
+            active.remove(i)
+
+    temps = _djvu_pages(mock_thread_instance, 6, write)
+    options = {
+        "dir": "/tmp",
+        "path": "/tmp/output.djvu",
+        "list_of_pages": list(range(1, 7)),
+        "options": {},
+        "pidfile": "pidfile",
+    }
+    request = Request("save_djvu", (options,), mock_thread_instance.responses)
+    with patch("savethread.tempfile.NamedTemporaryFile", side_effect=temps), patch(
+        "savethread.exec_command"
+    ) as mock_exec, patch("savethread.os.remove"), patch(
+        "savethread._set_timestamp"
+    ), patch(
+        "savethread._post_save_hook"
+    ):
+        mock_exec.return_value.returncode = 0
+        mock_thread_instance.do_save_djvu(request)
+
+    assert max(concurrency) > 1
+    assert max(concurrency) <= 3
+    assert mock_exec.call_args[0][0] == [
+        "djvm",
+        "-c",
+        "/tmp/output.djvu",
+        *[f"/tmp/page{i}.djvu" for i in range(1, 7)],
+    ]
+    assert mock_thread_instance.progress == 1
+
+
+def test_save_djvu_cancel(mock_thread_instance):
+    "Test cancelling stops encoding pages and removes the temporary files"
+    mock_thread_instance.processes = 2
+
+    def write(i, _filename, _options):
+        if i == 2:
+            mock_thread_instance.cancel = True
+
+    temps = _djvu_pages(mock_thread_instance, 6, write)
+    options = {
+        "dir": "/tmp",
+        "path": "/tmp/output.djvu",
+        "list_of_pages": list(range(1, 7)),
+        "pidfile": "pidfile",
+    }
+    request = Request("save_djvu", (options,), mock_thread_instance.responses)
+    with patch("savethread.tempfile.NamedTemporaryFile", side_effect=temps), patch(
+        "savethread.exec_command"
+    ) as mock_exec, patch("savethread.os.path.exists", return_value=True), patch(
+        "savethread.os.remove"
+    ) as mock_remove:
+        with pytest.raises(CancelledError):
+            mock_thread_instance.do_save_djvu(request)
+
+    mock_exec.assert_not_called()
+    assert not mock_thread_instance.mock_pages[6].write_image_for_djvu.called
+    created = [temp for temp in temps if temp.__enter__.called]
+    assert mock_remove.call_count == len(created)
+
+
+def test_save_tiff(mock_thread_instance, tmp_path):
+    "Test save_tiff method encodes each page once, appending them in order"
+    mock_thread_instance.processes = 2
+    for i in range(1, 6):
+        page = Page(image_object=Image.new("RGB", (10 * i, 10)))
+        page.resolution = (300, 300, "PixelsPerInch")
+        mock_thread_instance.mock_pages[i] = page
+    options = {
+        "dir": tmp_path,
+        "path": str(tmp_path / "output.tif"),
+        "list_of_pages": [1, 2, 3, 4, 5],
+        "options": {"compression": "jpeg", "quality": 75},
+        "pidfile": "pidfile",
+    }
+    request = Request("save_tiff", (options,), mock_thread_instance.responses)
 
+    with patch("savethread.subprocess.run") as mock_run, patch(
+        "savethread._post_save_hook"
+    ):
         mock_thread_instance.do_save_tiff(request)
 
-        assert mock_page_instance.write_image_for_tiff.called
-        assert mock_run.called
-        assert "tiffcp" in mock_run.call_args[0][0]
-        assert "-c" in mock_run.call_args[0][0]
-        assert "jpeg:75" in mock_run.call_args[0][0]
+    mock_run.assert_not_called()
+    assert mock_thread_instance.progress == 1
+    with Image.open(options["path"]) as tiff:
+        assert tiff.n_frames == 5
+        for i in range(5):
+            tiff.seek(i)
+            assert tiff.size == (10 * (i + 1), 10)
+            assert tiff.info["compression"] == "jpeg"
+            assert tiff.info["dpi"] == (300, 300)
+
+
+def test_save_tiff_cancel(mock_thread_instance, tmp_path):
+    "Test cancelling saving a TIFF stops encoding pages and removes the file"
+    mock_thread_instance.processes = 1
+
+    def write(i, fhd, _options):
+        if i == 2:
+            mock_thread_instance.cancel = True
+        Image.new("1", (10, 10)).save(fhd, format="TIFF")
+
+    for i in range(1, 6):
+        page = MagicMock(spec=Page)
+        page.write_image_for_tiff.side_effect = partial(write, i)
+        mock_thread_instance.mock_pages[i] = page
+    options = {
+        "path": str(tmp_path / "output.tif"),
+        "list_of_pages": [1, 2, 3, 4, 5],
+        "options": {},
+        "pidfile": "pidfile",
+    }
+    request = Request("save_tiff", (options,), mock_thread_instance.responses)
+    with pytest.raises(CancelledError):
+        mock_thread_instance.do_save_tiff(request)
+
+    assert not mock_thread_instance.mock_pages[5].write_image_for_tiff.called
+    assert not (tmp_path / "output.tif").exists()
 
 
-def test_save_tiff_ps(mock_thread_instance, mock_page_instance):
+def test_save_tiff_ps(mock_thread_instance, mock_page_instance, tmp_path):
     "Test save_tiff method to PS"
     mock_thread_instance.mock_pages[1] = mock_page_instance
     options = {
-        "dir": "/tmp",
-        "path": "/tmp/output.tif",
+        "path": str(tmp_path / "output.tif"),
         "list_of_pages": [1],
         "options": {"ps": "/tmp/output.ps"},
         "pidfile": "pidfile",
     }
     request = Request("save_tiff", (options,), mock_thread_instance.responses)
 
-    with patch("savethread.tempfile.NamedTemporaryFile"), patch(
-        "savethread.subprocess.run"
-    ), patch("savethread.exec_command") as mock_exec, patch(
-        "savethread.os.remove"
-    ), patch(
+    with patch("savethread.exec_command") as mock_exec, patch(
         "savethread._post_save_hook"
     ):
 
@@ -292,23 +494,18 @@ def test_save_tiff_ps(mock_thread_instance, mock_page_instance):
         assert "tiff2ps" in mock_exec.call_args[0][0]
 
 
-def test_save_tiff_ps_failure(mock_thread_instance, mock_page_instance):
+def test_save_tiff_ps_failure(mock_thread_instance, mock_page_instance, tmp_path):
     "Test save_tiff method to PS with failure"
     mock_thread_instance.mock_pages[1] = mock_page_instance
     options = {
-        "dir": "/tmp",
-        "path": "/tmp/output.tif",
+        "path": str(tmp_path / "output.tif"),
         "list_of_pages": [1],
         "options": {"ps": "/tmp/output.ps"},
         "pidfile": "pidfile",
     }
     request = Request("save_tiff", (options,), mock_thread_instance.responses)
 
-    with patch("savethread.tempfile.NamedTemporaryFile"), patch(
-        "savethread.subprocess.run"
-    ), patch("savethread.exec_command") as mock_exec, patch(
-        "savethread.os.remove"
-    ), patch(
+    with patch("savethread.exec_command") as mock_exec, patch(
         "savethread._post_save_hook"
     ):
 
@@ -568,9 +765,7 @@ def test_save_pdf_prepend(mock_thread_instance, mock_page_instance):
     ), patch("savethread.open", mock_open()), patch(
         "savethread.img2pdf.convert", return_value=b"pdf"
     ), patch(
-        "savethread.ocrmypdf.api._pdf_to_hocr"
-    ), patch(
-        "savethread.ocrmypdf.api._hocr_to_ocr_pdf"
+        "savethread.pikepdf.open"
     ), patch(
         "savethread.os.remove"
     ), patch(
@@ -633,9 +828,7 @@ def test_save_pdf_with_password(mock_thread_instance, mock_page_instance):
     ), patch("savethread.open", mock_open()), patch(
         "savethread.img2pdf.convert", return_value=b"pdf_data"
     ), patch(
-        "savethread.ocrmypdf.api._pdf_to_hocr"
-    ), patch(
-        "savethread.ocrmypdf.api._hocr_to_ocr_pdf"
+        "savethread.pikepdf.open"
     ), patch(
         "savethread.os.remove"
     ), patch(
@@ -671,9 +864,7 @@ def test_save_pdf_with_password_failure(mock_thread_instance, mock_page_instance
     ), patch("savethread.open", mock_open()), patch(
         "savethread.img2pdf.convert", return_value=b"pdf_data"
     ), patch(
-        "savethread.ocrmypdf.api._pdf_to_hocr"
-    ), patch(
-        "savethread.ocrmypdf.api._hocr_to_ocr_pdf"
+        "savethread.pikepdf.open"
     ), patch(
         "savethread.os.remove"
     ), patch(
@@ -711,9 +902,7 @@ def test_save_pdf_ps_failure(mock_thread_instance, mock_page_instance):
     ), patch("savethread.open", mock_open()), patch(
         "savethread.img2pdf.convert", return_value=b"pdf_data"
     ), patch(
-        "savethread.ocrmypdf.api._pdf_to_hocr"
-    ), patch(
-        "savethread.ocrmypdf.api._hocr_to_ocr_pdf"
+        "savethread.pikepdf.open"
     ), patch(
         "savethread.os.remove"
     ), patch(
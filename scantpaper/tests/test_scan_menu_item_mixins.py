@@ -1,6 +1,7 @@
 "Tests for the ScanMenuItemMixins."
 
 import os
+import threading
 from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 import pytest
@@ -65,6 +66,7 @@ def mock_scan_window(mocker):
         "adf-defaults-scan-all-pages": False,
         "ignore-duplex-capabilities": False,
         "cycle sane handle": False,
+        "scan spool size": 4,
         "cancel-between-pages": False,
         "profile": {},
         "scan_window_width": 100,
@@ -515,6 +517,23 @@ def test_new_scan_callback(mock_scan_window):
     assert call_kwargs["resolution"] == (300, 300, "PixelsPerInch")
 
 
+def test_new_scan_callback_releases_scan(mock_scan_window):
+    "Test the scan dialog is told once the scan has been imported"
+    mock_widget = MagicMock()
+    mock_scan_window.slist.import_scan = MagicMock()
+    mock_scan_window._error_callback = MagicMock()
+
+    mock_scan_window._new_scan_callback(mock_widget, MagicMock(), 1, 300, 300)
+    call_kwargs = mock_scan_window.slist.import_scan.call_args[1]
+    mock_widget.release_scan.assert_not_called()
+    call_kwargs["finished_callback"]("response")
+    mock_widget.release_scan.assert_called_once()
+    mock_scan_window.post_process_progress.finish.assert_called_with("response")
+    call_kwargs["error_callback"]("error")
+    assert mock_widget.release_scan.call_count == 2
+    mock_scan_window._error_callback.assert_called_with("error")
+
+
 def test_new_scan_callback_none_image(mock_scan_window):
     "Test _new_scan_callback with None image"
     mock_scan_window.slist.import_scan = MagicMock()
@@ -522,6 +541,19 @@ def test_new_scan_callback_none_image(mock_scan_window):
     mock_scan_window.slist.import_scan.assert_not_called()
 
 
+def test_new_scan_callback_none_image_releases_spool(mock_scan_window):
+    "Test an empty frame frees its place in the scan spool"
+    spool = threading.BoundedSemaphore(1)
+    mock_widget = MagicMock()
+    mock_widget.release_scan.side_effect = spool.release
+    mock_scan_window.slist.import_scan = MagicMock()
+
+    assert spool.acquire(blocking=False), "the frame takes the only place"
+    mock_scan_window._new_scan_callback(mock_widget, None, 1, 300, 300)
+    mock_scan_window.slist.import_scan.assert_not_called()
+    assert spool.acquire(blocking=False), "the place is free for the next frame"
+
+
 def test_new_scan_callback_options(mock_scan_window):
     "Test _new_scan_callback with various options"
     mock_image = MagicMock()
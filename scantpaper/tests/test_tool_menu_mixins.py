@@ -119,7 +119,7 @@ def test_ocr_display_callback(mocker, mock_tool_window):
     mock_tool_window._create_txt_canvas = mocker.Mock()
 
     mock_response = mocker.Mock()
-    mock_response.request.args = [{"page": "uuid"}]
+    mock_response.info = {"type": "page", "row": (1, None, "uuid")}
 
     mock_tool_window._ocr_display_callback(mock_response)
 
@@ -131,7 +131,7 @@ def test_ocr_display_callback_page_not_found(mocker, mock_tool_window):
     mock_tool_window.slist.find_page_by_uuid.return_value = None
     mock_tool_window._create_txt_canvas = mocker.Mock()
     mock_response = mocker.Mock()
-    mock_response.request.args = [{"page": "uuid"}]
+    mock_response.info = {"type": "page", "row": (1, None, "uuid")}
 
     mock_tool_window._ocr_display_callback(mock_response)
     mock_tool_window._create_txt_canvas.assert_not_called()
@@ -143,7 +143,7 @@ def test_ocr_display_callback_page_not_selected(mocker, mock_tool_window):
     mock_tool_window.slist.get_selected_indices.return_value = [1]
     mock_tool_window._create_txt_canvas = mocker.Mock()
     mock_response = mocker.Mock()
-    mock_response.request.args = [{"page": "uuid"}]
+    mock_response.info = {"type": "page", "row": (1, None, "uuid")}
 
     mock_tool_window._ocr_display_callback(mock_response)
     mock_tool_window._create_txt_canvas.assert_not_called()
@@ -630,7 +630,7 @@ def test_unpaper_dialog(mocker, mock_tool_window):
     call_kwargs = mock_tool_window.slist.unpaper.call_args[1]
     assert call_kwargs["options"]["command"] == ["unpaper"]
     assert call_kwargs["options"]["direction"] == "direction"
-    assert call_kwargs["page"] == "pageobject"
+    assert call_kwargs["pages"] == ["pageobject"]
 
     # Execute finished callback
     finished_callback = call_kwargs["finished_callback"]
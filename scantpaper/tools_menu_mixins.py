@@ -556,25 +556,28 @@ class ToolsMenuMixins:
                 )
             )
 
-            # run unpaper
-            for pageobject in pagelist:
+            if not pagelist:
+                self._windowu.hide()
+                return
 
-                def unpaper_finished_callback(response):
-                    self.post_process_progress.finish(response)
+            def unpaper_display_callback(response):
+                self.post_process_progress.update(response)
+                self._display_callback(response)
 
-                self.slist.unpaper(
-                    page=pageobject,
-                    options={
-                        "command": self._unpaper.get_cmdline(),
-                        "direction": self._unpaper.get_option("direction"),
-                    },
-                    queued_callback=self.post_process_progress.queued,
-                    started_callback=self.post_process_progress.update,
-                    running_callback=self.post_process_progress.update,
-                    finished_callback=unpaper_finished_callback,
-                    error_callback=self._error_callback,
-                    display_callback=self._display_callback,
-                )
+            # run unpaper
+            self.slist.unpaper(
+                pages=pagelist,
+                options={
+                    "command": self._unpaper.get_cmdline(),
+                    "direction": self._unpaper.get_option("direction"),
+                },
+                queued_callback=self.post_process_progress.queued,
+                started_callback=self.post_process_progress.update,
+                running_callback=self.post_process_progress.update,
+                finished_callback=self.post_process_progress.finish,
+                error_callback=self._error_callback,
+                display_callback=unpaper_display_callback,
+            )
             self._windowu.hide()
 
         self._windowu.add_actions(
@@ -657,7 +660,8 @@ class ToolsMenuMixins:
 
     def _ocr_display_callback(self, response):
         "Callback function to handle the display of OCR (Optical Character Recognition) results."
-        uuid = response.request.args[0]["page"]
+        self.post_process_progress.update(response)
+        uuid = response.info["row"][2]
         i = self.slist.find_page_by_uuid(uuid)
         if i is None:
             logger.error("Can't display page with uuid %s: page not found", uuid)
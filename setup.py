@@ -68,7 +68,7 @@ deleting pages.
 OCR can be used to recognise text in the scans, and the output embedded in the
 PDF or DjVu.
 
-PDF conversion is done by ocrmypdf.
+PDF conversion is done by img2pdf and pikepdf.
 
 The resulting document may be saved as a PDF, DjVu, multipage TIFF file, or
 single page image file.""",